@@ -0,0 +1,175 @@
+"""Suggests the activity type of routes from their geometry.
+
+Every route gets a few features computed over all routes at once:
+
+  sinuosity: path length over the distance between the endpoints, in log.
+  length: path length, in log.
+  near_road, near_water: fraction of the vertices within NEAR_DISTANCE_M of a
+    road, or of a paddle, float or rapid route.
+  speed: median speed, in log, for routes with timestamps.
+
+The routes that already have an activity type are the examples: a route
+gets the most common activity of its NUM_NEIGHBORS closest examples in
+standardized feature space.
+"""
+
+import dataclasses
+from typing import Text
+
+import numpy as np
+
+import route
+import simplify
+
+NEAR_DISTANCE_M = 30.0
+NEAR_ACTIVITIES = {'near_road': ('road',), 'near_water': ('paddle', 'float', 'rapid')}
+NUM_NEIGHBORS = 7
+# Routes classified at once, bounds the memory of the distance matrix.
+BLOCK_SIZE = 1024
+
+
+@dataclasses.dataclass
+class Suggestion:
+  route_id: int
+  name: Text
+  activity_type: Text
+  # Fraction of the neighbors with that activity.
+  confidence: float
+
+
+class SegmentGrid:
+  """Uniform grid of segments, for the distance of points to the closest
+  segment within a radius."""
+
+  def __init__(self, a, b, owner, radius_m):
+    self._cell_size = max(2.0 * radius_m, float(np.median(np.hypot(*(b - a).T))) if len(a) else 1.0)
+    # Long segments are indexed as cell sized pieces, which only cover a few
+    # cells each.
+    a, b, segment = simplify.split_segments(a, b, self._cell_size)
+    self._a, self._b, self._owner = a, b, owner[segment]
+    low = np.floor((np.minimum(a, b) - radius_m) / self._cell_size).astype(np.int64)
+    high = np.floor((np.maximum(a, b) + radius_m) / self._cell_size).astype(np.int64)
+    extent = high - low + 1
+    num_cells = extent[:, 0] * extent[:, 1]
+    segment = np.repeat(np.arange(len(a)), num_cells)
+    rank = np.arange(len(segment)) - np.repeat(np.cumsum(num_cells) - num_cells, num_cells)
+    cells = low[segment] + np.stack([rank // extent[segment, 1], rank % extent[segment, 1]], axis=1)
+    keys = self._keys(cells)
+    order = np.argsort(keys, kind='stable')
+    self._keys_sorted, self._segments = keys[order], segment[order]
+
+  @staticmethod
+  def _keys(cells):
+    # Cells are hashed to one int64, collisions only add candidates.
+    return cells[:, 0] * 73856093 ^ cells[:, 1] * 19349663
+
+  def nearest_distances(self, points, owner):
+    """Distance of every point to the closest segment with another owner,
+    inf if there is none in its cell."""
+    distances = np.full(len(points), np.inf)
+    if not len(self._segments) or not len(points):
+      return distances
+    keys = self._keys(np.floor(points / self._cell_size).astype(np.int64))
+    first = np.searchsorted(self._keys_sorted, keys, side='left')
+    counts = np.searchsorted(self._keys_sorted, keys, side='right') - first
+    point = np.repeat(np.arange(len(points)), counts)
+    entry = np.repeat(first, counts) + np.arange(len(point)) - np.repeat(np.cumsum(counts) - counts, counts)
+    segment = self._segments[entry]
+    other = self._owner[segment] != owner[point]
+    point, segment = point[other], segment[other]
+    a, ab = self._a[segment], self._b[segment] - self._a[segment]
+    t = np.clip(np.einsum('ij,ij->i', points[point] - a, ab) / np.maximum(np.einsum('ij,ij->i', ab, ab), 1e-12),
+                0.0, 1.0)
+    np.minimum.at(distances, point, np.hypot(*(points[point] - a - t[:, None] * ab).T))
+    return distances
+
+
+def route_features(routes, times=None):
+  """(num_routes, num_features) features of the routes and their names.
+
+  times, if given, maps a route index to the seconds of each of its vertices.
+  """
+  lengths = np.array([len(r.points) for r in routes], dtype=np.int64)
+  latlngs = np.array([[p.lat, p.lng] for r in routes for p in r.points], dtype=np.float64).reshape(-1, 2)
+  xy = simplify.local_xy(latlngs)
+  owner = np.repeat(np.arange(len(routes)), lengths)
+  offsets = np.cumsum(lengths) - lengths
+  nonempty = lengths > 0
+  # Segments within a route, from vertex i to i + 1.
+  within = np.ones(len(xy), dtype=bool)
+  within[(offsets + lengths - 1)[nonempty]] = False
+  start = within.nonzero()[0]
+  segment_lengths = np.hypot(*(xy[start + 1] - xy[start]).T)
+  path_length = np.bincount(owner[start], weights=segment_lengths, minlength=len(routes))
+  chord = np.zeros(len(routes))
+  chord[nonempty] = np.hypot(*(xy[(offsets + lengths - 1)[nonempty]] - xy[offsets[nonempty]]).T)
+  features = {
+      'sinuosity': np.log(np.maximum(path_length, 1.0) / np.maximum(chord, 1.0)),
+      'length': np.log(np.maximum(path_length, 1.0)),
+  }
+
+  for feature, activities in NEAR_ACTIVITIES.items():
+    reference = np.array([r.activity_type in activities for r in routes])
+    reference_segments = start[reference[owner[start]]]
+    grid = SegmentGrid(xy[reference_segments], xy[reference_segments + 1], owner[reference_segments],
+                       NEAR_DISTANCE_M)
+    near = grid.nearest_distances(xy, owner) <= NEAR_DISTANCE_M
+    features[feature] = np.bincount(owner, weights=near, minlength=len(routes)) / np.maximum(lengths, 1)
+
+  if times:
+    speeds = np.full(len(routes), np.nan)
+    for i, route_times in times.items():
+      dt = np.diff(np.asarray(route_times, dtype=np.float64))
+      route_segments = segment_lengths[owner[start] == i]
+      valid = dt > 0
+      if valid.any():
+        speeds[i] = np.log(np.median(route_segments[valid] / dt[valid]) + 1e-3)
+    features['speed'] = speeds
+  return np.stack(list(features.values()), axis=1), list(features)
+
+
+def suggest(items, route_ids=None, times=None):
+  """Suggests an activity for the (route_id, route) items without one, or
+  for route_ids. times may map route ids to the seconds of their vertices.
+
+  Returns a list of Suggestion, most confident first.
+  """
+  routes = [r for _, r in items]
+  index = {route_id: i for i, (route_id, _) in enumerate(items)}
+  times = {index[route_id]: t for route_id, t in (times or {}).items() if route_id in index}
+  features, _ = route_features(routes, times)
+  labeled = np.array([r.activity_type in route.activity_color for r in routes], dtype=bool)
+  if route_ids is None:
+    targets = (~labeled).nonzero()[0]
+  else:
+    targets = np.array([index[route_id] for route_id in route_ids if route_id in index], dtype=np.int64)
+  activities = sorted(set(r.activity_type for r, is_labeled in zip(routes, labeled) if is_labeled))
+  if not activities or not len(targets):
+    return []
+
+  # Features missing for some routes, like speed, are set to their mean.
+  mean = np.nanmean(features[labeled], axis=0)
+  features = np.where(np.isnan(features), np.nan_to_num(mean)[None, :], features)
+  scale = np.maximum(features[labeled].std(axis=0), 1e-6)
+  standardized = (features - features[labeled].mean(axis=0)) / scale
+  activity_index = np.array([activities.index(r.activity_type) if is_labeled else -1
+                             for r, is_labeled in zip(routes, labeled)])
+  examples = labeled.nonzero()[0]
+  k = min(NUM_NEIGHBORS, len(examples))
+  best, confidence = [], []
+  for block in range(0, len(targets), BLOCK_SIZE):
+    block_targets = targets[block:block + BLOCK_SIZE]
+    distances = ((standardized[block_targets, None, :] - standardized[None, examples, :]) ** 2).sum(axis=2)
+    # A route never votes for itself.
+    distances[block_targets[:, None] == examples[None, :]] = np.inf
+    neighbors = examples[np.argpartition(distances, k - 1, axis=1)[:, :k]]
+    votes = np.zeros((len(block_targets), len(activities)))
+    np.add.at(votes, (np.repeat(np.arange(len(block_targets)), k), activity_index[neighbors].ravel()), 1.0)
+    best.append(votes.argmax(axis=1))
+    confidence.append(votes.max(axis=1) / k)
+  best, confidence = np.concatenate(best), np.concatenate(confidence)
+
+  suggestions = [Suggestion(route_id=items[i][0], name=routes[i].name, activity_type=activities[k],
+                            confidence=float(c))
+                 for i, k, c in zip(targets.tolist(), best.tolist(), confidence.tolist())]
+  return sorted(suggestions, key=lambda s: -s.confidence)
@@ -0,0 +1,271 @@
+"""Benchmarks the load, render, edit and export paths on synthetic projects.
+
+Run:
+
+  python benchmark.py -num_routes 500 -num_vertices 200 -alaska_scales 1,10 \
+      -output bench_results.jsonl
+
+Every stage is written as one JSON line with its best time over -repeats runs
+and its peak traced memory, so results from different versions can be diffed.
+"""
+
+import contextlib
+import copy
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from absl import app
+from absl import flags
+import gpxpy
+import gpxpy.geo
+import gpxpy.gpx
+
+import cleanup
+import editor
+import kml_parser
+import loader
+# Defines the flags of the editor.
+import map_server
+import route
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('num_routes', 200, 'Number of routes of the synthetic project.')
+flags.DEFINE_integer('num_vertices', 200, 'Number of vertices per synthetic route.')
+flags.DEFINE_integer('num_labels', 5, 'Number of labels per synthetic route.')
+flags.DEFINE_list('alaska_scales', ['1'], 'Replication factors of alaska.kml to benchmark, '
+                  'e.g. 1,10,100. Empty to skip.')
+flags.DEFINE_boolean('gpx', True, 'Whether to also benchmark a synthetic gpx project.')
+flags.DEFINE_integer('repeats', 3, 'Number of timed runs per stage, the best one is reported.')
+flags.DEFINE_boolean('measure_memory', True, 'Whether to do an extra traced run per stage '
+                     'to measure peak memory.')
+flags.DEFINE_integer('seed', 0, 'Random seed for the synthetic projects.')
+flags.DEFINE_string('output', None, 'JSON lines file the results are appended to.')
+
+
+def write_kml(routes, filename):
+  """Writes routes with RouteMap.save, on a headless map."""
+  route_map = route.RouteMap(headless=True)
+  for r in routes:
+    route_map.add_route(copy.deepcopy(r), static=True, check_duplicates=False)
+  route_map.save(filename)
+
+
+def synthetic_routes(num_routes, num_vertices, num_labels, seed):
+  """Random walks over Alaska with activity colors and section like labels."""
+  rng = random.Random(seed)
+  colors = list(route.activity_color.values())
+  all_labels = ['primary'] + [f's{s}{chr(ord("a") + i)}' for s in range(1, 7) for i in range(5)]
+  routes = []
+  for i in range(num_routes):
+    lat, lng = rng.uniform(60.0, 69.0), rng.uniform(-160.0, -141.0)
+    points = []
+    for _ in range(num_vertices):
+      lat += rng.gauss(0.0, 0.002)
+      lng += rng.gauss(0.0, 0.004)
+      points.append(route.LatLng(lat, lng))
+    routes.append(route.Route(
+        name=f'route {i}', points=points, description=f'Synthetic route {i}.',
+        labels=rng.sample(all_labels, min(num_labels, len(all_labels))),
+        line_style=route.LineStyle(rng.choice(colors), 5.0)))
+  return routes
+
+
+def scaled_routes(routes, scale):
+  """Replicates routes with shifted coordinates so they aren't duplicates."""
+  scaled = []
+  for copy_index in range(scale):
+    for r in routes:
+      r = copy.deepcopy(r)
+      if copy_index:
+        r.name = f'{r.name} copy{copy_index}'
+        for p in r.points:
+          p.lat += 0.001 * copy_index
+      scaled.append(r)
+  return scaled
+
+
+def write_gpx(routes, filename):
+  gpx = gpxpy.gpx.GPX()
+  for r in routes:
+    gpx_route = gpxpy.gpx.GPXRoute(name=r.name)
+    gpx_route.points = [gpxpy.gpx.GPXRoutePoint(p.lat, p.lng) for p in r.points]
+    gpx.routes.append(gpx_route)
+  with open(filename, 'w') as f:
+    f.write(gpx.to_xml())
+
+
+def _git_revision():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                   stderr=subprocess.DEVNULL, text=True).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+@contextlib.contextmanager
+def _quiet():
+  # The code under test prints progress for every route.
+  with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+    yield
+
+
+def time_stage(fn):
+  """Returns (result, best_seconds, peak_bytes) of running fn."""
+  seconds = []
+  for _ in range(FLAGS.repeats):
+    with _quiet():
+      start = time.perf_counter()
+      result = fn()
+      seconds.append(time.perf_counter() - start)
+  peak_bytes = None
+  if FLAGS.measure_memory:
+    tracemalloc.start()
+    with _quiet():
+      fn()
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+  return result, min(seconds), peak_bytes
+
+
+def _import_all(routes):
+  route_map = route.RouteMap()
+  for r in routes:
+    loader.import_route(route_map, r, static=True)
+  return route_map
+
+
+def _add_all(routes):
+  route_map = route.RouteMap()
+  for r in routes:
+    route_map.add_route(r, static=True)
+  return route_map
+
+
+def _reload_data(kml_path, work_dir):
+  # reload_data writes templates/map.html relative to the working directory.
+  FLAGS.input_gpx = None
+  FLAGS.input_kml = kml_path
+  cwd = os.getcwd()
+  os.chdir(work_dir)
+  try:
+    editor.reload_data()
+  finally:
+    os.chdir(cwd)
+
+
+def _split_all(routes):
+  for r in routes:
+    # Routes whose vertices are all the same can't be split.
+    if len(set((p.lat, p.lng) for p in r.points)) >= 2:
+      r.split(r.points[len(r.points) // 2])
+
+
+def _gpxpy_simplify(r, max_distance=5.0):
+  # Route.simplify before simplify.py, the reference of the simplify stages.
+  locs = [gpxpy.geo.Location(p.lat, p.lng, p.elevation) for p in r.points]
+  return [route.LatLng(l.latitude, l.longitude, l.elevation)
+          for l in gpxpy.geo.simplify_polyline(locs, max_distance=max_distance)]
+
+
+def benchmark_kml_project(project, kml_path, label, work_dir):
+  """Times every stage of a kml project, returns a list of result dicts."""
+  stages = []
+  routes, *timing = time_stage(lambda: kml_parser.parse_kml(kml_path))
+  stages.append(('parse_kml', timing))
+  route_map, *timing = time_stage(lambda: _import_all(routes))
+  stages.append(('import_route', timing))
+  imported = [r for _, r in route_map.items()]
+  # Copied outside the timed stage, every run adds the same copies to a new map.
+  copies = copy.deepcopy(imported)
+  _, *timing = time_stage(lambda: _add_all(copies))
+  stages.append(('add_route', timing))
+  _, *timing = time_stage(lambda: _reload_data(kml_path, work_dir))
+  stages.append(('reload_data', timing))
+  _, *timing = time_stage(lambda: route_map.compute_stats(''))
+  stages.append(('compute_stats', timing))
+  _, *timing = time_stage(lambda: route_map.compute_stats(label))
+  stages.append(('compute_stats_label', timing))
+  _, *timing = time_stage(lambda: _split_all(imported))
+  stages.append(('split', timing))
+  _, *timing = time_stage(lambda: [r.simplify() for r in imported])
+  stages.append(('simplify', timing))
+  # The raw routes, as import_route simplifies them.
+  _, *timing = time_stage(lambda: [_gpxpy_simplify(r, 1.0) for r in routes])
+  stages.append(('simplify_raw_gpxpy', timing))
+  _, *timing = time_stage(lambda: [r.simplify(1.0) for r in routes])
+  stages.append(('simplify_raw', timing))
+  _, *timing = time_stage(lambda: route.simplify_routes(routes, 1.0))
+  stages.append(('simplify_raw_batch', timing))
+  _, *timing = time_stage(lambda: cleanup.clean_routes(routes, cleanup.CleanupConfig()))
+  stages.append(('clean', timing))
+  _, *timing = time_stage(lambda: [r.simplify(1.0, method='visvalingam_whyatt') for r in routes])
+  stages.append(('simplify_raw_vw', timing))
+  save_path = os.path.join(work_dir, 'save.kml')
+  _, *timing = time_stage(lambda: route_map.save(save_path))
+  stages.append(('save', timing))
+
+  num_vertices = sum(len(r.points) for r in routes)
+  return [{'project': project, 'stage': stage, 'seconds': seconds,
+           'peak_mb': peak_bytes / 2**20 if peak_bytes is not None else None,
+           'routes': len(routes), 'vertices': num_vertices}
+          for stage, (seconds, peak_bytes) in stages]
+
+
+def benchmark_gpx_project(project, gpx_path):
+  def load():
+    gpx = loader.load_gpx(gpx_path)
+    return [route.Route(name=r.name, points=[route.LatLng(p.latitude, p.longitude) for p in r.points])
+            for r in gpx.routes]
+  routes, *load_timing = time_stage(load)
+  _, *import_timing = time_stage(lambda: _import_all(routes))
+  num_vertices = sum(len(r.points) for r in routes)
+  return [{'project': project, 'stage': stage, 'seconds': seconds,
+           'peak_mb': peak_bytes / 2**20 if peak_bytes is not None else None,
+           'routes': len(routes), 'vertices': num_vertices}
+          for stage, (seconds, peak_bytes) in [('load_gpx', load_timing),
+                                               ('import_route', import_timing)]]
+
+
+def main(argv):
+  environment = {'git_revision': _git_revision(), 'python': platform.python_version(),
+                 'timestamp': time.time(), 'repeats': FLAGS.repeats}
+  results = []
+  with tempfile.TemporaryDirectory() as work_dir:
+    os.mkdir(os.path.join(work_dir, 'templates'))
+    synthetic = synthetic_routes(FLAGS.num_routes, FLAGS.num_vertices, FLAGS.num_labels, FLAGS.seed)
+    project = f'synthetic_{FLAGS.num_routes}x{FLAGS.num_vertices}x{FLAGS.num_labels}'
+    kml_path = os.path.join(work_dir, f'{project}.kml')
+    write_kml(synthetic, kml_path)
+    results += benchmark_kml_project(project, kml_path, 'primary', work_dir)
+    if FLAGS.gpx:
+      gpx_path = os.path.join(work_dir, f'{project}.gpx')
+      write_gpx(synthetic, gpx_path)
+      results += benchmark_gpx_project(f'{project}_gpx', gpx_path)
+
+    if FLAGS.alaska_scales:
+      with _quiet():
+        alaska = kml_parser.parse_kml('alaska.kml')
+      for scale in FLAGS.alaska_scales:
+        kml_path = os.path.join(work_dir, f'alaska_{scale}x.kml')
+        write_kml(scaled_routes(alaska, int(scale)), kml_path)
+        results += benchmark_kml_project(f'alaska_{scale}x', kml_path, 'primary', work_dir)
+
+  for result in results:
+    result.update(environment)
+    peak_str = f'{result["peak_mb"]:9.1f} MB' if result['peak_mb'] is not None else ''
+    print(f'{result["project"]:>30} {result["stage"]:>20} {result["seconds"]:9.3f} s {peak_str}')
+  if FLAGS.output:
+    with open(FLAGS.output, 'a') as f:
+      for result in results:
+        f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+  app.run(main)
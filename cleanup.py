@@ -0,0 +1,149 @@
+"""Cleans raw GPS logs before they are imported.
+
+Every step works on the whole track at once and counts the vertices it
+removed:
+
+  dedup: repeated vertices.
+  spike: vertices far from both neighbors when the neighbors are close.
+  stationary: the jitter of a device that isn't moving, collapsed to the
+    first vertex. A slow track leaves the radius before the run is long
+    enough, so densely sampled walks keep their vertices.
+  resample: vertices at a uniform spacing along the track.
+"""
+
+import collections
+import copy
+import dataclasses
+from typing import Optional
+
+import numpy as np
+
+import metrics
+import route
+import simplify
+
+STEPS = ('dedup', 'spike', 'stationary', 'resample')
+
+
+@dataclasses.dataclass
+class CleanupConfig:
+  """A step is skipped when its parameter is None."""
+  dedup: bool = True
+  spike_distance_m: Optional[float] = 200.0
+  stationary_radius_m: Optional[float] = 5.0
+  # Stationary runs have more than 2 * stationary_window vertices.
+  stationary_window: int = 3
+  resample_spacing_m: Optional[float] = None
+
+
+def _distances(xy):
+  return np.hypot(*np.diff(xy, axis=0).T)
+
+
+def dedup_mask(xy):
+  mask = np.ones(len(xy), dtype=bool)
+  mask[1:] = np.any(np.diff(xy, axis=0) != 0.0, axis=1)
+  return mask
+
+
+def spike_mask(xy, spike_distance_m):
+  mask = np.ones(len(xy), dtype=bool)
+  if len(xy) < 3:
+    return mask
+  legs = _distances(xy)
+  shortcut = np.hypot(*(xy[2:] - xy[:-2]).T)
+  in_leg, out_leg = legs[:-1], legs[1:]
+  mask[1:-1] = ~((in_leg > spike_distance_m) & (out_leg > spike_distance_m) &
+                 (shortcut < 0.5 * np.minimum(in_leg, out_leg)))
+  return mask
+
+
+def stationary_mask(xy, radius_m, window):
+  """Runs of more than 2 * window vertices all within radius_m of the first
+  vertex of the run are stationary, only their first vertex is kept."""
+  n = len(xy)
+  mask = np.ones(n, dtype=bool)
+  min_run = 2 * window + 1
+  start = 0
+  while start < n - 1:
+    # Looks ahead in growing chunks, a moving track leaves the radius after a
+    # few vertices.
+    chunk = 4 * min_run
+    while True:
+      distances = np.hypot(*(xy[start + 1:start + 1 + chunk] - xy[start]).T)
+      outside = np.flatnonzero(distances > radius_m)
+      if len(outside) or start + 1 + chunk >= n:
+        break
+      chunk *= 2
+    end = start + 1 + (outside[0] if len(outside) else len(distances))
+    if end - start >= min_run:
+      mask[start + 1:end] = False
+    start = end
+  mask[-1] = True
+  return mask
+
+
+def resample(xy, elevations, spacing_m):
+  """Returns the xy and elevations of vertices spaced spacing_m along the
+  track, keeping both endpoints."""
+  cumulative = np.concatenate([[0.0], np.cumsum(_distances(xy))])
+  if cumulative[-1] <= spacing_m:
+    return xy, elevations
+  samples = np.append(np.arange(0.0, cumulative[-1], spacing_m), cumulative[-1])
+  new_xy = np.stack([np.interp(samples, cumulative, xy[:, 0]), np.interp(samples, cumulative, xy[:, 1])], axis=1)
+  valid = ~np.isnan(elevations)
+  if valid.any():
+    new_elevations = np.interp(samples, cumulative[valid], elevations[valid])
+  else:
+    new_elevations = np.full(len(samples), np.nan)
+  return new_xy, new_elevations
+
+
+def clean_route(r, config, removed=None):
+  """Returns a cleaned copy of r, adding the vertices removed by every step to
+  the removed counter.
+
+  Resampling may add vertices, they count as negative removals.
+  """
+  removed = removed if removed is not None else collections.Counter()
+  latlngs = np.array(r.points_as_list(), dtype=np.float64).reshape(-1, 2)
+  xy = simplify.local_xy(latlngs)
+  elevations = r.elevations()
+  # Original vertex of every remaining vertex, until resampling.
+  index = np.arange(len(xy))
+  steps = [
+      ('dedup', config.dedup, lambda: dedup_mask(xy)),
+      ('spike', config.spike_distance_m is not None, lambda: spike_mask(xy, config.spike_distance_m)),
+      ('stationary', config.stationary_radius_m is not None,
+       lambda: stationary_mask(xy, config.stationary_radius_m, config.stationary_window)),
+  ]
+  for step, enabled, step_mask in steps:
+    if not enabled or len(xy) < 2:
+      continue
+    mask = step_mask()
+    removed[step] += int(len(mask) - mask.sum())
+    xy, elevations, index = xy[mask], elevations[mask], index[mask]
+
+  cleaned = copy.deepcopy(dataclasses.replace(r, points=[]))
+  if config.resample_spacing_m is not None and len(xy) >= 2:
+    num_vertices = len(xy)
+    xy, elevations = resample(xy, elevations, config.resample_spacing_m)
+    removed['resample'] += num_vertices - len(xy)
+    cleaned.points = [route.LatLng(lat, lng, None if np.isnan(elevation) else elevation)
+                      for (lat, lng), elevation in zip(simplify.latlng_from_xy(xy, latlngs[:, 0].mean()).tolist(), elevations.tolist())]
+    # The endpoints stay exactly where they were.
+    cleaned.points[0], cleaned.points[-1] = copy.copy(r.points[index[0]]), copy.copy(r.points[index[-1]])
+  else:
+    cleaned.points = [copy.copy(r.points[i]) for i in index.tolist()]
+  return cleaned
+
+
+@metrics.timed('clean_routes')
+def clean_routes(routes, config):
+  """Returns the cleaned copies of routes and the vertices removed by every step."""
+  removed = collections.Counter()
+  cleaned = [clean_route(r, config, removed) for r in routes]
+  for step, count in removed.items():
+    metrics.inc('routemapper_cleanup_removed_vertices_total', count, 'Vertices removed by the track cleanup.',
+                step=step)
+  return cleaned, removed
@@ -0,0 +1,40 @@
+import collections
+
+from absl.testing import absltest
+import numpy as np
+
+import cleanup
+import route
+import simplify
+
+
+def _track(xy, lat=60.0):
+  latlngs = simplify.latlng_from_xy(np.asarray(xy, dtype=np.float64), lat)
+  return route.Route(name='track', points=[route.LatLng(lat, lng) for lat, lng in latlngs.tolist()])
+
+
+class StationaryTest(absltest.TestCase):
+
+  def test_slow_dense_track_keeps_its_shape(self):
+    # A 2 km walk sampled at 1 Hz, 1.2 m/s, with a bend halfway.
+    t = np.arange(1700.0)
+    xy = np.stack([np.minimum(t, 850.0) * 1.2, np.maximum(t - 850.0, 0.0) * 1.2], axis=1)
+    removed = collections.Counter()
+    cleaned = cleanup.clean_route(_track(xy), cleanup.CleanupConfig(), removed)
+    self.assertEqual(removed['stationary'], 0)
+    self.assertLen(cleaned.points, 1700)
+
+  def test_jitter_collapses(self):
+    rng = np.random.default_rng(0)
+    walk_in = np.stack([np.arange(20.0) * 10.0, np.zeros(20)], axis=1)
+    jitter = walk_in[-1] + rng.uniform(-2.0, 2.0, size=(300, 2))
+    walk_out = walk_in[-1] + np.stack([np.arange(1.0, 21.0) * 10.0, np.zeros(20)], axis=1)
+    xy = np.concatenate([walk_in, jitter, walk_out])
+    mask = cleanup.stationary_mask(xy, 5.0, 3)
+    self.assertGreater(len(xy) - mask.sum(), 290)
+    self.assertTrue(mask[:20].all())
+    self.assertTrue(mask[-20:].all())
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,248 @@
+import collections
+import math
+import os
+import re
+import struct
+import threading
+
+import numpy as np
+
+# Rasters are read in blocks (GeoTIFF tiles or strips, or bands of rows for
+# .hgt files). Blocks are memory-mapped from disk and only decoded to float32
+# when sampled; decoded blocks are kept in an LRU cache shared by all rasters.
+_HGT_BLOCK_ROWS = 256
+
+_TIFF_TYPES = {1: 'B', 2: 's', 3: 'H', 4: 'I', 6: 'b', 7: 'B', 8: 'h', 9: 'i',
+               11: 'f', 12: 'd', 16: 'Q'}
+_TIFF_DTYPES = {(1, 8): 'u1', (1, 16): 'u2', (1, 32): 'u4',
+                (2, 8): 'i1', (2, 16): 'i2', (2, 32): 'i4',
+                (3, 32): 'f4', (3, 64): 'f8'}
+
+
+class _TileCache:
+
+  def __init__(self, max_tiles):
+    self._max_tiles = max_tiles
+    self._tiles = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key, load_fn):
+    with self._lock:
+      tile = self._tiles.get(key)
+      if tile is not None:
+        self._tiles.move_to_end(key)
+        return tile
+    tile = load_fn()
+    with self._lock:
+      self._tiles[key] = tile
+      while len(self._tiles) > self._max_tiles:
+        self._tiles.popitem(last=False)
+    return tile
+
+
+class Raster:
+  """Single band lat/lng raster stored as contiguous blocks in a file.
+
+  lat_first/lng_first are the coordinates of the center of pixel (0, 0), rows
+  go south and columns go east.
+  """
+
+  def __init__(self, path, dtype, shape, block_shape, block_offsets,
+               lat_first, lng_first, lat_step, lng_step, nodata=None,
+               padded_blocks=False):
+    self.path = path
+    self.dtype = np.dtype(dtype)
+    self.shape = shape
+    self.block_shape = block_shape
+    self.block_offsets = block_offsets
+    self.lat_first = lat_first
+    self.lng_first = lng_first
+    self.lat_step = lat_step
+    self.lng_step = lng_step
+    self.nodata = nodata
+    # GeoTIFF tiles are padded to full size at the image edges, strips and
+    # hgt row bands are not.
+    self.padded_blocks = padded_blocks
+    self._blocks_per_row = -(-shape[1] // block_shape[1])
+    self._data = None
+
+  def bounds(self):
+    south = self.lat_first - (self.shape[0] - 1) * self.lat_step
+    east = self.lng_first + (self.shape[1] - 1) * self.lng_step
+    return south, self.lng_first, self.lat_first, east
+
+  def _block(self, block_index):
+    if self._data is None:
+      self._data = np.memmap(self.path, dtype=np.uint8, mode='r')
+    shape = self.block_shape
+    if not self.padded_blocks:
+      block_row = block_index // self._blocks_per_row
+      shape = (min(shape[0], self.shape[0] - block_row * shape[0]), shape[1])
+    offset = self.block_offsets[block_index]
+    num_bytes = shape[0] * shape[1] * self.dtype.itemsize
+    block = self._data[offset:offset + num_bytes].view(self.dtype).reshape(shape)
+    block = block.astype(np.float32)
+    if self.nodata is not None:
+      block[block == self.nodata] = np.nan
+    return block
+
+  def _pixels(self, rows, cols, cache):
+    values = np.empty(rows.shape, np.float32)
+    block_h, block_w = self.block_shape
+    block_ids = (rows // block_h) * self._blocks_per_row + cols // block_w
+    for block_id in np.unique(block_ids):
+      mask = block_ids == block_id
+      block = cache.get((self.path, int(block_id)), lambda: self._block(int(block_id)))
+      values[mask] = block[rows[mask] % block_h, cols[mask] % block_w]
+    return values
+
+  def sample(self, lats, lngs, cache):
+    """Bilinearly interpolates the raster, NaN outside of it or on nodata."""
+    out = np.full(lats.shape, np.nan)
+    row_f = (self.lat_first - lats) / self.lat_step
+    col_f = (lngs - self.lng_first) / self.lng_step
+    inside = ((row_f > -0.5) & (row_f < self.shape[0] - 0.5) &
+              (col_f > -0.5) & (col_f < self.shape[1] - 0.5))
+    if not inside.any():
+      return out
+    row_f = np.clip(row_f[inside], 0, self.shape[0] - 1)
+    col_f = np.clip(col_f[inside], 0, self.shape[1] - 1)
+    r0 = np.floor(row_f).astype(np.int64)
+    c0 = np.floor(col_f).astype(np.int64)
+    r1 = np.minimum(r0 + 1, self.shape[0] - 1)
+    c1 = np.minimum(c0 + 1, self.shape[1] - 1)
+    dr = row_f - r0
+    dc = col_f - c0
+    corners = [(r0, c0, (1 - dr) * (1 - dc)), (r0, c1, (1 - dr) * dc),
+               (r1, c0, dr * (1 - dc)), (r1, c1, dr * dc)]
+    total = np.zeros(r0.shape)
+    weight = np.zeros(r0.shape)
+    for rows, cols, w in corners:
+      values = self._pixels(rows, cols, cache)
+      valid = ~np.isnan(values)
+      total[valid] += w[valid] * values[valid]
+      weight[valid] += w[valid]
+    with np.errstate(invalid='ignore', divide='ignore'):
+      out[inside] = np.where(weight > 0, total / weight, np.nan)
+    return out
+
+
+def open_hgt(path):
+  """Opens a SRTM .hgt file, named after its south west corner (N61W150.hgt)."""
+  match = re.match(r'([NS])(\d+)([EW])(\d+)', os.path.basename(path).upper())
+  if not match:
+    raise ValueError(f'Cannot parse hgt tile position from name: {path}')
+  lat = int(match.group(2)) * (1 if match.group(1) == 'N' else -1)
+  lng = int(match.group(4)) * (1 if match.group(3) == 'E' else -1)
+  size = int(round(math.sqrt(os.path.getsize(path) / 2)))
+  if size * size * 2 != os.path.getsize(path):
+    raise ValueError(f'Unexpected hgt file size: {path}')
+  step = 1.0 / (size - 1)
+  offsets = [row * size * 2 for row in range(0, size, _HGT_BLOCK_ROWS)]
+  return Raster(path, '>i2', (size, size), (_HGT_BLOCK_ROWS, size), offsets,
+                lat + 1, lng, step, step, nodata=-32768)
+
+
+def _read_tiff_tags(f):
+  byte_order = f.read(2)
+  if byte_order not in (b'II', b'MM'):
+    raise ValueError('Not a TIFF file')
+  endian = '<' if byte_order == b'II' else '>'
+  magic, ifd_offset = struct.unpack(endian + 'HI', f.read(6))
+  if magic != 42:
+    raise ValueError('Only classic (non BigTIFF) GeoTIFFs are supported')
+  f.seek(ifd_offset)
+  num_entries, = struct.unpack(endian + 'H', f.read(2))
+  entries = [struct.unpack(endian + 'HHI4s', f.read(12)) for _ in range(num_entries)]
+  tags = {}
+  for tag, tag_type, count, value in entries:
+    if tag_type not in _TIFF_TYPES:
+      continue
+    fmt = _TIFF_TYPES[tag_type]
+    size = struct.calcsize(fmt) * count
+    if size > 4:
+      f.seek(struct.unpack(endian + 'I', value)[0])
+      value = f.read(size)
+    if tag_type == 2:
+      tags[tag] = value[:count].rstrip(b'\x00').decode('ascii')
+    else:
+      tags[tag] = struct.unpack(f'{endian}{count}{fmt}', value[:size])
+  return endian, tags
+
+
+def open_geotiff(path):
+  """Opens an uncompressed, single band GeoTIFF in geographic coordinates."""
+  with open(path, 'rb') as f:
+    endian, tags = _read_tiff_tags(f)
+  if tags.get(259, (1,))[0] != 1:
+    raise ValueError(f'Compressed GeoTIFFs are not supported: {path}')
+  if tags.get(277, (1,))[0] != 1:
+    raise ValueError(f'Only single band GeoTIFFs are supported: {path}')
+  sample_format = tags.get(339, (1,))[0]
+  bits = tags[258][0]
+  if (sample_format, bits) not in _TIFF_DTYPES:
+    raise ValueError(f'Unsupported GeoTIFF sample type: {path}')
+  dtype = endian + _TIFF_DTYPES[(sample_format, bits)]
+  width, height = tags[256][0], tags[257][0]
+  padded_blocks = 324 in tags
+  if padded_blocks:
+    block_shape = (tags[323][0], tags[322][0])
+    offsets = list(tags[324])
+  else:
+    block_shape = (min(tags.get(278, (height,))[0], height), width)
+    offsets = list(tags[273])
+
+  geo_keys = tags.get(34735, ())
+  geo_keys = {geo_keys[i]: geo_keys[i + 3] for i in range(4, len(geo_keys), 4)}
+  if geo_keys.get(1024, 2) != 2:
+    raise ValueError(f'Only GeoTIFFs in geographic coordinates are supported: {path}')
+  pixel_is_point = geo_keys.get(1025, 1) == 2
+  lng_step, lat_step = tags[33550][:2]
+  i, j, _, x, y, _ = tags[33922][:6]
+  offset = 0.0 if pixel_is_point else 0.5
+  lng_first = x + (offset - i) * lng_step
+  lat_first = y - (offset - j) * lat_step
+  nodata = float(tags[42113]) if 42113 in tags else None
+  return Raster(path, dtype, (height, width), block_shape, offsets,
+                lat_first, lng_first, lat_step, lng_step, nodata=nodata,
+                padded_blocks=padded_blocks)
+
+
+def open_raster(path):
+  if path.lower().endswith('.hgt'):
+    return open_hgt(path)
+  return open_geotiff(path)
+
+
+class DEM:
+  """Digital elevation model made of local .hgt and GeoTIFF files."""
+
+  def __init__(self, paths, max_cached_tiles=64):
+    self._rasters = []
+    for path in paths:
+      if os.path.isdir(path):
+        for filename in sorted(os.listdir(path)):
+          if filename.lower().endswith(('.hgt', '.tif', '.tiff')):
+            self._rasters.append(open_raster(os.path.join(path, filename)))
+      else:
+        self._rasters.append(open_raster(path))
+    self._bounds = np.array([r.bounds() for r in self._rasters]).reshape(-1, 4)
+    self._cache = _TileCache(max_cached_tiles)
+    print(f'Loaded DEM with {len(self._rasters)} rasters.')
+
+  def sample(self, lats, lngs):
+    """Returns elevations in meters, NaN where there is no coverage."""
+    lats = np.asarray(lats, dtype=np.float64)
+    lngs = np.asarray(lngs, dtype=np.float64)
+    elevations = np.full(lats.shape, np.nan)
+    if lats.size == 0:
+      return elevations
+    overlaps = ((self._bounds[:, 0] <= lats.max()) & (self._bounds[:, 2] >= lats.min()) &
+                (self._bounds[:, 1] <= lngs.max()) & (self._bounds[:, 3] >= lngs.min()))
+    for raster_index in np.flatnonzero(overlaps):
+      missing = np.isnan(elevations)
+      if not missing.any():
+        break
+      elevations[missing] = self._rasters[raster_index].sample(
+          lats[missing], lngs[missing], self._cache)
+    return elevations
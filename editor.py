@@ -0,0 +1,554 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import dataclasses
+import gzip
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+from absl import flags
+from flask import Flask, render_template, request, make_response, send_file, g
+
+import kml_parser
+import loader
+import metrics
+import route
+import route_diff
+import route_store
+import tiles
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+FLAGS = flags.FLAGS
+
+map_app = Flask(__name__)
+# templates/map.html is rewritten by reload_data().
+map_app.config['TEMPLATES_AUTO_RELOAD'] = True
+
+route_map = None
+profiler = None
+tile_cache = None
+# Rendered and precompressed index page, see index().
+index_page = None
+# Digest of the input files and route_map revision right after reload_data().
+loaded_state = None
+# route_diff signatures of the routes of -input_kml the map has, by route id.
+route_signatures = []
+# Publishes the routes to -route_store_dir for the read-only workers.
+store_writer = None
+store_publisher = None
+
+# Responses smaller than this aren't worth compressing.
+MIN_COMPRESS_BYTES = 512
+COMPRESSIBLE_MIMETYPES = ('text/html', 'text/plain', 'text/csv', 'text/kml', 'application/json')
+
+def compress(data, encoding, best=False):
+  if encoding == 'br':
+    return brotli.compress(data, quality=9 if best else 5)
+  return gzip.compress(data, compresslevel=9 if best else 6)
+
+def accepted_encoding():
+  """Best encoding supported by both sides, None for identity."""
+  encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+  return request.accept_encodings.best_match(encodings)
+
+def maybe_return_js_code(**extra):
+  ret_dict = {'status':'OK', **extra}
+  js_code = route_map.pop_js_commands()
+  if len(js_code) > 0:
+    ret_dict['js_code'] = js_code
+  metrics.observe('routemapper_js_payload_bytes', len(js_code), 'Size of the JS code sent to the client.',
+                  buckets=metrics.SIZE_BUCKETS, endpoint=request.path)
+  metrics.inc('routemapper_js_payload_bytes_total', len(js_code), 'Total JS code bytes sent to the client.',
+              endpoint=request.path)
+  output = make_response(json.dumps(ret_dict))
+  output.headers["Cache-Control"] = "no-store"
+  return output
+
+
+@map_app.before_request
+def start_request_timer():
+  g.request_start = time.perf_counter()
+  metrics.registry.start_request()
+
+@map_app.after_request
+def record_request_time(response):
+  seconds = time.perf_counter() - g.request_start
+  endpoint = request.url_rule.rule if request.url_rule else 'unknown'
+  metrics.observe('routemapper_request_seconds', seconds, 'Latency of the HTTP handlers.',
+                  endpoint=endpoint, method=request.method)
+  metrics.observe('routemapper_response_bytes', response.calculate_content_length() or 0,
+                  'Size of the HTTP responses.', buckets=metrics.SIZE_BUCKETS, endpoint=endpoint)
+  # Per request debug timings, shown by the browser developer tools.
+  span_totals = collections.OrderedDict()
+  for name, span_s in metrics.registry.request_spans():
+    total_s, count = span_totals.get(name, (0.0, 0))
+    span_totals[name] = (total_s + span_s, count + 1)
+  timings = [f'{name};dur={total_s*1000:.1f};desc="{count} calls"'
+             for name, (total_s, count) in span_totals.items()]
+  timings.append(f'total;dur={seconds*1000:.1f}')
+  response.headers['Server-Timing'] = ', '.join(timings)
+  return response
+
+# after_request hooks run in reverse order of registration, so responses are
+# compressed before their size is recorded.
+@map_app.after_request
+def compress_response(response):
+  if (response.direct_passthrough or response.status_code != 200 or
+      'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+    return response
+  response.vary.add('Accept-Encoding')
+  data = response.get_data()
+  encoding = accepted_encoding()
+  if encoding is None or len(data) < MIN_COMPRESS_BYTES:
+    return response
+  response.set_data(compress(data, encoding))
+  response.headers['Content-Encoding'] = encoding
+  return response
+
+@map_app.after_request
+def publish_routes(response):
+  # Writing a snapshot goes through every vertex, it is done in the
+  # background and coalesces the changes of several requests.
+  if store_publisher is not None and route_map is not None and not store_writer.is_current(route_map):
+    store_publisher.request(route_map)
+  return response
+
+@map_app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+  output = make_response(metrics.registry.render())
+  output.headers["Content-type"] = "text/plain; version=0.0.4"
+  return output
+
+@map_app.route('/profile', methods=['GET'])
+def profile():
+  """Sampling profiler: ?enable=1 starts it, ?enable=0 stops it, ?reset=1 clears it.
+
+  Returns the sampled stacks in collapsed format.
+  """
+  global profiler
+  if profiler is None:
+    profiler = metrics.SamplingProfiler(FLAGS.profile_interval_ms / 1000.0)
+  if request.args.get('reset') == '1':
+    profiler.reset()
+  if request.args.get('enable') == '1':
+    profiler.start()
+  elif request.args.get('enable') == '0':
+    profiler.stop()
+  output = make_response(profiler.collapsed())
+  output.headers["Content-type"] = "text/plain"
+  return output
+
+
+def input_digest():
+  """Hash of the input files, to notice when they change on disk."""
+  digest = hashlib.sha1()
+  for path in [FLAGS.input_kml, FLAGS.input_gpx]:
+    if path is not None and os.path.exists(path):
+      with open(path, 'rb') as f:
+        digest.update(f.read())
+  return digest.hexdigest()
+
+def build_index_page():
+  """Renders the index page and compresses it once for every encoding."""
+  html = render_template('index.html', git_controls=FLAGS.git_controls).encode('utf-8')
+  etag = hashlib.sha1(html).hexdigest()
+  bodies = {None: html, 'gzip': compress(html, 'gzip', best=True)}
+  if brotli is not None:
+    bodies['br'] = compress(html, 'br', best=True)
+  return {'bodies': bodies, 'etag': etag}
+
+@map_app.route('/tiles/<layer>/<int:z>/<int:x>/<int:y>', methods=['GET'])
+def tile(layer, z, x, y):
+  data = get_tile_cache().get(layer, z, x, y)
+  if data is None:
+    return make_response('', 404)
+  output = make_response(data)
+  output.headers["Content-type"] = tiles.content_type(data)
+  output.headers["Cache-Control"] = "max-age=86400"
+  return output
+
+def get_tile_cache():
+  global tile_cache
+  if tile_cache is None:
+    tile_cache = tiles.TileCache(FLAGS.tile_cache_dir, FLAGS.tile_cache_mb * 2**20, offline=FLAGS.tile_offline)
+  return tile_cache
+
+
+@map_app.route('/')
+def index():
+  global index_page
+  # Reloading discards the unsaved edits, as the routes are loaded again from
+  # the input files. It's skipped when the routes haven't changed since.
+  if route_map is None or loaded_state != (input_digest(), route_map.revision):
+    reload_data()
+  if index_page is None:
+    index_page = build_index_page()
+
+  encoding = accepted_encoding()
+  # Every encoding is a different representation with its own ETag.
+  etag = f"{index_page['etag']}-{encoding or 'identity'}"
+  if request.if_none_match.contains(etag):
+    output = make_response('', 304)
+  else:
+    output = make_response(index_page['bodies'][encoding])
+    if encoding is not None:
+      output.headers['Content-Encoding'] = encoding
+  output.set_etag(etag)
+  output.vary.add('Accept-Encoding')
+  # The browser may keep the page but has to revalidate it on every load.
+  output.headers['Cache-Control'] = 'no-cache'
+  return output
+
+@map_app.route('/label', methods=['POST'])
+def label():
+  route_map.set_activity_type(int(request.form['element']), request.form['params'])
+  return maybe_return_js_code()
+
+@map_app.route('/split', methods=['POST'])
+def split():
+  route_map.split_route(
+    int(request.form['element']),
+    route.LatLng(float(request.form['lat']), float(request.form['lng'])))
+  return maybe_return_js_code()
+
+@map_app.route('/edit', methods=['POST'])
+def edit():
+  route_map.edit_route(int(request.form['element']))
+  return maybe_return_js_code()
+
+@map_app.route('/endedit', methods=['POST'])
+def endedit():
+  route_map.end_edit_route(int(request.form['route_name']), json.loads(request.form['latlngs']))
+  return maybe_return_js_code()
+
+@map_app.route('/create_route', methods=['POST'])
+def create_route():
+  route_map.create_route()  
+  return maybe_return_js_code()
+
+@map_app.route('/end_create_route', methods=['POST'])
+def end_create_route():
+  route_map.end_create_route(json.loads(request.form['latlngs']))
+  return maybe_return_js_code()
+
+
+@map_app.route('/save', methods=['POST'])
+def save():
+  route_map.save(request.form['filename'], request.form['label_name'])
+  return maybe_return_js_code()
+
+@map_app.route('/download', methods=['POST'])
+def download():
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    path = os.path.join(tmp_dir, 'track.kml') 
+    route_map.save(path)
+    return send_file(path, as_attachment=True)
+
+@map_app.route('/info', methods=['POST'])
+def info():
+  route_map.info(
+    int(request.form['element']),
+    route.LatLng(float(request.form['lat']), float(request.form['lng'])))
+  return maybe_return_js_code()
+
+
+@map_app.route('/remove', methods=['POST'])
+def remove():
+  route_map.remove_route(int(request.form['element']))
+  
+  return maybe_return_js_code()
+
+@map_app.route('/add_label', methods=['POST'])
+def add_label():
+  route_map.add_label(int(request.form['element']), request.form['label_name'])  
+  return maybe_return_js_code()
+
+@map_app.route('/remove_label', methods=['POST'])
+def remove_label():
+  route_map.remove_label(int(request.form['element']), request.form['label_name'])  
+  return maybe_return_js_code()
+
+@map_app.route('/simplify', methods=['POST'])
+def simplify():
+  route_map.simplify(int(request.form['element']))  
+  return maybe_return_js_code()
+
+@map_app.route('/batch', methods=['POST'])
+def batch():
+  if 'operations' in request.form:
+    operations = json.loads(request.form['operations'])
+  else:
+    # A single operation applied to every route matching the label query.
+    operations = [{'op': request.form['op'], 'params': request.form.get('params', ''),
+                   'labels': request.form['label_name']}]
+  try:
+    route_map.apply_batch(operations)
+  except ValueError as e:
+    # Sends the JS of anything already changed, so the client stays in sync.
+    return maybe_return_js_code(status='ERROR', message=str(e))
+  return maybe_return_js_code()
+
+@map_app.route('/split_junctions', methods=['POST'])
+def split_junctions():
+  route_map.split_at_junctions(request.form.get('label_name', ''), FLAGS.junction_tolerance_m)
+  return maybe_return_js_code()
+
+@map_app.route('/search', methods=['GET', 'POST'])
+def search():
+  """Routes matching ?q=, or the search_query of the form, which also zooms
+  the map to them."""
+  query = request.values.get('q', request.values.get('search_query', ''))
+  try:
+    limit = int(request.values.get('limit', 50))
+  except ValueError:
+    return json.dumps({'status': 'ERROR', 'message': f'Invalid limit: {request.values["limit"]}'})
+  results = route_map.search(query, limit)
+  if request.method == 'POST':
+    route_map.zoom_to([result['route_id'] for result in results])
+  return maybe_return_js_code(results=results)
+
+@map_app.route('/suggest_activities', methods=['POST'])
+def suggest_activities():
+  """The client keeps the suggestions and sends them back to
+  /apply_activities, so clients don't apply each other's suggestions."""
+  suggestions = route_map.suggest_activities(request.form.get('label_name', ''))
+  return maybe_return_js_code(suggestions=[dataclasses.asdict(s) for s in suggestions])
+
+@map_app.route('/apply_activities', methods=['POST'])
+def apply_activities():
+  """Applies the suggestions of the form, a json list of /suggest_activities
+  suggestions, above min_confidence, and only the reviewed route_ids if
+  given, with a single client update."""
+  try:
+    suggestions = json.loads(request.form.get('suggestions') or '[]')
+    min_confidence = float(request.form.get('min_confidence') or 0.0)
+    route_ids = request.form.get('route_ids')
+    accepted = set(int(route_id) for route_id in route_ids.split(',') if route_id) if route_ids is not None else None
+    operations = [{'op': 'label', 'element': int(s['route_id']), 'params': s['activity_type']} for s in suggestions
+                  if float(s['confidence']) >= min_confidence and (accepted is None or int(s['route_id']) in accepted)]
+    route_map.apply_batch(operations)
+  except (KeyError, TypeError) as e:
+    return json.dumps({'status': 'ERROR', 'message': f'Malformed suggestions: {e!r}'})
+  except ValueError as e:
+    # A suggested route was removed since.
+    return json.dumps({'status': 'ERROR', 'message': str(e)})
+  return maybe_return_js_code(applied=len(operations))
+
+@map_app.route('/viewport', methods=['POST'])
+def viewport():
+  bounds = ((float(request.form['south']), float(request.form['west'])),
+            (float(request.form['north']), float(request.form['east'])))
+  loaded_ids = [int(route_id) for route_id in request.form.get('loaded', '').split(',') if route_id]
+  route_map.viewport(bounds, int(request.form['zoom']), loaded_ids)
+  return maybe_return_js_code()
+
+@map_app.route('/stats', methods=['POST'])
+def stats():
+  route_map.stats(request.form['label_name'])  
+  return maybe_return_js_code()
+
+@map_app.route('/enable_highlight', methods=['POST'])
+def enable_highlight():
+  route_map.enable_highlight(request.form['label_name'])  
+  return maybe_return_js_code()
+
+@map_app.route('/disable_highlight', methods=['POST'])
+def disable_highlight():
+  route_map.enable_highlight('')  
+  return maybe_return_js_code()
+
+@map_app.route('/wayback', methods=['POST'])
+def wayback():
+  route_map.wayback()  
+  return maybe_return_js_code()
+
+@map_app.route('/update_info', methods=['POST'])
+def update_info():
+  route_map.update_info(
+    int(request.form['route_name']),
+    request.form['name'],
+    request.form['description'],
+    request.form['labels'])
+  return maybe_return_js_code()
+
+
+def record_saved_signatures():
+  # The saved routes have the ids of the map.
+  global route_signatures
+  route_signatures = [route_diff.signature(r) for r in loader.parse_routes(FLAGS.input_kml)]
+  route_map.forget_splits()
+
+@map_app.route('/commit', methods=['POST'])
+def commit():
+  route_map.save(FLAGS.input_kml)
+  record_saved_signatures()
+  cmd = f"git reset; git add {FLAGS.input_kml}; git commit -m \"[track update] {request.form['message']}\""
+  os.system(cmd)
+  return maybe_return_js_code()
+
+@map_app.route('/force_commit', methods=['GET'])
+def force_commit():
+  print('saving')
+  route_map.save(FLAGS.input_kml)
+  record_saved_signatures()
+  cmd = f"git reset; git add {FLAGS.input_kml}; git commit -m \"[track update] forced commit.\""
+  os.system(cmd)
+  return maybe_return_js_code()
+
+@map_app.route('/all_stats', methods=['GET'])
+def all_stats():
+  csv_str = route.section_stats_csv(route_map.compute_stats)
+  output = make_response(csv_str)
+  output.headers["Content-Disposition"] = "attachment; filename=section_stats.csv"
+  output.headers["Content-type"] = "text/csv"
+  return output
+
+
+@map_app.route('/export_no_names', methods=['GET'])
+def export_no_names():
+  
+  labels_str=request.args.get('labels', '')
+  width=int(request.args.get('width', '-1'))
+  
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    fpath = os.path.join(tmp_dir, 'export_no_names.kml')
+    route_map.save(fpath, labels_str, no_names=True, max_width=width)
+    with open(fpath, 'r') as f:
+      contents = f.read()
+
+  output = make_response(contents)
+  output.headers["Content-Disposition"] = "attachment; filename=export_no_names.kml"
+  output.headers["Content-type"] = "text/kml"
+  return output
+
+
+@map_app.route('/export_gpkg', methods=['GET'])
+def export_gpkg():
+  labels_str=request.args.get('labels', '')
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    fpath = os.path.join(tmp_dir, 'export.gpkg')
+    route_map.save(fpath, labels_str)
+    with open(fpath, 'rb') as f:
+      contents = f.read()
+
+  output = make_response(contents)
+  output.headers["Content-Disposition"] = "attachment; filename=export.gpkg"
+  output.headers["Content-type"] = "application/geopackage+sqlite3"
+  return output
+
+
+@map_app.route('/push', methods=['POST'])
+def push():
+  cmd = f"git push"
+  os.system(cmd)
+  return maybe_return_js_code()
+
+def diff_input_kml(revision=None, apply=False):
+  """Diffs the routes of the map against -input_kml, or its git revision,
+  and optionally applies the changes to the map."""
+  global route_signatures
+  new_routes = route_diff.parse_revision(FLAGS.input_kml, revision)
+  diff = route_diff.diff_routes(route_signatures, new_routes)
+  print(f'diff: {diff.summary()}')
+  if apply:
+    route_diff.apply_diff(route_map, diff)
+    route_signatures = [route_diff.signature(r) for r in new_routes if r.id is not None]
+  return diff
+
+@map_app.route('/diff', methods=['POST'])
+def diff():
+  if not FLAGS.input_kml:
+    return json.dumps({'status': 'ERROR', 'message': 'No -input_kml.'})
+  try:
+    changes = diff_input_kml(request.form.get('revision') or None, request.form.get('apply') == 'true')
+  except subprocess.CalledProcessError as e:
+    return json.dumps({'status': 'ERROR', 'message': str(e)})
+  return maybe_return_js_code(
+      summary=changes.summary(), added=[r.name for r in changes.added],
+      removed=[s.name for s in changes.removed], modified=[r.name for _, r in changes.modified],
+      relabeled=[r.name for _, r in changes.relabeled])
+
+@map_app.route('/pull', methods=['POST'])
+def pull():
+  cmd = f"git pull"
+  os.system(cmd)
+  if FLAGS.input_kml:
+    # Only the routes changed by the pull are sent to the client.
+    diff_input_kml(apply=True)
+  return maybe_return_js_code()
+
+@map_app.route('/upload_route', methods=['POST'])
+def upload_route():
+  kml_file = request.files['uploaded_kml_route']
+  print(kml_file)
+
+  with tempfile.TemporaryDirectory() as tmpdirname:
+    kml_path = os.path.join(tmpdirname, 'import.kml')
+    kml_file.save(kml_path)
+    imported_routes = kml_parser.parse_kml(kml_path)
+
+  for r in imported_routes:
+    loader.import_route(route_map, r)
+    print(r.name)
+  return maybe_return_js_code()
+
+
+
+markers_visible = True
+@map_app.route('/toggle_marker_visibility', methods=['POST'])
+def toggle_marker_visibility():
+  global markers_visible
+  markers_visible = not markers_visible
+  visibility_str = "visible" if markers_visible else "hidden"
+  route_map._js_commands += f"""
+$("path[fill!=\\"none\\"]").attr('visibility', '{visibility_str}');
+"""
+  return maybe_return_js_code()
+
+@metrics.timed('reload_data')
+def reload_data():
+  print('reload_data')
+  global route_map, index_page, loaded_state, route_signatures, store_writer, store_publisher
+  index_page = None
+  digest = input_digest()
+  route_map = route.RouteMap(width=FLAGS.map_width, height=FLAGS.map_height, dem=loader.load_dem(),
+                             polyline_precision=FLAGS.polyline_precision,
+                             tile_proxy='/tiles' if FLAGS.tile_proxy else None,
+                             lazy_min_zoom=FLAGS.lazy_min_zoom if FLAGS.lazy_routes else None)
+  imported = loader.load_routes(route_map, input_kml=FLAGS.input_kml, input_gpx=FLAGS.input_gpx)
+  route_signatures = [route_diff.signature(r, route_id) for route_id, r in imported]
+  if FLAGS.route_store_dir:
+    store_writer = store_writer or route_store.Writer(FLAGS.route_store_dir)
+    store_publisher = store_publisher or route_store.Publisher(store_writer)
+    route_map.publish(store_writer)
+
+  with metrics.span('render_map'):
+    html = route_map.map()._repr_html_()
+  html = html.replace(';padding-bottom:60%', '', 1)
+  html = html.replace(';height:0', f';height:{FLAGS.map_height}px', 1)
+  print(html[:200])
+
+  with open('templates/map.html', 'w') as f:
+    f.write(html) 
+  loaded_state = (digest, route_map.revision)
+
+
+def serve():
+  if FLAGS.profile_at_start:
+    global profiler
+    profiler = metrics.SamplingProfiler(FLAGS.profile_interval_ms / 1000.0)
+    profiler.start()
+  reload_data()
+  if FLAGS.seed_tile_zooms:
+    get_tile_cache().seed(route_map.route_bounds(FLAGS.seed_tile_margin), [int(z) for z in FLAGS.seed_tile_zooms],
+                    FLAGS.seed_tile_layers or list(tiles.TILE_LAYERS))
+  map_app.run(debug=True, host="0.0.0.0", port=os.environ.get("PORT", 5000))
@@ -0,0 +1,205 @@
+"""Reads and writes routes as GeoPackage files, SQLite databases GIS tools
+open directly.
+
+Run:
+
+  python geopackage.py alaska.kml alaska.gpkg
+  python geopackage.py alaska.gpkg alaska.kml
+
+Every route is a row of the routes table, with its LineString geometry and
+route_id, name, description, labels (comma separated), activity_type, color,
+width and length_m columns. The table has an R*Tree index of the route bounds, so
+read_routes() only reads the rows in the given bounds. Rows are read and
+written one at a time, a file is never loaded whole.
+"""
+
+import os
+import sqlite3
+import struct
+import tempfile
+
+from absl import app
+import numpy as np
+
+import metrics
+import route
+
+TABLE = 'routes'
+GEOMETRY_COLUMN = 'geom'
+RTREE = f'rtree_{TABLE}_{GEOMETRY_COLUMN}'
+WGS84 = 4326
+# 'GPKG' and version 1.2.
+APPLICATION_ID = 0x47504B47
+USER_VERSION = 10200
+
+WKB_LINESTRING = 2
+WKB_MULTILINESTRING = 5
+# ISO WKB adds 1000 to the geometry type for Z coordinates.
+WKB_Z = 1000
+
+_SCHEMA = f"""
+CREATE TABLE gpkg_spatial_ref_sys (
+  srs_name TEXT NOT NULL, srs_id INTEGER NOT NULL PRIMARY KEY, organization TEXT NOT NULL,
+  organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, description TEXT);
+INSERT INTO gpkg_spatial_ref_sys VALUES
+  ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', NULL),
+  ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', NULL),
+  ('WGS 84 geodetic', {WGS84}, 'EPSG', {WGS84}, 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]]', NULL);
+CREATE TABLE gpkg_contents (
+  table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, identifier TEXT UNIQUE, description TEXT DEFAULT '',
+  last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+  min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER);
+CREATE TABLE gpkg_geometry_columns (
+  table_name TEXT NOT NULL, column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL, srs_id INTEGER NOT NULL,
+  z TINYINT NOT NULL, m TINYINT NOT NULL, PRIMARY KEY (table_name, column_name));
+CREATE TABLE gpkg_extensions (
+  table_name TEXT, column_name TEXT, extension_name TEXT NOT NULL, definition TEXT NOT NULL, scope TEXT NOT NULL);
+CREATE TABLE {TABLE} (
+  fid INTEGER PRIMARY KEY AUTOINCREMENT, {GEOMETRY_COLUMN} LINESTRING, route_id INTEGER, name TEXT,
+  description TEXT, labels TEXT, activity_type TEXT, color TEXT, width DOUBLE, length_m DOUBLE);
+CREATE VIRTUAL TABLE {RTREE} USING rtree(id, minx, maxx, miny, maxy);
+INSERT INTO gpkg_geometry_columns VALUES ('{TABLE}', '{GEOMETRY_COLUMN}', 'LINESTRING', {WGS84}, 2, 0);
+INSERT INTO gpkg_extensions VALUES
+  ('{TABLE}', '{GEOMETRY_COLUMN}', 'gpkg_rtree_index', 'http://www.geopackage.org/spec120/#extension_rtree', 'write-only');
+"""
+
+
+def _geometry(r):
+  """GeoPackage geometry blob of the route and its (min_x, max_x, min_y, max_y)."""
+  coords = np.array([[p.lng, p.lat, np.nan if p.elevation is None else p.elevation] for p in r.points],
+                    dtype=np.float64).reshape(-1, 3)
+  has_z = len(coords) > 0 and not np.isnan(coords[:, 2]).any()
+  if not has_z:
+    coords = coords[:, :2]
+  envelope = ((coords[:, 0].min(), coords[:, 0].max(), coords[:, 1].min(), coords[:, 1].max())
+              if len(coords) else (np.nan,) * 4)
+  # Little endian, with an xy envelope.
+  header = b'GP' + struct.pack('<BBi4d', 0, 0b0011, WGS84, *envelope)
+  wkb = struct.pack('<BII', 1, WKB_LINESTRING + (WKB_Z if has_z else 0), len(coords))
+  return header + wkb + coords.astype('<f8').tobytes(), envelope
+
+
+def _parse_linestrings(wkb, offset=0):
+  """(n, 3) lng, lat, elevation of the LineString or MultiLineString at offset
+  of the WKB, and the offset after it."""
+  byte_order = '<' if wkb[offset] == 1 else '>'
+  geometry_type, = struct.unpack_from(f'{byte_order}I', wkb, offset + 1)
+  # EWKB flags Z in the high bits instead.
+  has_z = geometry_type // WKB_Z == 1 or geometry_type & 0x80000000
+  geometry_type = (geometry_type & 0x0fffffff) % WKB_Z
+  count, = struct.unpack_from(f'{byte_order}I', wkb, offset + 5)
+  offset += 9
+  if geometry_type == WKB_MULTILINESTRING:
+    parts = []
+    for _ in range(count):
+      part, offset = _parse_linestrings(wkb, offset)
+      parts.append(part)
+    return np.concatenate(parts) if parts else np.zeros((0, 3)), offset
+  if geometry_type != WKB_LINESTRING:
+    raise ValueError(f'Unsupported geometry type: {geometry_type}')
+  dimensions = 3 if has_z else 2
+  coords = np.frombuffer(wkb, dtype=f'{byte_order}f8', count=count * dimensions, offset=offset)
+  coords = coords.reshape(count, dimensions)
+  offset += coords.nbytes
+  if not has_z:
+    coords = np.concatenate([coords, np.full((count, 1), np.nan)], axis=1)
+  return coords, offset
+
+
+def _parse_geometry(blob):
+  """Route points of a GeoPackage geometry blob."""
+  flags = blob[3]
+  # Sizes of the envelope types: none, xy, xyz, xym, xyzm.
+  envelope_size = (0, 32, 48, 48, 64)[(flags >> 1) & 0b111]
+  coords, _ = _parse_linestrings(blob, 8 + envelope_size)
+  return [route.LatLng(lat, lng, None if np.isnan(elevation) else elevation)
+          for lng, lat, elevation in coords.tolist()]
+
+
+@metrics.timed('write_gpkg')
+def write_routes(filename, routes, no_names=False, max_width=-1, lengths=None):
+  """Writes the routes, any iterable of route.Route, to a new GeoPackage.
+  lengths are the known lengths of the routes, in meters. Returns the number
+  of routes written."""
+  if os.path.exists(filename):
+    os.remove(filename)
+  connection = sqlite3.connect(filename)
+  try:
+    connection.execute(f'PRAGMA application_id = {APPLICATION_ID}')
+    connection.execute(f'PRAGMA user_version = {USER_VERSION}')
+    connection.executescript(_SCHEMA)
+    bounds = np.array([np.inf, -np.inf, np.inf, -np.inf])
+    num_routes = 0
+    with connection:
+      for i, r in enumerate(routes):
+        geometry, envelope = _geometry(r)
+        length_m = lengths[i] if lengths is not None else r.length()
+        width = min(r.line_style.width, max_width) if max_width > 0 else r.line_style.width
+        cursor = connection.execute(
+            f'INSERT INTO {TABLE} ({GEOMETRY_COLUMN}, route_id, name, description, labels, activity_type, color, '
+            'width, length_m) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (geometry, r.id, '' if no_names else r.name, r.description or '', ','.join(r.labels),
+             r.activity_type, r.line_style.color, width, length_m))
+        if r.points:
+          connection.execute(f'INSERT INTO {RTREE} VALUES (?, ?, ?, ?, ?)', (cursor.lastrowid, *envelope))
+          bounds = np.array([min(bounds[0], envelope[0]), max(bounds[1], envelope[1]),
+                             min(bounds[2], envelope[2]), max(bounds[3], envelope[3])])
+        num_routes += 1
+      min_x, max_x, min_y, max_y = bounds.tolist() if num_routes else (None,) * 4
+      connection.execute(
+          'INSERT INTO gpkg_contents (table_name, data_type, identifier, min_x, min_y, max_x, max_y, srs_id) '
+          'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (TABLE, 'features', TABLE, min_x, min_y, max_x, max_y, WGS84))
+  finally:
+    connection.close()
+  print(f'Saving gpkg file with {num_routes} tracks.')
+  return num_routes
+
+
+def read_routes(filename, bounds=None):
+  """Yields the route.Route rows of a GeoPackage, only the ones intersecting
+  ((south, west), (north, east)) bounds if given."""
+  connection = sqlite3.connect(f'file:{filename}?mode=ro', uri=True)
+  try:
+    columns = f'{TABLE}.{GEOMETRY_COLUMN}, route_id, name, description, labels, activity_type, color, width'
+    if bounds is None:
+      rows = connection.execute(f'SELECT {columns} FROM {TABLE} ORDER BY fid')
+    else:
+      (south, west), (north, east) = bounds
+      rows = connection.execute(
+          f'SELECT {columns} FROM {TABLE} JOIN {RTREE} ON {TABLE}.fid = {RTREE}.id '
+          f'WHERE {RTREE}.minx <= ? AND {RTREE}.maxx >= ? AND {RTREE}.miny <= ? AND {RTREE}.maxy >= ? '
+          f'ORDER BY {TABLE}.fid', (east, west, north, south))
+    for geometry, route_id, name, description, labels, activity_type, color, width in rows:
+      yield route.Route(
+          name=name or '', points=_parse_geometry(geometry) if geometry else [], description=description or '',
+          labels=[l for l in (labels or '').split(',') if l], activity_type=activity_type or '',
+          line_style=route.LineStyle(color or route.LineStyle.color, width or route.LineStyle.width), id=route_id)
+  finally:
+    connection.close()
+
+
+@metrics.timed('parse_gpkg')
+def parse_gpkg(filename, bounds=None):
+  return list(read_routes(filename, bounds))
+
+
+def parse_gpkg_string(data):
+  """Routes of a GeoPackage file contents, SQLite only opens files."""
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    filename = os.path.join(tmp_dir, 'routes.gpkg')
+    with open(filename, 'wb') as f:
+      f.write(data)
+    return parse_gpkg(filename)
+
+
+def main(argv):
+  if len(argv) != 3:
+    raise app.UsageError('Usage: geopackage.py input.{kml,gpkg} output.{kml,gpkg}')
+  import loader
+  route_map = route.RouteMap(headless=True)
+  for r in loader.normalize_routes(loader.parse_routes(argv[1])):
+    route_map.add_route(r, static=True, check_duplicates=False)
+  route_map.save(argv[2])
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,59 @@
+import os
+import sqlite3
+
+from absl.testing import absltest
+
+import geopackage
+import route
+
+
+def _routes():
+  return [
+      route.Route(name='Brady Glacier', points=[route.LatLng(58.5, -136.9, 10.0), route.LatLng(58.6, -136.8, 250.5)],
+                  labels=['s1a', 'primary'], description='Along the moraine', activity_type='offtrail',
+                  line_style=route.LineStyle('FF6200', 4.0), id=3),
+      route.Route(name='Ferry', points=[route.LatLng(57.0, -135.0), route.LatLng(57.1, -135.2),
+                                        route.LatLng(57.3, -135.1)], labels=[], activity_type='float', id=7),
+      route.Route(name='Empty', points=[], labels=[], id=8),
+  ]
+
+
+class GeoPackageTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.filename = os.path.join(absltest.get_default_test_tmpdir(), 'routes.gpkg')
+
+  def test_round_trips(self):
+    routes = _routes()
+    self.assertEqual(geopackage.write_routes(self.filename, routes), 3)
+    self.assertEqual(geopackage.parse_gpkg(self.filename), routes)
+
+  def test_is_a_geopackage(self):
+    geopackage.write_routes(self.filename, _routes())
+    connection = sqlite3.connect(self.filename)
+    self.assertEqual(connection.execute('PRAGMA application_id').fetchone()[0], geopackage.APPLICATION_ID)
+    min_x, min_y, max_x, max_y = connection.execute(
+        'SELECT min_x, min_y, max_x, max_y FROM gpkg_contents').fetchone()
+    connection.close()
+    self.assertEqual((min_x, min_y, max_x, max_y), (-136.9, 57.0, -135.0, 58.6))
+
+  def test_reads_the_routes_in_bounds(self):
+    geopackage.write_routes(self.filename, _routes())
+    routes = geopackage.parse_gpkg(self.filename, bounds=((58.0, -137.0), (59.0, -136.0)))
+    self.assertEqual([r.name for r in routes], ['Brady Glacier'])
+
+  def test_export_options(self):
+    geopackage.write_routes(self.filename, _routes(), no_names=True, max_width=3.0)
+    routes = geopackage.parse_gpkg(self.filename)
+    self.assertEqual([r.name for r in routes], ['', '', ''])
+    self.assertEqual([r.line_style.width for r in routes], [3.0, 2.0, 2.0])
+
+  def test_parses_file_contents(self):
+    geopackage.write_routes(self.filename, _routes())
+    with open(self.filename, 'rb') as f:
+      self.assertEqual(geopackage.parse_gpkg_string(f.read()), _routes())
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,221 @@
+"""Finds where routes cross or end next to each other.
+
+All the segments of all routes go into a uniform grid, and only the segments
+sharing a grid cell are tested against each other, so finding the junctions of
+tens of thousands of segments takes well under a second instead of a pairwise
+scan. Segments longer than a cell go into the grid as cell sized pieces.
+
+Positions along a polyline are fractional vertex indices: 3.25 is a quarter of
+the way from vertex 3 to vertex 4.
+"""
+
+import collections
+
+import numpy as np
+
+import route
+import simplify
+
+
+def _cross(a, b):
+  return a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]
+
+
+def _candidate_pairs(a, b, tolerance_m, cell_size_m):
+  """Pairs (i, j), i < j, of the segments from a to b whose bounding boxes,
+  grown by tolerance_m, share a grid cell."""
+  low = np.floor((np.minimum(a, b) - tolerance_m) / cell_size_m).astype(np.int64)
+  high = np.floor((np.maximum(a, b) + tolerance_m) / cell_size_m).astype(np.int64)
+  extent = high - low + 1
+  num_cells = extent[:, 0] * extent[:, 1]
+  # Every (segment, cell) entry.
+  segment = np.repeat(np.arange(len(a)), num_cells)
+  rank = np.arange(len(segment)) - np.repeat(np.cumsum(num_cells) - num_cells, num_cells)
+  cell = low[segment] + np.stack([rank // extent[segment, 1], rank % extent[segment, 1]], axis=1)
+  cell -= cell.min(axis=0)
+  key = cell[:, 0] * (cell[:, 1].max() + 1) + cell[:, 1]
+  order = np.argsort(key, kind='stable')
+  key, segment = key[order], segment[order]
+
+  # Every entry pairs with the entries after it in its cell.
+  first = np.concatenate([[0], (key[1:] != key[:-1]).nonzero()[0] + 1])
+  counts = np.diff(np.append(first, len(key)))
+  rank_in_cell = np.arange(len(key)) - np.repeat(first, counts)
+  num_partners = np.repeat(counts, counts) - 1 - rank_in_cell
+  i = np.repeat(np.arange(len(key)), num_partners)
+  j = i + 1 + np.arange(len(i)) - np.repeat(np.cumsum(num_partners) - num_partners, num_partners)
+  pairs = np.stack([np.minimum(segment[i], segment[j]), np.maximum(segment[i], segment[j])], axis=1)
+  # Segments sharing several cells are paired once.
+  return np.unique(pairs, axis=0) if len(pairs) else pairs
+
+
+def find_junctions(polylines, tolerance_m=5.0, min_angle_deg=15.0):
+  """Finds the junctions of a list of (n, 2) lat/lng arrays.
+
+  Polylines crossing at less than min_angle_deg are two tracks of the same
+  path rather than a junction, and aren't split.
+
+  Returns (cuts, snaps). cuts maps a polyline index to the sorted
+  (position, lat, lng) where it should be split. snaps maps (polyline index,
+  0 or -1) to the (lat, lng) an endpoint should move to, as it ends within
+  tolerance_m of another polyline.
+  """
+  lengths = np.array([len(p) for p in polylines], dtype=np.int64)
+  cuts = collections.defaultdict(list)
+  snaps = {}
+  if (lengths >= 2).sum() < 2:
+    return cuts, snaps
+  latlngs = np.concatenate([np.asarray(p, dtype=np.float64).reshape(-1, 2) for p in polylines])
+  lat0 = latlngs[:, 0].mean()
+  xy = simplify.local_xy(latlngs, lat0)
+  offsets = np.cumsum(lengths) - lengths
+
+  # Segment k goes from vertex start[k] to start[k] + 1.
+  num_segments = np.maximum(lengths - 1, 0)
+  segment_polyline = np.repeat(np.arange(len(polylines)), num_segments)
+  start = (np.arange(len(segment_polyline)) + offsets[segment_polyline] -
+           (np.cumsum(num_segments) - num_segments)[segment_polyline])
+  a, b = xy[start], xy[start + 1]
+  segment_lengths = np.hypot(*(b - a).T)
+  cell_size_m = max(4.0 * tolerance_m, float(np.median(segment_lengths)))
+  # Pieces are ordered by segment, so pairs of pieces stay i <= j.
+  piece_a, piece_b, piece_segment = simplify.split_segments(a, b, cell_size_m)
+  pairs = piece_segment[_candidate_pairs(piece_a, piece_b, tolerance_m, cell_size_m)]
+  pairs = np.unique(pairs, axis=0) if len(pairs) else pairs
+  pairs = pairs[segment_polyline[pairs[:, 0]] != segment_polyline[pairs[:, 1]]]
+  s1, s2 = pairs[:, 0], pairs[:, 1]
+
+  # Arc length of every vertex, to keep cuts away from the polyline ends.
+  cumulative = np.zeros(len(xy))
+  cumulative[start + 1] = segment_lengths
+  cumulative = np.cumsum(cumulative)
+  nonempty = lengths > 0
+  cumulative -= np.repeat(cumulative[offsets[nonempty]], lengths[nonempty])
+  total_length = np.repeat(cumulative[(offsets + lengths - 1)[nonempty]], lengths[nonempty])
+
+  def away_from_ends(segments, t):
+    arc = cumulative[start[segments]] + t * segment_lengths[segments]
+    return (arc > tolerance_m) & (arc < total_length[start[segments]] - tolerance_m)
+
+  def position(segments, t):
+    return start[segments] - offsets[segment_polyline[segments]] + t
+
+  found = []  # (polyline, position, x, y) of every cut.
+  # Crossings, unless they are next to an end of either polyline, which the
+  # endpoint snapping below handles.
+  r, s = b[s1] - a[s1], b[s2] - a[s2]
+  denominator = _cross(r, s)
+  valid = np.abs(denominator) > 1e-12
+  denominator = np.where(valid, denominator, 1.0)
+  t = _cross(a[s2] - a[s1], s) / denominator
+  u = _cross(a[s2] - a[s1], r) / denominator
+  sin_angle = np.abs(denominator) / np.maximum(segment_lengths[s1] * segment_lengths[s2], 1e-12)
+  crossing = valid & (sin_angle >= np.sin(np.radians(min_angle_deg)))
+  crossing &= (t >= 0.0) & (t <= 1.0) & (u >= 0.0) & (u <= 1.0)
+  # Polylines sharing a vertex, like overlapping tracks, don't cross there.
+  crossing &= ~((np.minimum(t, 1.0 - t) < 1e-9) & (np.minimum(u, 1.0 - u) < 1e-9))
+  crossing &= away_from_ends(s1, np.clip(t, 0.0, 1.0)) & away_from_ends(s2, np.clip(u, 0.0, 1.0))
+  points = a[s1[crossing]] + t[crossing, None] * r[crossing]
+  for segments, params in ((s1[crossing], t[crossing]), (s2[crossing], u[crossing])):
+    found.append((segment_polyline[segments], position(segments, params), points[:, 0], points[:, 1]))
+
+  # Polyline endpoints within tolerance of a segment of another polyline.
+  first_segment = np.r_[True, segment_polyline[1:] != segment_polyline[:-1]]
+  last_segment = np.r_[segment_polyline[1:] != segment_polyline[:-1], True]
+  touch_segment, touch_end, target = [], [], []
+  for ends, end in ((first_segment, 0), (last_segment, -1)):
+    for this, other in ((s1, s2), (s2, s1)):
+      selected = ends[this]
+      touch_segment.append(this[selected])
+      touch_end.append(np.full(selected.sum(), end))
+      target.append(other[selected])
+  touch_segment, touch_end, target = map(np.concatenate, (touch_segment, touch_end, target))
+  endpoint = np.where(touch_end == 0, start[touch_segment], start[touch_segment] + 1)
+  p = xy[endpoint]
+  ab = b[target] - a[target]
+  u = np.clip(np.einsum('ij,ij->i', p - a[target], ab) / np.maximum(np.einsum('ij,ij->i', ab, ab), 1e-12),
+              0.0, 1.0)
+  projection = a[target] + u[:, None] * ab
+  distance = np.hypot(*(projection - p).T)
+  near = distance <= tolerance_m
+  # The closest target of every endpoint.
+  order = np.lexsort((distance[near], endpoint[near]))
+  near_index = near.nonzero()[0][order]
+  if len(near_index):
+    near_index = near_index[np.r_[True, endpoint[near_index][1:] != endpoint[near_index][:-1]]]
+
+  snapped = []  # (polyline, end, polyline of the target, cut position or None, x, y)
+  for k in near_index.tolist():
+    polyline = int(segment_polyline[touch_segment[k]])
+    other_segment = int(target[k])
+    other = int(segment_polyline[other_segment])
+    if away_from_ends(np.array([other_segment]), u[k:k + 1])[0]:
+      snapped.append((polyline, int(touch_end[k]), other, float(position(np.array([other_segment]), u[k])[0]),
+                      projection[k, 0], projection[k, 1]))
+    elif polyline > other and distance[k] > 0.0:
+      # Next to an end of the other polyline, only one of the two ends moves.
+      other_end = 0 if cumulative[start[other_segment]] + u[k] * segment_lengths[other_segment] <= tolerance_m else -1
+      vertex = offsets[other] if other_end == 0 else offsets[other] + lengths[other] - 1
+      snapped.append((polyline, int(touch_end[k]), other, None, xy[vertex, 0], xy[vertex, 1]))
+
+  # Cuts closer than tolerance_m along a polyline are merged into the first.
+  polyline_cuts = collections.defaultdict(list)
+  for cut_polylines, positions, xs, ys in found:
+    for polyline, pos, x, y in zip(cut_polylines.tolist(), positions.tolist(), xs.tolist(), ys.tolist()):
+      polyline_cuts[polyline].append((pos, x, y))
+  for polyline, _, other, pos, x, y in snapped:
+    if pos is not None:
+      polyline_cuts[other].append((pos, x, y))
+  merged = {}
+  for polyline, polyline_cut_list in polyline_cuts.items():
+    kept = []
+    for pos, x, y in sorted(polyline_cut_list):
+      if kept and np.hypot(x - kept[-1][1], y - kept[-1][2]) <= tolerance_m:
+        merged[(polyline, pos)] = kept[-1]
+        continue
+      kept.append((pos, x, y))
+      merged[(polyline, pos)] = kept[-1]
+    latlng = simplify.latlng_from_xy(np.array([[x, y] for _, x, y in kept]), lat0)
+    cuts[polyline] = [(pos, lat, lng) for (pos, _, _), (lat, lng) in zip(kept, latlng.tolist())]
+  for polyline, end, other, pos, x, y in snapped:
+    if pos is not None:
+      _, x, y = merged[(other, pos)]
+    lat, lng = simplify.latlng_from_xy(np.array([[x, y]]), lat0)[0].tolist()
+    snaps[(polyline, end)] = (lat, lng)
+  return cuts, snaps
+
+
+def _interpolate(p, q, t):
+  if p.elevation is None or q.elevation is None:
+    return None
+  return p.elevation + t * (q.elevation - p.elevation)
+
+
+def cut_points(points, cuts, snaps=()):
+  """Splits a list of LatLng at the (position, lat, lng) cuts, after moving its
+  (end, (lat, lng)) snapped endpoints. Returns the list of pieces, each
+  piece ends at the vertex the next one starts at."""
+  points = list(points)
+  for end, (lat, lng) in snaps:
+    points[end] = route.LatLng(lat, lng, points[end].elevation)
+  pieces = []
+  current = []
+  next_vertex = 0
+  for pos, lat, lng in cuts:
+    index = int(pos)
+    t = pos - index
+    if t > 1.0 - 1e-9:
+      index, t = index + 1, 0.0
+    current.extend(points[next_vertex:index + 1])
+    if t < 1e-9:
+      # At a vertex, which ends this piece.
+      junction = current[-1]
+    else:
+      junction = route.LatLng(lat, lng, _interpolate(points[index], points[index + 1], t))
+      current.append(junction)
+    pieces.append(current)
+    current = [route.LatLng(junction.lat, junction.lng, junction.elevation)]
+    next_vertex = index + 1
+  current.extend(points[next_vertex:])
+  pieces.append(current)
+  return pieces
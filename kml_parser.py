@@ -2,6 +2,7 @@ from fastkml import kml
 from fastkml import styles
 import collections
 
+import metrics
 import route
 
 def _kml_color_to_rgb(kml_color):
@@ -10,10 +11,36 @@ def _kml_color_to_rgb(kml_color):
   color = kml_color[2:] if len(kml_color) == 8 else kml_color
   return f'{color[-2:]}{color[2:4]}{color[:2]}'
 
+def _coord_to_latlng(c):
+  return route.LatLng(c[1], c[0], c[2] if len(c) > 2 else None)
+
+def _route_id(node):
+  # Written by RouteMap.save.
+  if node.extended_data is None:
+    return None
+  for data in node.extended_data.elements:
+    if getattr(data, 'name', None) == 'route_id':
+      try:
+        return int(data.value)
+      except (TypeError, ValueError):
+        return None
+  return None
+
+def _drop_zero_elevations(latlngs):
+  # Some tools write a 0 altitude for every vertex instead of omitting it.
+  if all(p.elevation == 0.0 for p in latlngs):
+    for p in latlngs:
+      p.elevation = None
+  return latlngs
+
 
 def parse_kml(kml_file):
   with open(kml_file, 'rb') as f:
       doc=f.read()
+  return parse_kml_string(doc)
+
+@metrics.timed('parse_kml')
+def parse_kml_string(doc):
   k = kml.KML()
   k.from_string(doc)
 
@@ -41,18 +68,20 @@ def parse_kml(kml_file):
         for st  in style.styles():
           if type(st) is styles.LineStyle:
             line_style = route.LineStyle(_kml_color_to_rgb(st.color), max(st.width, 2.0))
-        latlngs = [route.LatLng(c[1], c[0]) for c in node.geometry.coords]
-        routes.append(route.Route(name=node.name, points=latlngs, description=node.description, line_style=line_style))
+        latlngs = _drop_zero_elevations([_coord_to_latlng(c) for c in node.geometry.coords])
+        routes.append(route.Route(name=node.name, points=latlngs, description=node.description, line_style=line_style,
+                                  id=_route_id(node)))
         
       elif node.geometry.geom_type == 'MultiLineString':
         # These are exported by GAIA gps.
-        latlngs = sum([[route.LatLng(c[1], c[0]) for c in g.coords] for g in node.geometry.geoms], [])
+        latlngs = _drop_zero_elevations([_coord_to_latlng(c) for g in node.geometry.geoms for c in g.coords])
         first_style = next(node.styles())
         line_style = route.LineStyle()
         for st  in first_style.styles():
           if type(st) is styles.LineStyle:
             line_style = route.LineStyle(_kml_color_to_rgb(st.color), max(st.width, 2.0))
-        routes.append(route.Route(name=node.name, points=latlngs, description=node.description, line_style=line_style))
+        routes.append(route.Route(name=node.name, points=latlngs, description=node.description, line_style=line_style,
+                                  id=_route_id(node)))
       elif node.geometry.geom_type == 'Point':
         # ignore
         pass
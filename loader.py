@@ -0,0 +1,143 @@
+import gpxpy
+from absl import flags
+
+import cleanup
+import dem
+import kml_parser
+import metrics
+import route
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('input_gpx', None, 'Input gpx filename.')
+flags.DEFINE_string('input_kml', None, 'Input kml or GeoPackage (.gpkg) filename.')
+flags.DEFINE_string('map_height', "600", 'Map height in pixels or percentage string.')
+flags.DEFINE_string('map_width', "100%", 'Map width in pixels or percentage string.')
+flags.DEFINE_list('dem', [], 'DEM files (SRTM .hgt or GeoTIFF) or directories containing them, '
+                  'used to add elevation to the routes.')
+flags.DEFINE_integer('dem_cache_tiles', 64, 'Number of decoded DEM tiles kept in memory.')
+flags.DEFINE_integer('polyline_precision', 6, 'Decimals of the encoded polylines sent to the browser, '
+                     '0 sends full precision JSON coordinates.')
+flags.DEFINE_boolean('clean_tracks', False, 'Whether to clean the imported routes never saved by the editor, '
+                     'raw GPS logs, before simplifying them.')
+flags.DEFINE_float('clean_spike_m', 200.0, 'Vertices farther than this from both neighbors, which are close '
+                   'to each other, are dropped as GPS spikes. 0 disables it.')
+flags.DEFINE_float('clean_stationary_m', 5.0, 'Runs of vertices staying within this radius of their first '
+                   'vertex are collapsed to one. 0 disables it.')
+flags.DEFINE_float('clean_resample_m', 0.0, 'Spacing the cleaned tracks are resampled to. 0 disables it.')
+flags.DEFINE_enum('simplify_method', 'douglas_peucker', ['douglas_peucker', 'visvalingam_whyatt'],
+                  'Simplification of the imported routes.')
+
+elevation_model = None
+
+def load_dem():
+  global elevation_model
+  if FLAGS.dem and elevation_model is None:
+    elevation_model = dem.DEM(FLAGS.dem, max_cached_tiles=FLAGS.dem_cache_tiles)
+  return elevation_model
+
+def load_gpx(gpx_file):
+  with open(gpx_file) as f:
+    return gpxpy.parse(f)
+
+def parse_routes(input_file):
+  """Routes of a kml or GeoPackage (.gpkg) file."""
+  if input_file.endswith('.gpkg'):
+    import geopackage
+    return geopackage.parse_gpkg(input_file)
+  return kml_parser.parse_kml(input_file)
+
+def cleanup_config():
+  return cleanup.CleanupConfig(
+      spike_distance_m=FLAGS.clean_spike_m or None,
+      stationary_radius_m=FLAGS.clean_stationary_m or None,
+      resample_spacing_m=FLAGS.clean_resample_m or None)
+
+def clean_raw_routes(routes):
+  """Cleans the routes without a route id with -clean_tracks. The editor saves
+  every route with its id, so saved routes aren't cleaned again."""
+  raw = [i for i, r in enumerate(routes) if r.id is None]
+  if not FLAGS.clean_tracks or not raw:
+    return routes
+  cleaned, removed = cleanup.clean_routes([routes[i] for i in raw], cleanup_config())
+  num_vertices = sum(len(routes[i].points) for i in raw)
+  print(f'Cleaned {len(raw)} routes with {num_vertices} vertices, removed: ' +
+        ', '.join(f'{removed[step]} {step}' for step in cleanup.STEPS if step in removed))
+  routes = list(routes)
+  for i, r in zip(raw, cleaned):
+    routes[i] = r
+  return routes
+
+def normalize_route(r):
+  """Returns a simplified copy of an imported route with its labels and
+  activity type parsed from its name and color."""
+  return normalize_routes([r])[0]
+
+def normalize_routes(routes):
+  """normalize_route of every route, simplified together."""
+  routes = clean_raw_routes(routes)
+  return [_parse_name_and_color(r) for r in route.simplify_routes(routes, 1.0, method=FLAGS.simplify_method)]
+
+def _parse_name_and_color(r):
+  r.line_style.width = max(r.line_style.width, 5.0)
+  for activity_type, color in route.activity_color.items():
+    if color == r.line_style.color:
+      r.activity_type = activity_type
+  # GeoPackage routes have their labels in a column, kml routes in the name.
+  r.labels = list(r.labels)
+  for name_token in r.name.split():
+    if len(name_token) >= 2 and name_token[0] == '#':
+      label = name_token[1:]
+      if label not in r.labels:
+        r.labels.append(label)
+  if r.labels:
+    name = r.name
+    for l in r.labels:
+      name = name.replace(f' #{l}', '')
+    r.name = name
+  while True:
+    if len(r.name) >= 2 and r.name[-1] == r.name[-2]:
+      r.name = r.name[:-1]
+    else:
+      break
+  return r
+
+def import_route(route_map, r, static=False, markers=True):
+  """Adds a normalized copy of r to the map, returns its id or None if it's a duplicate."""
+  return route_map.add_route(normalize_route(r), static=static, markers=markers)
+
+def load_routes(route_map, input_kml=None, input_gpx=None, markers=True):
+  """Adds the routes of the input gpx or kml file to the map and fits it to them.
+
+  Returns the (route_id, route) of the imported kml routes, as parsed.
+  """
+  imported = []
+  if input_gpx:
+    gpx = load_gpx(input_gpx)
+    for r in gpx.routes:
+      route_map.add_route(route.Route(
+          name=r.name,
+          points=[route.LatLng(p.latitude, p.longitude) for p in r.points]), static=True)
+      break
+    for t in gpx.tracks:
+      break
+      for i, s in enumerate(t.segments):
+        name = t.name
+        if len(t.segments) > 1:
+          name += f'_{i}'
+        route_map.add_route(route.Route(
+            name=name,
+            points=[route.LatLng(p.latitude, p.longitude) for p in s.points]), static=True)
+        break
+      break
+    route_map.fit_bounds()
+  elif input_kml:
+    routes = parse_routes(input_kml)
+    with metrics.span('import_routes'):
+      for r, normalized in zip(routes, normalize_routes(routes)):
+        route_id = route_map.add_route(normalized, static=True, markers=markers)
+        if route_id is not None:
+          imported.append((route_id, r))
+
+    route_map.fit_bounds()
+  return imported
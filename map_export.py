@@ -0,0 +1,150 @@
+import collections
+import copy
+import dataclasses
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import types
+
+from absl import flags
+import numpy as np
+
+import loader
+import metrics
+import route
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('output_map_html', None, 'Output html file containing map iframe html.')
+flags.DEFINE_list('input_kmls', [], 'Input kml filenames to render, each one is written to '
+                  '-output_dir.')
+flags.DEFINE_list('export_labels', [], 'Label filters to render from -input_kml, one map per '
+                  'filter written to -output_dir. Use + to require several labels, e.g. s1a+primary.')
+flags.DEFINE_string('output_dir', '.', 'Output directory of the maps rendered from -input_kmls '
+                    'or -export_labels.')
+flags.DEFINE_integer('export_processes', None, 'Number of worker processes rendering maps, '
+                     'defaults to the number of CPUs.')
+
+
+def _write_map_html(route_map, output_map_html, height):
+  with metrics.span('render_map'):
+    html = route_map.map()._repr_html_()
+  html = html.replace(';padding-bottom:60%', '', 1)
+  html = html.replace(';height:0', f';height:{height}px', 1)
+  html = html.replace('data-html=', 'data-html="')
+  html = html.replace(' onload=', '" onload=')
+
+  with open(output_map_html, 'w') as f:
+    f.write(html)
+
+
+def generate_map(output_map_html, input_kml=None, input_gpx=None, markers=True, width=None, height=None,
+                 polyline_precision=None):
+  width = width or FLAGS.map_width
+  height = height or FLAGS.map_height
+  if polyline_precision is None:
+    polyline_precision = FLAGS.polyline_precision
+  route_map = route.RouteMap(width=width, height=height, edit_pane=False, polyline_precision=polyline_precision)
+  loader.load_routes(route_map, input_kml=input_kml, input_gpx=input_gpx, markers=markers)
+  _write_map_html(route_map, output_map_html, height)
+
+
+def _generate_map_task(args):
+  generate_map(*args)
+  return args[0]
+
+
+def _num_processes(num_tasks):
+  return max(1, min(num_tasks, FLAGS.export_processes or os.cpu_count()))
+
+
+def generate_maps(input_kmls, output_dir, markers=True):
+  """Renders many kml files with a pool of worker processes.
+
+  Each input.kml is written to output_dir/input.html. Every worker renders
+  several maps reusing its folium and jinja setup.
+  """
+  os.makedirs(output_dir, exist_ok=True)
+  tasks = []
+  for input_kml in input_kmls:
+    name = os.path.splitext(os.path.basename(input_kml))[0]
+    tasks.append((os.path.join(output_dir, f'{name}.html'), input_kml, None, markers,
+                  FLAGS.map_width, FLAGS.map_height, FLAGS.polyline_precision))
+  with multiprocessing.Pool(_num_processes(len(tasks))) as pool:
+    for output_map_html in pool.imap_unordered(_generate_map_task, tasks):
+      print(f'Wrote {output_map_html}')
+
+
+# Routes shared with the export workers, set by _init_export_worker.
+_shared_routes = None
+
+
+def _pack_routes(routes):
+  """Packs the vertices of all routes in one (num_vertices, 3) lat/lng/elevation array."""
+  points = np.array([[p.lat, p.lng, np.nan if p.elevation is None else p.elevation]
+                     for r in routes for p in r.points], dtype=np.float64).reshape(-1, 3)
+  offsets = np.cumsum([0] + [len(r.points) for r in routes])
+  metadata = [dataclasses.replace(r, points=[]) for r in routes]
+  return points, offsets, metadata
+
+
+def _init_export_worker(shm_name, shape, offsets, metadata, width, height, polyline_precision, markers):
+  global _shared_routes
+  shm = shared_memory.SharedMemory(name=shm_name)
+  points = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+  _shared_routes = types.SimpleNamespace(shm=shm, points=points, offsets=offsets, metadata=metadata,
+                                         width=width, height=height, polyline_precision=polyline_precision,
+                                         markers=markers)
+
+
+def _export_labels_task(args):
+  labels, output_map_html = args
+  shared = _shared_routes
+  route_map = route.RouteMap(width=shared.width, height=shared.height, edit_pane=False,
+                             polyline_precision=shared.polyline_precision)
+  for i, r in enumerate(shared.metadata):
+    if not all(label in r.labels for label in labels):
+      continue
+    r = copy.deepcopy(r)
+    r.points = [route.LatLng(lat, lng, None if np.isnan(elevation) else elevation)
+                for lat, lng, elevation in shared.points[shared.offsets[i]:shared.offsets[i + 1]].tolist()]
+    # Duplicates were already removed when packing.
+    route_map.add_route(r, static=True, markers=shared.markers, check_duplicates=False)
+  route_map.fit_bounds()
+  _write_map_html(route_map, output_map_html, shared.height)
+  return output_map_html
+
+
+def export_label_maps(input_kml, label_filters, output_dir, markers=True):
+  """Renders one map per label filter of the routes of input_kml.
+
+  The kml file is parsed, simplified and deduplicated once. The route vertices
+  are shared with the worker processes through shared memory, and each worker
+  writes the maps of its filters to output_dir/<filter>.html.
+  """
+  routes = []
+  routes_by_key = collections.defaultdict(list)
+  for r in loader.normalize_routes(loader.parse_routes(input_kml)):
+    key = (r.name, len(r.points))
+    if any(route.is_duplicate(other, r) for other in routes_by_key[key]):
+      print(f"Found duplicate route: {r.name} with {len(r.points)} points, ignoring.")
+      continue
+    routes_by_key[key].append(r)
+    routes.append(r)
+  points, offsets, metadata = _pack_routes(routes)
+
+  os.makedirs(output_dir, exist_ok=True)
+  tasks = [([label for label in label_filter.split('+') if label],
+            os.path.join(output_dir, f'{label_filter.replace("+", "_")}.html'))
+           for label_filter in label_filters]
+  shm = shared_memory.SharedMemory(create=True, size=max(points.nbytes, 1))
+  try:
+    np.ndarray(points.shape, dtype=np.float64, buffer=shm.buf)[:] = points
+    initargs = (shm.name, points.shape, offsets, metadata, FLAGS.map_width, FLAGS.map_height,
+                FLAGS.polyline_precision, markers)
+    with multiprocessing.Pool(_num_processes(len(tasks)), _init_export_worker, initargs) as pool:
+      for output_map_html in pool.imap_unordered(_export_labels_task, tasks):
+        print(f'Wrote {output_map_html}')
+  finally:
+    shm.close()
+    shm.unlink()
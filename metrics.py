@@ -0,0 +1,171 @@
+import collections
+import contextlib
+import functools
+import sys
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in seconds and in bytes.
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+class Histogram:
+
+  def __init__(self, buckets):
+    self.buckets = buckets
+    self.counts = [0] * len(buckets)
+    self.count = 0
+    self.sum = 0.0
+
+  def observe(self, value):
+    for i, bound in enumerate(self.buckets):
+      if value <= bound:
+        self.counts[i] += 1
+    self.count += 1
+    self.sum += value
+
+
+def _labels_str(labels, extra=()):
+  items = list(labels) + list(extra)
+  if not items:
+    return ''
+  escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in items)
+  return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + '}'
+
+
+class Registry:
+  """Counters and histograms rendered in the Prometheus text format."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._help = {}
+    self._histograms = collections.defaultdict(dict)
+    self._counters = collections.defaultdict(dict)
+    self._local = threading.local()
+
+  def observe(self, name, value, help_str='', buckets=TIME_BUCKETS, **labels):
+    key = tuple(sorted(labels.items()))
+    with self._lock:
+      self._help.setdefault(name, help_str)
+      histogram = self._histograms[name].get(key)
+      if histogram is None:
+        histogram = self._histograms[name][key] = Histogram(buckets)
+      histogram.observe(value)
+
+  def inc(self, name, value=1, help_str='', **labels):
+    key = tuple(sorted(labels.items()))
+    with self._lock:
+      self._help.setdefault(name, help_str)
+      self._counters[name][key] = self._counters[name].get(key, 0) + value
+
+  def start_request(self):
+    """Starts collecting the spans of the current thread for a debug header."""
+    self._local.spans = []
+
+  def request_spans(self):
+    spans = getattr(self._local, 'spans', None)
+    self._local.spans = None
+    return spans or []
+
+  @contextlib.contextmanager
+  def span(self, name):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      seconds = time.perf_counter() - start
+      self.observe('routemapper_span_seconds', seconds, 'Time spent in instrumented stages.', span=name)
+      spans = getattr(self._local, 'spans', None)
+      if spans is not None:
+        spans.append((name, seconds))
+
+  def render(self):
+    lines = []
+    with self._lock:
+      for name, counters in sorted(self._counters.items()):
+        lines.append(f'# HELP {name} {self._help[name]}')
+        lines.append(f'# TYPE {name} counter')
+        for labels, value in sorted(counters.items()):
+          lines.append(f'{name}{_labels_str(labels)} {value}')
+      for name, histograms in sorted(self._histograms.items()):
+        lines.append(f'# HELP {name} {self._help[name]}')
+        lines.append(f'# TYPE {name} histogram')
+        for labels, histogram in sorted(histograms.items()):
+          for bound, count in zip(histogram.buckets, histogram.counts):
+            lines.append(f'{name}_bucket{_labels_str(labels, [("le", bound)])} {count}')
+          lines.append(f'{name}_bucket{_labels_str(labels, [("le", "+Inf")])} {histogram.count}')
+          lines.append(f'{name}_sum{_labels_str(labels)} {histogram.sum}')
+          lines.append(f'{name}_count{_labels_str(labels)} {histogram.count}')
+    return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+observe = registry.observe
+inc = registry.inc
+span = registry.span
+
+
+def timed(name):
+  """Decorator recording the duration of every call as a span."""
+  def decorator(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      with span(name):
+        return fn(*args, **kwargs)
+    return wrapper
+  return decorator
+
+
+class SamplingProfiler:
+  """Periodically samples the stacks of all threads.
+
+  Stacks are aggregated in the collapsed format used by flamegraph.pl and
+  speedscope: one 'outer;...;inner count' line per distinct stack.
+  """
+
+  def __init__(self, interval_s=0.005):
+    self._interval_s = interval_s
+    self._counts = collections.Counter()
+    self._counts_lock = threading.Lock()
+    self._thread = None
+    self._stop = threading.Event()
+
+  def running(self):
+    return self._thread is not None
+
+  def start(self):
+    if self._thread is not None:
+      return
+    self._stop.clear()
+    self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    if self._thread is None:
+      return
+    self._stop.set()
+    self._thread.join()
+    self._thread = None
+
+  def _run(self):
+    own_id = threading.get_ident()
+    while not self._stop.wait(self._interval_s):
+      for thread_id, frame in sys._current_frames().items():
+        if thread_id == own_id:
+          continue
+        stack = []
+        while frame is not None:
+          code = frame.f_code
+          stack.append(f'{code.co_filename.rsplit("/", 1)[-1]}:{code.co_name}')
+          frame = frame.f_back
+        with self._counts_lock:
+          self._counts[';'.join(reversed(stack))] += 1
+
+  def collapsed(self):
+    with self._counts_lock:
+      return ''.join(f'{stack} {count}\n' for stack, count in self._counts.most_common())
+
+  def reset(self):
+    with self._counts_lock:
+      self._counts.clear()
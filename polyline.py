@@ -0,0 +1,62 @@
+import numpy as np
+
+# Decodes polylines written by encode() in the browser. It uses arithmetic
+# instead of bitwise operators, which are limited to 32 bits in JS, so that
+# precisions above 5 don't overflow.
+DECODER_JS = """
+function decodePolyline(encoded, precision) {
+  var factor = Math.pow(10, precision);
+  var latlngs = [];
+  var coords = [0, 0];
+  var index = 0;
+  var i = 0;
+  while (i < encoded.length) {
+    var value = 0;
+    var scale = 1;
+    var b;
+    do {
+      b = encoded.charCodeAt(i++) - 63;
+      value += (b % 32) * scale;
+      scale *= 32;
+    } while (b >= 32);
+    coords[index] += (value % 2) ? -(value + 1) / 2 : value / 2;
+    if (index == 1) {
+      latlngs.push([coords[0] / factor, coords[1] / factor]);
+    }
+    index = 1 - index;
+  }
+  return latlngs;
+}
+"""
+
+
+def encode(latlngs, precision=5):
+  """Encodes [[lat, lng], ...] with the Google encoded polyline algorithm.
+
+  Coordinates are rounded to precision decimals: 5 is about 1m, 6 about 10cm.
+  """
+  values = np.round(np.asarray(latlngs, dtype=np.float64).reshape(-1, 2) * 10**precision).astype(np.int64)
+  deltas = np.diff(values, axis=0, prepend=np.zeros((1, 2), np.int64)).ravel()
+  zigzag = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+  chars = []
+  for value in zigzag.tolist():
+    while value >= 0x20:
+      chars.append(chr((0x20 | (value & 0x1f)) + 63))
+      value >>= 5
+    chars.append(chr(value + 63))
+  return ''.join(chars)
+
+
+def decode(encoded, precision=5):
+  """Inverse of encode(), returns [[lat, lng], ...]."""
+  values = []
+  value = shift = 0
+  for c in encoded:
+    b = ord(c) - 63
+    value |= (b & 0x1f) << shift
+    shift += 5
+    if b < 0x20:
+      values.append(~(value >> 1) if value & 1 else value >> 1)
+      value = shift = 0
+  latlngs = np.cumsum(np.array(values, dtype=np.int64).reshape(-1, 2), axis=0) / 10**precision
+  return latlngs.tolist()
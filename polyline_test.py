@@ -0,0 +1,28 @@
+from absl.testing import absltest
+import numpy as np
+
+import polyline
+
+
+class PolylineTest(absltest.TestCase):
+
+  def test_encodes_the_reference_example(self):
+    # The example of the Google encoded polyline algorithm documentation.
+    latlngs = [[38.5, -120.2], [40.7, -120.95], [43.252, -126.453]]
+    self.assertEqual(polyline.encode(latlngs), '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+    np.testing.assert_allclose(polyline.decode('_p~iF~ps|U_ulLnnqC_mqNvxq`@'), latlngs)
+
+  def test_round_trips(self):
+    rng = np.random.default_rng(0)
+    latlngs = np.stack([rng.uniform(-90.0, 90.0, 500), rng.uniform(-180.0, 180.0, 500)], axis=1)
+    for precision in (5, 6, 7):
+      decoded = polyline.decode(polyline.encode(latlngs, precision), precision)
+      np.testing.assert_allclose(decoded, np.round(latlngs, precision), atol=0.5 * 10**-precision)
+
+  def test_empty(self):
+    self.assertEqual(polyline.encode([]), '')
+    self.assertEqual(polyline.decode(''), [])
+
+
+if __name__ == '__main__':
+  absltest.main()
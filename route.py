@@ -1,23 +1,30 @@
 
-from typing import Sequence, Text
+from typing import Optional, Sequence, Text
+import collections
+import contextlib
 import dataclasses
-import folium
-import utils
+import functools
+import json
+import threading
 import types
 import numpy as np
-import folium.plugins
-import my_draw
-import os
-import simplekml
 import copy
 import gpxpy
 import html
+import metrics
+import route_table
+import search
+import simplify
+import tiles
+
+# folium, my_draw, utils (branca) and simplekml are slow to import and only
+# needed to render or save maps, so they are imported where they are used.
 
 @dataclasses.dataclass
 class LatLng:
   lat: float = 0.0
   lng: float = 0.0
-  # elevation: float = 0.0
+  elevation: Optional[float] = None
 
 @dataclasses.dataclass
 class LineStyle:
@@ -32,6 +39,8 @@ class Route:
   description: Text = ''
   line_style: LineStyle = LineStyle()
   activity_type: Text = ""
+  # Stable id assigned by RouteMap, saved with the route.
+  id: Optional[int] = None
   
   def points_as_list(self):
     return [[p.lat, p.lng] for p in self.points]
@@ -52,36 +61,114 @@ class Route:
         best = (distance, closest_point, idx)
     closest_point = best[1]
     idx = best[2]
+    # Elevation interpolated along the split segment.
+    a, b = self.points[idx], self.points[idx + 1]
+    elevation = None
+    if a.elevation is not None and b.elevation is not None:
+      t = np.linalg.norm(closest_point - points[idx]) / max(np.linalg.norm(points[idx + 1] - points[idx]), 1e-12)
+      elevation = a.elevation + t * (b.elevation - a.elevation)
     r1 = copy.deepcopy(self)
-    r1.points = self.points[:idx+1] + [LatLng(*closest_point.tolist())]
+    r1.points = self.points[:idx+1] + [LatLng(*closest_point.tolist(), elevation)]
     r2 = copy.deepcopy(self)
-    r2.points = [LatLng(*closest_point.tolist())] + self.points[idx+1:]
+    r2.points = [LatLng(*closest_point.tolist(), elevation)] + self.points[idx+1:]
     
     return r1, r2
   
   def length(self):
     locs = [gpxpy.geo.Location(p.lat, p.lng) for p in self.points]
     return gpxpy.geo.length_2d(locs)
+
+  def elevations(self):
+    return np.array([np.nan if p.elevation is None else p.elevation for p in self.points])
+
+  def sample_elevations(self, dem):
+    """Fills in the elevation of the vertices that don't have one."""
+    missing = [p for p in self.points if p.elevation is None]
+    if not missing:
+      return
+    elevations = dem.sample([p.lat for p in missing], [p.lng for p in missing])
+    for p, elevation in zip(missing, elevations):
+      if not np.isnan(elevation):
+        p.elevation = float(elevation)
+
+  def elevation_gain(self):
+    """Returns (ascent_m, descent_m), vertices without elevation are skipped."""
+    elevations = self.elevations()
+    diffs = np.diff(elevations[~np.isnan(elevations)])
+    return float(diffs[diffs > 0].sum()), float(-diffs[diffs < 0].sum())
+
+  def elevation_profile(self, num_samples=64):
+    """Returns num_samples (distance_m, elevation_m) evenly spaced along the route."""
+    elevations = self.elevations()
+    valid = ~np.isnan(elevations)
+    if valid.sum() < 2:
+      return []
+    distances = np.concatenate([[0.0], np.cumsum(_segment_lengths(self.points))])
+    sample_distances = np.linspace(0.0, distances[-1], num_samples)
+    sample_elevations = np.interp(sample_distances, distances[valid], elevations[valid])
+    return list(zip(sample_distances.tolist(), sample_elevations.tolist()))
     
     
-  def simplify(self, max_distance=5.0):
-    r = copy.deepcopy(self)
-    locs = [gpxpy.geo.Location(p.lat, p.lng) for p in self.points]
-    new_locs = gpxpy.geo.simplify_polyline(locs, max_distance=max_distance)
-    
-    r.points = [LatLng(l.latitude, l.longitude) for l in new_locs]
+  @metrics.timed('simplify')
+  def simplify(self, max_distance=5.0, method='douglas_peucker', keep=None):
+    """Returns a copy without the vertices closer than max_distance meters to
+    the simplified line. The endpoints and the vertex indices in keep stay."""
+    r = copy.deepcopy(dataclasses.replace(self, points=[]))
+    mask = simplify.simplify_mask(self.points_as_list(), max_distance, method=method, keep=keep)
+    r.points = [LatLng(p.lat, p.lng, p.elevation) for p, kept in zip(self.points, mask.tolist()) if kept]
     return r
 
-def create_route_nodes(r: Route, markers=True):
+@metrics.timed('simplify_routes')
+def simplify_routes(routes, max_distance=5.0, method='douglas_peucker'):
+  """Route.simplify of every route, much faster than one by one."""
+  masks = simplify.simplify_masks([r.points_as_list() for r in routes], max_distance, method=method)
+  simplified = []
+  for r, mask in zip(routes, masks):
+    new_route = copy.deepcopy(dataclasses.replace(r, points=[]))
+    new_route.points = [LatLng(p.lat, p.lng, p.elevation) for p, kept in zip(r.points, mask.tolist()) if kept]
+    simplified.append(new_route)
+  return simplified
+
+def _segment_lengths(points):
+  latlngs = np.radians(np.array([[p.lat, p.lng] for p in points]).reshape(-1, 2))
+  dlat = np.diff(latlngs[:, 0])
+  dlng = np.diff(latlngs[:, 1])
+  a = np.sin(dlat / 2) ** 2 + np.cos(latlngs[:-1, 0]) * np.cos(latlngs[1:, 0]) * np.sin(dlng / 2) ** 2
+  return 2 * gpxpy.geo.EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+def _profile_svg(profile, width=300, height=60):
+  distances, elevations = np.array(profile).T
+  min_e, max_e = elevations.min(), elevations.max()
+  xs = distances / max(distances[-1], 1e-6) * width
+  ys = height - (elevations - min_e) / max(max_e - min_e, 1.0) * height
+  points = ' '.join(f'{x:.1f},{y:.1f}' for x, y in zip(xs, ys))
+  return (f'<svg width="{width}" height="{height}" style="background:#eee">'
+          f'<polyline points="{points}" fill="none" stroke="black" stroke-width="1.5"/></svg>'
+          f'<br>{min_e:.0f} m - {max_e:.0f} m')
+
+def create_route_nodes(r: Route, markers=True, polyline_precision=0):
+  """Creates the folium nodes of a route.
+
+  If polyline_precision > 0 the route is sent as an encoded polyline rounded
+  to that many decimals, and the map needs a utils.PolylineDecoder. The
+  client finds the layers of the route in route_layers[r.id], the map needs a
+  utils.RouteRegistry.
+  """
+  import folium
+  import utils
   points = r.points_as_list()
   segment_node = folium.FeatureGroup(name="segment", control=False)
-  polyline = folium.PolyLine(points, color=f'#{r.line_style.color}', weight=max(r.line_style.width, 3.0), opacity=1.0, bubbling_mouse_events=False).add_to(segment_node)
+  style = dict(color=f'#{r.line_style.color}', weight=max(r.line_style.width, 3.0), opacity=1.0, bubbling_mouse_events=False)
+  if polyline_precision > 0:
+    polyline = utils.EncodedPolyLine(points, precision=polyline_precision, **style).add_to(segment_node)
+  else:
+    polyline = folium.PolyLine(points, **style).add_to(segment_node)
   utils.JavaScript(script="""
 {{kwargs['polyline']}}.on('click', function(e) {
-console.log(e.latlng, "{{kwargs['polyline']}}");
+console.log(e.latlng, {{kwargs['route_id']}});
 parent.$('#lat').val(e.latlng["lat"]);
 parent.$('#lng').val(e.latlng["lng"]);
-parent.$('#element').val("{{kwargs['polyline']}}");
+parent.$('#element').val("{{kwargs['route_id']}}");
 action_type = parent.$('input[name="action"]:checked').val();
 index = action_type.indexOf(':');
 if (index >= 0) {
@@ -103,7 +190,7 @@ $.ajax({
       console.log(error);
     }
   });
-});""",  args={'polyline': polyline.get_name()}).add_to(segment_node)
+});""",  args={'polyline': polyline.get_name(), 'route_id': r.id}).add_to(segment_node)
 
   start_marker_nodes = []
   end_marker_nodes = []
@@ -122,6 +209,11 @@ $.ajax({
     start_marker_nodes.append(folium.RegularPolygonMarker(
       location=points[0], fill_color='white', fill_opacity=1, 
       color='white', number_of_sides=3, radius=3, rotation=0, classNaMe="marker").add_to(segment_node))
+  marker_names = lambda nodes: '[' + ', '.join(node.get_name() for node in nodes) + ']'
+  utils.JavaScript(script=f"""
+route_layers[{r.id}] = {{line: {polyline.get_name()}, segment: {segment_node.get_name()},
+  start_markers: {marker_names(start_marker_nodes)}, end_markers: {marker_names(end_marker_nodes)}}};
+""").add_to(segment_node)
   return types.SimpleNamespace(segment_node=segment_node,
                                polyline=polyline,
                                end_marker_nodes=end_marker_nodes,
@@ -138,37 +230,141 @@ activity_color = {
   "rapid": "F42410",
 }
 
+def is_duplicate(r1, r2):
+  """Whether both routes have the same name and vertices (within 10cm)."""
+  if r1.name != r2.name or len(r1.points) != len(r2.points):
+    return False
+  for p1, p2 in zip(r1.points, r2.points):
+    l1, l2 = tuple(gpxpy.geo.Location(p.lat, p.lng) for p in [p1, p2])
+    if l1.distance_2d(l2) > 0.1:
+      return False
+  return True
+
 def _size_value(value):
   if value[-1] == '%':
     return value
   else:
     return int(value)
 
+def section_stats_csv(compute_stats):
+  """CSV of the distance and segments of every activity in the s1a, s1b, ...
+  section labels, from a compute_stats(labels) function."""
+  num_subsections_per_section = [3, 3, 2, 4, 3, 5]
+  activities = ['total', 'trail', 'offtrail', 'bush', 'road', 'paddle', 'crossing', 'float', 'unknown']
+
+  csv_str = ",".join(["name"] + sum([[a + "_distance", a + "_segments"] for a in activities], [])) + "\n"
+  for section_index, num_subsections in enumerate(num_subsections_per_section):
+    for subsection_index in range(num_subsections):
+      label = f"s{section_index+1}{chr(ord('a') + subsection_index)}"
+      stats_dict = compute_stats(label)
+      stats_items = [stats_dict.get(act, (0.0, 0, 0.0, 0.0)) for act in activities]
+      stats_items_strs = sum([[f"{distance/1609.34:.2f}", f"{num_segments}"]
+                             for distance, num_segments, _, _ in stats_items],[])
+      csv_str += ",".join([label] + stats_items_strs) + "\n"
+  return csv_str
+
+def _parse_labels(labels):
+  return [l.strip() for l in labels.split(',') if l.strip() != '']
+
+def _has_labels(r, labels):
+  return all(label in r.labels for label in labels)
+
+def _locked(method):
+  @functools.wraps(method)
+  def wrapper(self, *args, **kwargs):
+    with self._lock:
+      return method(self, *args, **kwargs)
+  return wrapper
+
+def _mutating(method):
+  """Like _locked, also bumps the revision of the map."""
+  @functools.wraps(method)
+  def wrapper(self, *args, **kwargs):
+    with self._lock:
+      self.revision += 1
+      return method(self, *args, **kwargs)
+  return wrapper
+
+# Routes are drawn with this simplification distance, in meters, and precision
+# in the overview of lazy maps.
+OVERVIEW_MAX_DISTANCE = 100.0
+OVERVIEW_PRECISION = 5
+
+# Saved route ids above the number of routes plus this are given a new id.
+MAX_ROUTE_ID_GAP = 100000
+
+# Operations accepted by RouteMap.apply_batch.
+BATCH_OPERATIONS = ('label', 'add_label', 'remove_label', 'simplify', 'split', 'remove')
+
+def _batch_float(value, name):
+  try:
+    value = float(value)
+  except (TypeError, ValueError):
+    raise ValueError(f'Invalid {name}: {value}')
+  if not np.isfinite(value):
+    raise ValueError(f'Invalid {name}: {value}')
+  return value
+
 
 class RouteMap:
     
-  def __init__(self, width="100%", height="600", edit_pane=True):
-    self._route_dict = {}
-    self._route_nodes_dict = {}
+  def __init__(self, width="100%", height="600", edit_pane=True, dem=None, polyline_precision=6,
+               tile_proxy=None, lazy_min_zoom=None, headless=False):
+    self._dem = dem
+    # Headless maps only keep the routes, for batch processing: there is no
+    # folium map, no route nodes and no JS for a client.
+    self._headless = headless
+    # When set, the map only has overview lines and the client loads the
+    # routes in view from viewport() at zoom levels >= lazy_min_zoom.
+    self._lazy_min_zoom = lazy_min_zoom
+    # Url prefix of the tile proxy serving the basemaps, None to load them
+    # directly from the tile servers.
+    self._tile_proxy = tile_proxy
+    self._polyline_precision = polyline_precision
+    # Routes and their folium nodes indexed by route id. Removed routes leave
+    # a None, their ids aren't given to other routes.
+    self._routes = []
+    self._route_nodes = []
+    # Bounds, length and the other attributes derived from the vertices of
+    # every route id.
+    self._table = route_table.RouteTable()
+    self._search_index = search.SearchIndex()
+    # Route id every route split off since forget_splits() comes from.
+    self._split_from = {}
     self._js_commands = ''
-    self._create_map(width, height, edit_pane)
+    self._lock = threading.RLock()
+    # Incremented by every change of the routes.
+    self.revision = 0
+    # Route nodes and styles waiting to be sent to the client while in batch().
+    self._pending_nodes = None
+    self._pending_styles = None
+    self._map = None
+    if not headless:
+      self._create_map(width, height, edit_pane)
     
     
   def _create_map(self, width, height, edit_pane):
+    import folium
+    import my_draw
+    import utils
     self._map = folium.Map(tiles=None, zoom_control=False, width=_size_value(width), height=_size_value(height),control_scale = True, zoomDelta=0.1)
+    utils.RouteRegistry().add_to(self._map)
+    if self._polyline_precision > 0 or self._lazy_min_zoom is not None:
+      utils.PolylineDecoder().add_to(self._map)
     # self._map.default_js.append(("draw", "https://cdnjs.cloudflare.com/ajax/libs/leaflet.draw/1.0.4/leaflet.draw.js"))
     # self._map.default_css.append(("draw", "https://cdnjs.cloudflare.com/ajax/libs/leaflet.draw/1.0.4/leaflet.draw.css"))
-    folium.TileLayer('https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}', attr='ArcGIS', name='World_Imagery').add_to(self._map)
-    if edit_pane:
-      folium.TileLayer('https://server.arcgisonline.com/ArcGIS/rest/services/World_Topo_Map/MapServer/tile/{z}/{y}/{x}', attr='ESRI', name="ESRI Topo").add_to(self._map)
-      folium.TileLayer('https://{s}.tile.opentopomap.org/{z}/{x}/{y}.png', attr='OpenTopo', name="OpenTopo").add_to(self._map)
-      folium.TileLayer('https://basemap.nationalmap.gov/arcgis/rest/services/USGSTopo/MapServer/tile/{z}/{y}/{x}', attr='USGS', name="USGS Topo").add_to(self._map)
-      folium.TileLayer('http://caltopo.s3.amazonaws.com/topo/{z}/{x}/{y}.png?v=1', attr='Caltopo', name="CaltopoFS").add_to(self._map)
+    for layer in (tiles.TILE_LAYERS if edit_pane else tiles.STATIC_LAYERS):
+      url, attr, name = tiles.TILE_LAYERS[layer]
+      if self._tile_proxy is not None:
+        url = f'{self._tile_proxy}/{layer}/{{z}}/{{x}}/{{y}}'
+      folium.TileLayer(url, attr=attr, name=name).add_to(self._map)
 
 
     # folium.TileLayer('https://server.arcgisonline.com/ArcGIS/rest/services/World_Topo_Map/MapServer/tile/{z}/{y}/{x}', attr='ArcGIS', name='Topo Map').add_to(self._map)
     if edit_pane:
       folium.LayerControl(collapsed=False).add_to(self._map)
+    if self._lazy_min_zoom is not None:
+      self._viewport_loader = utils.ViewportLoader().add_to(self._map)
     if edit_pane:
       self._draw = my_draw.Draw(
           export=False,
@@ -202,68 +398,328 @@ class RouteMap:
 # """).add_to(self._map)
 
     
-  def add_route(self, route: Route, static=False, markers=True):
+  @_mutating
+  def add_route(self, route: Route, static=False, markers=True, check_duplicates=True):
     """Add route.
     
     If static = True, adds the nodes to the map directly instead
     of to the JS code var.
     """
     # Look for duplicates.
-    for r in self._route_dict.values():
-      if r.name != route.name: continue
-      if len(r.points) != len(route.points): continue
-      different = False
-      for p1, p2 in zip(r.points, route.points):
-        l1, l2 = tuple(gpxpy.geo.Location(p.lat, p.lng) for p in [p1, p2])
-        if l1.distance_2d(l2) > 0.1:
-          different = True
-          break
-      if not different:
+    candidates = self._table.duplicate_candidates(route, len(self._routes)) if check_duplicates else []
+    for r in (self._routes[route_id] for route_id in candidates):
+      if is_duplicate(r, route):
         print(f"Found duplicate route: {r.name} with {len(r.points)} points, ignoring.")
         return
-    route_nodes = create_route_nodes(route, markers=markers)
-    name = route_nodes.polyline.get_name()
+    if self._dem is not None:
+      route.sample_elevations(self._dem)
+    # Routes keep the id they were saved with, unless another route has it or
+    # it is far above the ids in use, which would grow every per id list.
+    if route.id is not None and (not isinstance(route.id, int) or route.id > len(self._routes) + MAX_ROUTE_ID_GAP):
+      print(f'Route {route.name} has an invalid id {route.id!r}, giving it a new one.')
+      route.id = None
+    if route.id is None or route.id < 0 or self._route_exists(route.id):
+      route.id = len(self._routes)
+    route_id = route.id
+    if route_id >= len(self._routes):
+      self._routes.extend([None] * (route_id + 1 - len(self._routes)))
+      self._route_nodes.extend([None] * (route_id + 1 - len(self._route_nodes)))
+    route_nodes = None
+    if not self._headless:
+      route_nodes = create_route_nodes(route, markers=markers, polyline_precision=self._polyline_precision)
     if not static:
-      print(f"adding {name}")
-    self._route_dict[name] = route
-    self._route_nodes_dict[name] = route_nodes
+      print(f"adding {route_id}")
+    self._routes[route_id] = route
+    self._route_nodes[route_id] = route_nodes
+    self._table.update(route_id, self._routes[route_id])
+    self._search_index.update(route_id, route)
+    if self._headless:
+      return route_id
+    if self._lazy_min_zoom is not None:
+      self._update_overview(route_id, static)
+      if static:
+        # Sent by viewport() once in view.
+        return route_id
     if static:
       route_nodes.segment_node.add_to(self._map)
+    elif self._pending_nodes is not None:
+      self._pending_nodes[route_id] = route_nodes
+    else:
+      self._js_commands += self._render_route_nodes([route_nodes])
+
+    return route_id
+
+  def _route_exists(self, route_id):
+    return 0 <= route_id < len(self._routes) and self._routes[route_id] is not None
+
+  def _get(self, route_id):
+    if not self._route_exists(route_id):
+      raise KeyError(f'Unknown route: {route_id}')
+    return self._routes[route_id]
+
+  def items(self):
+    """(route_id, route) of every route."""
+    return [(route_id, r) for route_id, r in enumerate(self._routes) if r is not None]
+
+  def get(self, route_id):
+    return self._get(route_id)
+
+  @_locked
+  def __contains__(self, route_id):
+    return self._route_exists(route_id)
+
+  def _update_overview(self, route_id, static):
+    import utils
+    r = self._routes[route_id]
+    overview_js = (f'addOverview({route_id}, '
+                   f'{utils.encoded_js(r.simplify(OVERVIEW_MAX_DISTANCE).points_as_list(), OVERVIEW_PRECISION)}, '
+                   f'{OVERVIEW_PRECISION}, "#{r.line_style.color}");\n')
+    self._viewport_loader.overviews[route_id] = overview_js
+    if not static:
+      self._js_commands += f'removeOverview({route_id});\n' + overview_js
+
+  def _update_route_nodes(self, route_id):
+    """Rebuilds the nodes of a changed route, lazy maps send them again from
+    viewport() when the route is back in view."""
+    markers = bool(self._route_nodes[route_id].start_marker_nodes)
+    self._route_nodes[route_id] = create_route_nodes(self._routes[route_id], markers=markers,
+                                                     polyline_precision=self._polyline_precision)
+
+  def _render_route_nodes(self, route_nodes_list):
+    import utils
+    return utils.render_nodes([n.segment_node for n in route_nodes_list], self._map)
+
+  def _remove_layers_js(self, route_id):
+    return (f"if (route_layers[{route_id}]) {{ {self._map.get_name()}.removeLayer(route_layers[{route_id}].segment); "
+            f"delete route_layers[{route_id}]; }}\n")
+
+  def _set_style(self, route_id, **style):
+    if self._headless:
+      return
+    if self._pending_styles is not None:
+      self._pending_styles.setdefault(route_id, {}).update(style)
     else:
-      self._js_commands += utils.render_nodes(route_nodes.segment_node, self._map)
-      self._js_commands += f"window.{name} = {name};"
-      for node in route_nodes.start_marker_nodes:
-        self._js_commands += f"window.{node.get_name()} = {node.get_name()};"
-      for node in route_nodes.end_marker_nodes:
-        self._js_commands += f"window.{node.get_name()} = {node.get_name()};"
-
-    return name
+      # Routes may not be loaded by the client in lazy maps.
+      self._js_commands += f"if (route_layers[{route_id}]) route_layers[{route_id}].line.setStyle({json.dumps(style)});\n"
+
+  @contextlib.contextmanager
+  def batch(self):
+    """Coalesces the client updates of all the operations in the block.
+
+    Routes added and removed inside the block are never sent, the remaining
+    new routes are rendered together and each route gets at most one setStyle.
+    """
+    with self._lock:
+      if self._pending_nodes is not None:
+        yield
+        return
+      self._pending_nodes = collections.OrderedDict()
+      self._pending_styles = collections.OrderedDict()
+      try:
+        yield
+      finally:
+        pending_nodes, pending_styles = self._pending_nodes, self._pending_styles
+        self._pending_nodes = None
+        self._pending_styles = None
+        if pending_nodes:
+          self._js_commands += self._render_route_nodes(list(pending_nodes.values()))
+        for route_id, style in pending_styles.items():
+          self._set_style(route_id, **style)
+
+  def query(self, labels):
+    """Returns the ids of the routes having all the comma separated labels."""
+    labels = _parse_labels(labels)
+    return [route_id for route_id, r in self.items() if _has_labels(r, labels)]
+
+  @_locked
+  def suggest_activities(self, labels=''):
+    """activity.Suggestion for the routes with the labels and no activity type."""
+    import activity
+    route_ids = [route_id for route_id in self.query(labels) if self._get(route_id).activity_type not in activity_color]
+    return activity.suggest(self.items(), route_ids)
+
+  @_locked
+  def apply_batch(self, operations):
+    """Applies a list of operations with a single client update.
+
+    Each operation is a dict with an 'op' from BATCH_OPERATIONS and either an
+    'element' route id or a 'labels' query selecting every route with those
+    labels. 'params' holds the activity type, the labels or the simplification
+    distance, and 'split' takes 'lat' and 'lng'. All operations are validated
+    before any is applied. Returns the number of routes changed.
+    """
+    validated = []
+    for operation in operations:
+      operation = dict(operation)
+      op = operation.get('op')
+      if op not in BATCH_OPERATIONS:
+        raise ValueError(f'Unknown batch operation: {op}')
+      if 'element' in operation:
+        try:
+          operation['element'] = int(operation['element'])
+        except (TypeError, ValueError):
+          raise ValueError(f'Invalid route id: {operation["element"]}')
+        if not self._route_exists(operation['element']):
+          raise ValueError(f'Unknown route: {operation["element"]}')
+      elif 'labels' not in operation:
+        raise ValueError(f'Batch operation {op} needs an element or labels.')
+      if op == 'label' and operation.get('params') not in activity_color:
+        raise ValueError(f'Unknown activity type: {operation.get("params")}')
+      if op == 'simplify':
+        operation['params'] = _batch_float(operation.get('params') or 5.0, 'simplification distance')
+      if op == 'split':
+        if 'element' not in operation or 'lat' not in operation or 'lng' not in operation:
+          raise ValueError('Batch split needs an element, lat and lng.')
+        operation['lat'] = _batch_float(operation['lat'], 'latitude')
+        operation['lng'] = _batch_float(operation['lng'], 'longitude')
+      validated.append(operation)
+
+    num_changed = 0
+    with self.batch():
+      for operation in validated:
+        op = operation['op']
+        params = operation.get('params', '')
+        if 'element' in operation:
+          route_ids = [operation['element']]
+        else:
+          route_ids = self.query(operation['labels'])
+        for route_id in route_ids:
+          if not self._route_exists(route_id):
+            # Removed by a previous operation.
+            continue
+          if op == 'label':
+            self.set_activity_type(route_id, params)
+          elif op == 'add_label':
+            self.add_label(route_id, params)
+          elif op == 'remove_label':
+            self.remove_label(route_id, params)
+          elif op == 'simplify':
+            self.simplify(route_id, params)
+          elif op == 'split':
+            self.split_route(route_id, LatLng(operation['lat'], operation['lng']))
+          elif op == 'remove':
+            self.remove_route(route_id)
+          num_changed += 1
+    print(f'Applied {len(operations)} batch operations to {num_changed} routes.')
+    return num_changed
   
   def fit_bounds(self):
-    points_array = np.concatenate([r.points_as_list() for _, r in self._route_dict.items()])
-    self._map.fit_bounds([points_array.min(axis=0).tolist(), points_array.max(axis=0).tolist()]) 
+    bounds = self._table.bounds[:len(self._routes)]
+    if self._map is None or np.isnan(bounds).all():
+      return
+    self._map.fit_bounds([np.nanmin(bounds[:, :2], axis=0).tolist(), np.nanmax(bounds[:, 2:], axis=0).tolist()])
+
+  @_locked
+  def search(self, query, limit=50):
+    """Routes matching the query in their name, description or labels, best
+    first, as dicts with the route_id, name, score and ((south, west), (north,
+    east)) bounds."""
+    results = []
+    for route_id, score in self._search_index.search(query, limit):
+      south, west, north, east = self._table.bounds[route_id].tolist()
+      results.append({'route_id': route_id, 'name': self._routes[route_id].name, 'score': score,
+                      'bounds': [[south, west], [north, east]]})
+    return results
+
+  @_locked
+  def zoom_to(self, route_ids):
+    """Fits the client map to the routes."""
+    bounds = self._table.bounds[route_ids]
+    if not len(route_ids) or np.isnan(bounds).all():
+      return
+    south, west = np.nanmin(bounds[:, :2], axis=0).tolist()
+    north, east = np.nanmax(bounds[:, 2:], axis=0).tolist()
+    self._js_commands += f'{self._map.get_name()}.fitBounds([[{south}, {west}], [{north}, {east}]]);\n'
+
+  @_locked
+  def nearest_route(self, latlng, max_distance_m=20.0):
+    """Id of the route closest to latlng, None if none is within max_distance_m."""
+    margin = np.degrees(max_distance_m / gpxpy.geo.EARTH_RADIUS)
+    lng_margin = margin / max(np.cos(np.radians(latlng.lat)), 1e-6)
+    candidates = self.routes_in_bounds(((latlng.lat - margin, latlng.lng - lng_margin),
+                                        (latlng.lat + margin, latlng.lng + lng_margin)))
+    best_id, best_distance = None, max_distance_m
+    for route_id in candidates:
+      xy = simplify.local_xy(self._routes[route_id].points_as_list() + [[latlng.lat, latlng.lng]], latlng.lat)
+      xy, query = xy[:-1], xy[-1]
+      if len(xy) < 2:
+        continue
+      a, ab = xy[:-1], xy[1:] - xy[:-1]
+      t = np.clip(((query - a) * ab).sum(axis=1) / np.maximum((ab * ab).sum(axis=1), 1e-12), 0.0, 1.0)
+      distance = np.hypot(*(query - a - t[:, None] * ab).T).min()
+      if distance <= best_distance:
+        best_id, best_distance = route_id, distance
+    return best_id
+
+  @_locked
+  def route_bounds(self, margin=0.0):
+    """((south, west), (north, east)) of every route, extended by margin degrees."""
+    return [((south - margin, west - margin), (north + margin, east + margin))
+            for south, west, north, east in self._table.bounds[:len(self._routes)].tolist()
+            if not np.isnan(south)]
+
+  @_locked
+  def routes_in_bounds(self, bounds):
+    """Ids of the routes whose bounds intersect ((south, west), (north, east))."""
+    (south, west), (north, east) = bounds
+    b = self._table.bounds[:len(self._routes)]
+    # Comparisons with the NaN bounds of removed routes are false.
+    return np.nonzero((b[:, 0] <= north) & (b[:, 2] >= south) & (b[:, 1] <= east) & (b[:, 3] >= west))[0].tolist()
+
+  @_locked
+  def viewport(self, bounds, zoom, loaded_ids, max_routes=1000):
+    """Sends the routes in bounds not loaded by the client and evicts the
+    loaded ones out of bounds. No route is detailed below lazy_min_zoom.
+    """
+    visible = []
+    if zoom >= self._lazy_min_zoom:
+      visible = self.routes_in_bounds(bounds)
+      if len(visible) > max_routes:
+        print(f'{len(visible)} routes in view, only loading {max_routes}.')
+        visible = visible[:max_routes]
+    loaded_ids = set(loaded_ids)
+    for route_id in loaded_ids - set(visible):
+      self._js_commands += self._remove_layers_js(route_id)
+    new_ids = [route_id for route_id in visible if route_id not in loaded_ids]
+    if new_ids:
+      self._js_commands += self._render_route_nodes([self._route_nodes[route_id] for route_id in new_ids])
 
   def map(self):
     return self._map
 
-  def remove_route(self, route_name):
-    print('remove ', route_name)
-    route = self._route_nodes_dict[route_name]
-    self._js_commands += f"""
-{self._map.get_name()}.removeLayer({route.segment_node.get_name()});
-"""
-    del self._route_dict[route_name]
-    del self._route_nodes_dict[route_name]
+  @_mutating
+  def remove_route(self, route_id):
+    print('remove ', route_id)
+    self._get(route_id)
+    if self._pending_nodes is not None and route_id in self._pending_nodes:
+      # Never reached the client.
+      del self._pending_nodes[route_id]
+    elif not self._headless:
+      self._js_commands += self._remove_layers_js(route_id)
+    if self._lazy_min_zoom is not None:
+      self._js_commands += f'removeOverview({route_id});\n'
+      del self._viewport_loader.overviews[route_id]
+    if self._pending_styles is not None:
+      self._pending_styles.pop(route_id, None)
+    self._routes[route_id] = None
+    self._route_nodes[route_id] = None
+    self._table.remove(route_id)
+    self._search_index.remove(route_id)
 
-  def set_activity_type(self, route_name, activity_type):
-    r = self._route_dict[route_name]
+  @_mutating
+  def set_activity_type(self, route_id, activity_type):
+    r = self._get(route_id)
     r.activity_type = activity_type
     r.line_style.color = activity_color[activity_type]
-    self._js_commands += f"{route_name}.setStyle({{color: '#{r.line_style.color}'}});\n"
+    self._set_style(route_id, color=f'#{r.line_style.color}')
+    if self._lazy_min_zoom is not None:
+      self._update_overview(route_id, static=False)
+      self._update_route_nodes(route_id)
 
     
-  def add_label(self, route_name, labels):
-    r = self._route_dict[route_name]
+  @_mutating
+  def add_label(self, route_id, labels):
+    r = self._get(route_id)
     route_labels = set(r.labels)
 
     for label in labels.split(','):
@@ -271,6 +727,7 @@ class RouteMap:
       if label not in r.labels:
         route_labels.add(label)
     r.labels = sorted(list(route_labels))
+    self._search_index.update(route_id, r)
     # if "primary" in r.labels:
     #   r.line_style.width = 4.5
     #   self._js_commands += f"{route_name}.setStyle({{weight: {r.line_style.width}}});\n"
@@ -279,14 +736,16 @@ class RouteMap:
     #   self._js_commands += f"{route_name}.setStyle({{weight: {r.line_style.width}}});\n"
     
 
-  def remove_label(self, route_name, labels):
-    r = self._route_dict[route_name]
+  @_mutating
+  def remove_label(self, route_id, labels):
+    r = self._get(route_id)
     route_labels = set(r.labels)
     for label in labels.split(','):
       label = label.strip()
       if label in route_labels:
         route_labels.remove(label)
     r.labels = sorted(list(route_labels))
+    self._search_index.update(route_id, r)
     # if "primary" in r.labels:
     #   r.line_style.width = 4.5
     #   self._js_commands += f"{route_name}.setStyle({{weight: {r.line_style.width}}});\n"
@@ -295,13 +754,79 @@ class RouteMap:
     #   self._js_commands += f"{route_name}.setStyle({{weight: {r.line_style.width}}});\n"
 
     
-  def split_route(self, route_name, latlng):
-    route = self._route_dict[route_name]
+  @_mutating
+  def split_route(self, route_id, latlng):
+    route = self._get(route_id)
+    # r1 keeps the id of the route, r2 gets a new one.
     r1, r2 = route.split(latlng)
-    self.remove_route(route_name)
+    r2.id = None
+    self.remove_route(route_id)
     self.add_route(r1)
-    self.add_route(r2)
+    self._record_split(route_id, self.add_route(r2))
+
+  def _record_split(self, route_id, piece_id):
+    if piece_id is not None:
+      self._split_from[piece_id] = self._split_from.get(route_id, route_id)
+
+  @_locked
+  def split_pieces(self, route_id):
+    """Ids of the routes split off route_id, or off its pieces, since
+    forget_splits()."""
+    return [piece_id for piece_id, origin in self._split_from.items()
+            if origin == route_id and self._route_exists(piece_id)]
+
+  @_locked
+  def forget_splits(self):
+    """Forgets where the routes were split off, once they are saved."""
+    self._split_from = {}
+
+  @_mutating
+  def simplify_all(self, labels='', max_distance=5.0, method='douglas_peucker'):
+    """simplify() of every route with the labels, keeping the vertices other
+    routes start or end at. Returns the number of vertices removed."""
+    def key(p):
+      return (round(p.lat, 7), round(p.lng, 7))
+    endpoints = collections.Counter(key(p) for _, r in self.items() if r.points for p in (r.points[0], r.points[-1]))
+    num_removed = 0
+    with self.batch():
+      for route_id in self.query(labels):
+        r = self._get(route_id)
+        own = collections.Counter(key(p) for p in (r.points[0], r.points[-1])) if r.points else {}
+        keep = [i for i, p in enumerate(r.points) if endpoints[key(p)] > own.get(key(p), 0)]
+        new_route = r.simplify(max_distance, method=method, keep=keep)
+        num_removed += len(r.points) - len(new_route.points)
+        self.remove_route(route_id)
+        self.add_route(new_route, check_duplicates=False)
+    return num_removed
+
+  @_mutating
+  def split_at_junctions(self, labels='', tolerance_m=5.0):
+    """Splits the routes with the labels where they cross, or where another
+    route ends within tolerance_m, snapping those ends onto the split points.
+
+    Returns the number of routes split or snapped.
+    """
+    import junctions
+    route_ids = self.query(labels)
+    routes = [self._get(route_id) for route_id in route_ids]
+    cuts, snaps = junctions.find_junctions([r.points_as_list() for r in routes], tolerance_m)
+    changed = sorted(set(cuts) | set(k for k, _ in snaps))
+    with self.batch():
+      for k in changed:
+        route_snaps = [(end, snaps[(k, end)]) for end in (0, -1) if (k, end) in snaps]
+        pieces = junctions.cut_points(routes[k].points, cuts.get(k, []), route_snaps)
+        self.remove_route(route_ids[k])
+        for i, points in enumerate(pieces):
+          # The first piece keeps the id of the route, like split_route.
+          piece = copy.deepcopy(dataclasses.replace(routes[k], points=[], id=route_ids[k] if i == 0 else None))
+          piece.points = points
+          piece_id = self.add_route(piece, check_duplicates=False)
+          if i > 0:
+            self._record_split(route_ids[k], piece_id)
+    print(f'Split {len(cuts)} and snapped {len(changed) - len(cuts)} of {len(routes)} routes at junctions.')
+    return len(changed)
 
+  @_locked
   def pop_js_commands(self):
     js_commands = self._js_commands
     self._js_commands = ''
@@ -318,55 +843,90 @@ if (iframe_selector.length == 0) {{
 C.{self._draw.get_name()}._toolbars['draw']._modes['polyline'].button.click();
 """
 
+  @_mutating
   def end_create_route(self, latlngs):
     r = Route(name='noname', points=[LatLng(p['lat'], p['lng']) for p in latlngs], description='')
-    route_name = self.add_route(r)
+    route_id = self.add_route(r)
     self._js_commands += f"""
-console.log("{route_name}");
-{route_name}.redraw();
+console.log({route_id});
+route_layers[{route_id}].line.redraw();
 """
  
-  def edit_route(self, route_name):
+  def edit_route(self, route_id):
     self._js_commands += f"""
-{route_name}.addTo(drawnItems);
+route_layers[{route_id}].line.addTo(drawnItems);
 {self._draw.get_name()}._toolbars['edit']._modes['edit'].button.click()
-current_edit_line = {route_name};
-current_route_name = "{route_name}";
+current_edit_line = route_layers[{route_id}].line;
+current_route_name = "{route_id}";
 """
 
-  def end_edit_route(self, route_name, latlngs):
-    self._route_dict[route_name].points = [LatLng(p['lat'], p['lng']) for p in latlngs]
-    for node in self._route_nodes_dict[route_name].start_marker_nodes:
-      self._js_commands += f"""{node.get_name()}.setLatLng({latlngs[0]});\n"""
-    for node in self._route_nodes_dict[route_name].end_marker_nodes:
-      self._js_commands += f"""{node.get_name()}.setLatLng({latlngs[-1]});\n"""
+  @_mutating
+  def end_edit_route(self, route_id, latlngs):
+    r = self._get(route_id)
+    # Vertices the edit didn't move keep their elevation, the DEM fills in the
+    # new ones. The client has the vertices rounded to the polyline precision.
+    decimals = self._polyline_precision if self._polyline_precision > 0 else 7
+    def key(lat, lng):
+      return (round(lat, decimals), round(lng, decimals))
+    elevations = {key(p.lat, p.lng): p.elevation for p in r.points}
+    r.points = [LatLng(p['lat'], p['lng'], elevations.get(key(p['lat'], p['lng']))) for p in latlngs]
+    if self._dem is not None:
+      r.sample_elevations(self._dem)
+    self._table.update(route_id, r)
+    if self._lazy_min_zoom is not None:
+      self._update_overview(route_id, static=False)
+      self._update_route_nodes(route_id)
+    self._js_commands += f"""
+route_layers[{route_id}].start_markers.forEach(function(m) {{ m.setLatLng({json.dumps(latlngs[0])}); }});
+route_layers[{route_id}].end_markers.forEach(function(m) {{ m.setLatLng({json.dumps(latlngs[-1])}); }});
+"""
     return
 
 
-  def simplify(self, route_name):
-    r = self._route_dict[route_name]
-    new_route = r.simplify()
-    self.remove_route(route_name)
+  def _junction_vertices(self, route_id):
+    """Indices of the vertices of the route where other routes start or end."""
+    endpoints = set()
+    for other_id, other in self.items():
+      if other_id != route_id and other.points:
+        endpoints.update((round(p.lat, 7), round(p.lng, 7)) for p in (other.points[0], other.points[-1]))
+    return [i for i, p in enumerate(self._get(route_id).points) if (round(p.lat, 7), round(p.lng, 7)) in endpoints]
+
+  @_mutating
+  def simplify(self, route_id, max_distance=5.0, method='douglas_peucker', preserve_topology=True):
+    """Simplifies a route, keeping the vertices other routes connect to if
+    preserve_topology."""
+    r = self._get(route_id)
+    keep = self._junction_vertices(route_id) if preserve_topology else None
+    new_route = r.simplify(max_distance, method=method, keep=keep)
+    self.remove_route(route_id)
     self.add_route(new_route)
 
   
-  def info(self, route_name, latlng):
-    print('num tracks: ', len(self._route_dict))
-    r = self._route_dict[route_name]
+  @_locked
+  def info(self, route_id, latlng):
+    print('num tracks: ', len(self.items()))
+    r = self._get(route_id)
     description = r.description if r.description else ''
-    length_in_m = r.length()
+    length_in_m = float(self._table.length_m[route_id])
     length_str = f'{length_in_m/1000.0:.1f} km / {length_in_m*0.000621371:.1f} mi'
     labels_str = ' '.join(f'#{l}' for l in r.labels)
+    elevation_str = ''
+    profile = r.elevation_profile()
+    if profile:
+      ascent_m, descent_m = self._table.elevation_gain[route_id].tolist()
+      elevation_str = (f'<b>Ascent/Descent:</b> {ascent_m:.0f} m / {descent_m:.0f} m '
+                       f'({ascent_m*3.28084:.0f} ft / {descent_m*3.28084:.0f} ft)<br>'
+                       f'{_profile_svg(profile)}<br>')
     print(description)
     content = f"""
 <form class="boxed"  role="form" id="popup-form">
-<input type="hidden" id="element" name="route_name" value="{route_name}">
+<input type="hidden" id="element" name="route_name" value="{route_id}">
 <p><b>Name:</b> <input type="text" id="name" name="name" value="{html.escape(r.name)}" size=50><br>
 <b>Description:</b> <textarea id="description" name="description" cols="50" rows="10">{html.escape(description)}</textarea>
 <br>
 <b>Labels:</b> <input type="text" id="labels" name="labels" value="{html.escape(labels_str)}" size=50><br>
 <b>Length:</b> {html.escape(length_str)}<br>
-<b>Activity:</b> {r.activity_type} <br>
+{elevation_str}<b>Activity:</b> {r.activity_type} <br>
 <span id="popup-edit">Edit</span>
 </p>
 </form>
@@ -404,38 +964,66 @@ $("#popup-edit").on("click", function(e) {{
     
     return
 
-  def update_info(self, route_name, name, description, labels):
-    r = self._route_dict[route_name]
+  @_mutating
+  def update_info(self, route_id, name, description, labels):
+    r = self._get(route_id)
     r.name = html.unescape(name)
     r.description = html.unescape(description)
     # print("\"" + r.description + "\"")
     r.labels = [l.strip()[1:] for l in labels.split(',')]
-    # print(route_name, name, description, labels)
+    self._search_index.update(route_id, r)
+    # print(route_id, name, description, labels)
     return
 
+  @_mutating
+  def replace_info(self, route_id, other):
+    """Copies everything but the geometry of other to the route."""
+    r = self._get(route_id)
+    r.name = other.name
+    r.description = other.description
+    r.labels = list(other.labels)
+    self._search_index.update(route_id, r)
+    r.activity_type = other.activity_type
+    r.line_style = copy.deepcopy(other.line_style)
+    self._set_style(route_id, color=f'#{r.line_style.color}', weight=max(r.line_style.width, 3.0))
+    if self._lazy_min_zoom is not None:
+      self._update_overview(route_id, static=False)
+      self._update_route_nodes(route_id)
+
   def wayback(self):
     self._js_commands += f"""
 bounds = {self._map.get_name()}.getBounds();
 window.open("https://livingatlas.arcgis.com/wayback/?ext="+bounds.getWest()+","+bounds.getNorth()+","+bounds.getEast()+","+bounds.getSouth());
 """
 
+  def publish(self, writer):
+    """Publishes a snapshot of the routes to a route_store.Writer, returns
+    its version. The map is only locked while the snapshot is collected,
+    not while it is written."""
+    with self._lock:
+      if writer.is_current(self):
+        return writer.version
+      items = self.items()
+      arrays, metadata = writer.collect(
+          items, self.revision, coordinates=[self._table.coordinates[route_id] for route_id, _ in items])
+    return writer.write(self, arrays, metadata)
+
+  @_locked
   def compute_stats(self, labels):
-    labels = [l.strip() for l in labels.split(',') if l.strip() != '']
+    labels = _parse_labels(labels)
     print(labels)
-    stats_dict = {}  # (length_m, num_segments)
-    for r in self._route_dict.values():
-      all_labels_match = True
-      for label in labels:
-        if label not in r.labels:
-          all_labels_match = False
-      if all_labels_match:
+    stats_dict = {}  # (length_m, num_segments, ascent_m, descent_m)
+    for route_id, r in self.items():
+      if _has_labels(r, labels):
         # print(r.activity_type, len(r.activity_type))
         activity = r.activity_type if len(r.activity_type) > 0 else 'unknown'
         # print(activity)
-        current_stats = stats_dict.get(activity, (0.0, 0))
-        stats_dict[activity] =  (current_stats[0] + r.length(), current_stats[1] + 1)
-        current_stats = stats_dict.get('total', (0.0, 0))
-        stats_dict['total'] =  (current_stats[0] + r.length(), current_stats[1] + 1)
+        length_m = float(self._table.length_m[route_id])
+        ascent_m, descent_m = self._table.elevation_gain[route_id].tolist()
+        for key in [activity, 'total']:
+          current_stats = stats_dict.get(key, (0.0, 0, 0.0, 0.0))
+          stats_dict[key] = (current_stats[0] + length_m, current_stats[1] + 1,
+                             current_stats[2] + ascent_m, current_stats[3] + descent_m)
     return stats_dict
 
 
@@ -461,8 +1049,11 @@ window.open("https://livingatlas.arcgis.com/wayback/?ext="+bounds.getWest()+","+
 
     for activity in activities:
       if activity not in stats_dict: continue
-      length_m, num_segments = stats_dict[activity]
-      summary_str += f"<b>{html.escape(activity)}</b>: {length_m/1000.0:.1f} km / {length_m*0.000621371:.1f} mi / {num_segments} segments <br>"
+      length_m, num_segments, ascent_m, descent_m = stats_dict[activity]
+      summary_str += f"<b>{html.escape(activity)}</b>: {length_m/1000.0:.1f} km / {length_m*0.000621371:.1f} mi / {num_segments} segments"
+      if self._dem is not None:
+        summary_str += f" / +{ascent_m:.0f} m -{descent_m:.0f} m"
+      summary_str += " <br>"
     labels = [l.strip() for l in labels.split(',') if l.strip() != '']
     labels_str = ' '.join(f'#{l}' for l in labels)
     self._js_commands += f"""
@@ -477,21 +1068,18 @@ var popup = L.popup()
     return
 
 
+  @_locked
   def enable_highlight(self, labels):
-    labels = [l.strip() for l in labels.split(',') if l.strip() != '']
-    stats_dict = {}  # (length_m, num_segments)
-    for route_name, r in self._route_dict.items():
-      all_labels_match = True
-      for label in labels:
-        if label not in r.labels:
-          all_labels_match = False
-      if all_labels_match:
-        self._js_commands += f"""{route_name}.setStyle({{weight: {r.line_style.width}, opacity: 1.0, dashArray: ''}});"""
+    labels = _parse_labels(labels)
+    for route_id, r in self.items():
+      if _has_labels(r, labels):
+        self._set_style(route_id, weight=r.line_style.width, opacity=1.0, dashArray='')
       else:
-        self._js_commands += f"""{route_name}.setStyle({{weight: {r.line_style.width * 0.5}, opacity: 0.8, dashArray: '10px'}});"""
+        self._set_style(route_id, weight=r.line_style.width * 0.5, opacity=0.8, dashArray='10px')
     return
 
 
+  @_locked
   def save(self, filename, selected_labels_str='', no_names=False, max_width=-1):
     # if os.path.exists(filename):
     #   pass
@@ -501,12 +1089,20 @@ var popup = L.popup()
       labels = [label.strip() for label in label_str.split(',') if label.strip()]
       return labels
     selected_labels = label_str_to_labels(selected_labels_str)
+    if filename.endswith('.gpkg'):
+      import geopackage
+      items = [(route_id, r) for route_id, r in self.items() if _has_labels(r, selected_labels)]
+      geopackage.write_routes(filename, [dataclasses.replace(r, id=route_id) for route_id, r in items],
+                              no_names=no_names, max_width=max_width,
+                              lengths=[float(self._table.length_m[route_id]) for route_id, _ in items])
+      return
 
+    import simplekml
     num_tracks = 0
     def _color_to_kml_color(color):
       return f'#ff{color[-2:]}{color[2:4]}{color[0:2]}'
     kml = simplekml.Kml()
-    for r in self._route_dict.values():
+    for route_id, r in self.items():
       skip = False
       for label in selected_labels:
         if label not in r.labels:
@@ -514,8 +1110,11 @@ var popup = L.popup()
       if skip:
         continue
       coords = [(c[1], c[0]) for c in r.points_as_list()]
+      if r.points and all(p.elevation is not None for p in r.points):
+        coords = [(p.lng, p.lat, p.elevation) for p in r.points]
       name = r.name + ' #'.join([''] + list(r.labels)) if not no_names else ''
       line = kml.newlinestring(name=name, coords=coords, description=r.description)
+      line.extendeddata.newdata(name='route_id', value=str(route_id))
       line.style.linestyle.color =  _color_to_kml_color(r.line_style.color) 
       width = r.line_style.width
       if max_width > 0:
@@ -0,0 +1,193 @@
+"""Runs pipelines of operations on the routes of a project, without the editor.
+
+Run:
+
+  python route_cli.py -input_kml alaska.kml nightly.txt
+  python route_cli.py -input_kml alaska.kml -op 'simplify max_distance=5' -op save
+
+The routes are loaded once into a headless RouteMap, which builds no folium
+nodes and no JS, then every operation runs in order: first the lines of the
+script files, then the -op flags. An operation is a name and key=value
+arguments, lines starting with # are comments:
+
+  add_label labels=s1a,primary search="brady glacier"
+  remove_label labels=primary where=s1a
+  label activity=trail where=s1a
+  remove where=obsolete
+  simplify max_distance=5 method=visvalingam_whyatt where=primary
+  split file=points.csv max_distance_m=20
+  split_junctions where=s1a tolerance_m=5
+  stats where=s1a
+  all_stats file=section_stats.csv
+  export file=s1a.gpkg where=s1a no_names=true max_width=4
+  save
+
+where selects the routes with all the comma separated labels and search the
+routes matching a full-text search, every route by default. split files
+have a lat,lng line for every split point, the closest route within
+max_distance_m is split there. save writes -input_kml, or file.
+"""
+
+import shlex
+import time
+
+from absl import app
+from absl import flags
+
+import loader
+import route
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_multi_string('op', [], 'Operation to run after the script files, can be repeated.')
+
+
+def select(route_map, args):
+  """Ids of the routes selected by the where and search arguments."""
+  route_ids = route_map.query(args.get('where', ''))
+  if 'search' in args:
+    matches = set(result['route_id'] for result in route_map.search(args['search'], limit=None))
+    route_ids = [route_id for route_id in route_ids if route_id in matches]
+  return route_ids
+
+
+def batch_operation(op, params_arg):
+  def run(route_map, args):
+    operations = [{'op': op, 'element': route_id, 'params': args[params_arg]}
+                  for route_id in select(route_map, args)]
+    return route_map.apply_batch(operations)
+  return run
+
+
+def split_at_points(route_map, args):
+  max_distance_m = float(args.get('max_distance_m', 20.0))
+  num_split = 0
+  with open(args['file']) as f:
+    for line in f:
+      line = line.strip()
+      if not line or line.startswith('#'):
+        continue
+      lat, lng = (float(value) for value in line.split(',')[:2])
+      latlng = route.LatLng(lat, lng)
+      route_id = route_map.nearest_route(latlng, max_distance_m)
+      if route_id is None:
+        print(f'No route within {max_distance_m} m of {lat}, {lng}, not split.')
+        continue
+      route_map.split_route(route_id, latlng)
+      num_split += 1
+  return num_split
+
+
+def print_stats(route_map, args):
+  stats_dict = route_map.compute_stats(args.get('where', ''))
+  for activity, (length_m, num_segments, ascent_m, descent_m) in sorted(stats_dict.items()):
+    print(f'{activity}: {length_m/1000.0:.1f} km / {length_m*0.000621371:.1f} mi / {num_segments} segments / '
+          f'+{ascent_m:.0f} m -{descent_m:.0f} m')
+  return stats_dict.get('total', (0.0, 0))[1]
+
+
+def write_all_stats(route_map, args):
+  with open(args.get('file', 'section_stats.csv'), 'w') as f:
+    f.write(route.section_stats_csv(route_map.compute_stats))
+
+
+def export(route_map, args):
+  route_map.save(args['file'], args.get('where', ''), no_names=args.get('no_names') == 'true',
+                 max_width=float(args.get('max_width', -1)))
+
+
+OPERATIONS = {
+    'add_label': batch_operation('add_label', 'labels'),
+    'remove_label': batch_operation('remove_label', 'labels'),
+    'label': batch_operation('label', 'activity'),
+    'remove': lambda route_map, args: route_map.apply_batch(
+        [{'op': 'remove', 'element': route_id} for route_id in select(route_map, args)]),
+    'simplify': lambda route_map, args: route_map.simplify_all(
+        args.get('where', ''), float(args.get('max_distance', 5.0)), args.get('method', 'douglas_peucker')),
+    'split': split_at_points,
+    'split_junctions': lambda route_map, args: route_map.split_at_junctions(
+        args.get('where', ''), float(args.get('tolerance_m', 5.0))),
+    'stats': print_stats,
+    'all_stats': write_all_stats,
+    'export': export,
+    'save': lambda route_map, args: route_map.save(args.get('file', FLAGS.input_kml)),
+}
+
+
+# (required, optional) arguments of every operation.
+SELECT_ARGS = ('where', 'search')
+ARGUMENTS = {
+    'add_label': (('labels',), SELECT_ARGS),
+    'remove_label': (('labels',), SELECT_ARGS),
+    'label': (('activity',), SELECT_ARGS),
+    'remove': ((), SELECT_ARGS),
+    'simplify': ((), ('where', 'max_distance', 'method')),
+    'split': (('file',), ('max_distance_m',)),
+    'split_junctions': ((), ('where', 'tolerance_m')),
+    'stats': ((), ('where',)),
+    'all_stats': ((), ('file',)),
+    'export': (('file',), ('where', 'no_names', 'max_width')),
+    'save': ((), ('file',)),
+}
+
+
+def parse_operation(text):
+  """(name, {key: value}) of an operation line, None for comments. Raises
+  ValueError for unknown operations and missing or unknown arguments."""
+  tokens = shlex.split(text, comments=True)
+  if not tokens:
+    return None
+  name, args = tokens[0], {}
+  if name not in OPERATIONS:
+    raise ValueError(f'Unknown operation: {name}')
+  for token in tokens[1:]:
+    if '=' not in token:
+      raise ValueError(f'Arguments are key=value: {token}')
+    key, value = token.split('=', 1)
+    args[key] = value
+  required, optional = ARGUMENTS[name]
+  missing = [key for key in required if key not in args]
+  if missing:
+    raise ValueError(f'{name} needs {", ".join(missing)}')
+  unknown = [key for key in args if key not in required and key not in optional]
+  if unknown:
+    raise ValueError(f'{name} takes no {", ".join(unknown)}, only {", ".join(required + optional)}')
+  return name, args
+
+
+def main(argv):
+  if not FLAGS.input_kml:
+    raise app.UsageError('Pass -input_kml.')
+  # Every operation is parsed before any runs, a typo doesn't leave a half
+  # processed project.
+  operations = []
+  for script in argv[1:]:
+    with open(script) as f:
+      for line_number, line in enumerate(f, 1):
+        try:
+          operation = parse_operation(line)
+        except ValueError as e:
+          raise app.UsageError(f'{script}:{line_number}: {e}')
+        if operation is not None:
+          operations.append(operation)
+  for text in FLAGS.op:
+    try:
+      operation = parse_operation(text)
+    except ValueError as e:
+      raise app.UsageError(f'-op {text}: {e}')
+    if operation is not None:
+      operations.append(operation)
+
+  start = time.perf_counter()
+  route_map = route.RouteMap(dem=loader.load_dem(), headless=True)
+  loader.load_routes(route_map, input_kml=FLAGS.input_kml)
+  print(f'Loaded {len(route_map.items())} routes in {time.perf_counter() - start:.2f} s.')
+  for name, args in operations:
+    start = time.perf_counter()
+    result = OPERATIONS[name](route_map, args)
+    result_str = f' -> {result}' if result is not None else ''
+    print(f'{name} {args}{result_str} in {time.perf_counter() - start:.2f} s.')
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,27 @@
+from absl.testing import absltest
+
+import route_cli
+
+
+class ParseOperationTest(absltest.TestCase):
+
+  def test_every_operation_declares_its_arguments(self):
+    self.assertEqual(set(route_cli.ARGUMENTS), set(route_cli.OPERATIONS))
+
+  def test_parses_quoted_arguments(self):
+    self.assertEqual(route_cli.parse_operation('add_label labels=s1a search="brady glacier"'),
+                     ('add_label', {'labels': 's1a', 'search': 'brady glacier'}))
+    self.assertIsNone(route_cli.parse_operation('# save'))
+
+  def test_rejects_missing_arguments(self):
+    with self.assertRaisesRegex(ValueError, 'needs file'):
+      route_cli.parse_operation('export where=s1a')
+
+  def test_rejects_unused_arguments(self):
+    for text in ('simplify search=x', 'split_junctions search=x', 'stats search=x', 'export file=a.gpkg search=x'):
+      with self.assertRaisesRegex(ValueError, 'takes no search'):
+        route_cli.parse_operation(text)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,172 @@
+"""Diffs the routes of two KML files or git revisions of a KML file.
+
+Run:
+
+  python route_diff.py old.kml new.kml
+  python route_diff.py alaska.kml@HEAD~1 alaska.kml
+
+where file@revision is the file at a git revision.
+
+Routes are matched by their saved route id, and the routes without one by
+the hash of their geometry.
+"""
+
+import collections
+import dataclasses
+import os
+import subprocess
+from typing import List, Optional, Text, Tuple
+
+from absl import app
+
+import geopackage
+import kml_parser
+import loader
+import route
+import route_table
+
+@dataclasses.dataclass(frozen=True)
+class Signature:
+  """What the diff compares of a route, small enough to keep for every route."""
+  id: Optional[int]
+  geometry: Text
+  name: Text
+  description: Text
+  color: Text
+  width: float
+
+
+def signature(r, route_id=None):
+  # kml routes have their labels in the name, GeoPackage routes in labels.
+  name = r.name + ' #'.join([''] + list(r.labels))
+  return Signature(id=r.id if route_id is None else route_id, geometry=route_table.geometry_hash(r), name=name,
+                   description=r.description or '', color=r.line_style.color, width=r.line_style.width)
+
+
+@dataclasses.dataclass
+class RouteDiff:
+  added: List[route.Route] = dataclasses.field(default_factory=list)
+  removed: List[Signature] = dataclasses.field(default_factory=list)
+  # (old, new) pairs, modified routes have a new geometry and relabeled
+  # routes the same geometry but a new name, description or style.
+  modified: List[Tuple[Signature, route.Route]] = dataclasses.field(default_factory=list)
+  relabeled: List[Tuple[Signature, route.Route]] = dataclasses.field(default_factory=list)
+  num_unchanged: int = 0
+
+  def summary(self):
+    return {'added': len(self.added), 'removed': len(self.removed), 'modified': len(self.modified),
+            'relabeled': len(self.relabeled), 'unchanged': self.num_unchanged}
+
+
+def diff_routes(old_signatures, new_routes):
+  """Diffs the signatures of the old routes against the new routes.
+
+  The new routes matched to an old route get its id.
+  """
+  new_signatures = [signature(r) for r in new_routes]
+  old_by_id = {s.id: s for s in old_signatures if s.id is not None}
+  matched = set()
+  pairs = []
+  unmatched_new = []
+  for r, s in zip(new_routes, new_signatures):
+    old = old_by_id.get(s.id) if s.id is not None else None
+    if old is not None and old.id not in matched:
+      matched.add(old.id)
+      pairs.append((old, r, s))
+    else:
+      unmatched_new.append((r, s))
+
+  # Routes without a known id are matched by geometry.
+  old_by_geometry = collections.defaultdict(list)
+  for old in old_signatures:
+    if old.id is None or old.id not in matched:
+      old_by_geometry[old.geometry].append(old)
+  diff = RouteDiff()
+  for r, s in unmatched_new:
+    candidates = old_by_geometry.get(s.geometry)
+    if candidates:
+      pairs.append((candidates.pop(0), r, s))
+    else:
+      diff.added.append(r)
+  diff.removed = [old for candidates in old_by_geometry.values() for old in candidates]
+
+  for old, r, s in pairs:
+    r.id = old.id
+    if old.geometry != s.geometry:
+      diff.modified.append((old, r))
+    elif (old.name, old.description, old.color, old.width) != (s.name, s.description, s.color, s.width):
+      diff.relabeled.append((old, r))
+    else:
+      diff.num_unchanged += 1
+  return diff
+
+
+def read_revision(kml_file, revision):
+  """Contents of kml_file at a git revision."""
+  directory = os.path.dirname(os.path.abspath(kml_file))
+  return subprocess.check_output(['git', 'show', f'{revision}:./{os.path.basename(kml_file)}'], cwd=directory)
+
+
+def parse_revision(kml_file, revision=None):
+  """Routes of kml_file, or a GeoPackage, at a git revision, or of the file
+  when revision is None."""
+  if revision is None:
+    return loader.parse_routes(kml_file)
+  if kml_file.endswith('.gpkg'):
+    return geopackage.parse_gpkg_string(read_revision(kml_file, revision))
+  return kml_parser.parse_kml_string(read_revision(kml_file, revision))
+
+
+def apply_diff(route_map, diff, markers=True):
+  """Applies the diff to a map whose route ids are the ids of the old
+  signatures, the added routes get the id they are added with.
+
+  Routes removed from the map since the old signatures stay removed. The
+  pieces split off a route since then are removed with it when it is
+  removed or modified, the new version replaces all of them, and get its
+  new info when it is relabeled.
+  """
+  def remove_with_pieces(route_id):
+    for piece_id in route_map.split_pieces(route_id):
+      route_map.remove_route(piece_id)
+    if route_id in route_map:
+      route_map.remove_route(route_id)
+
+  with route_map.batch():
+    for old in diff.removed:
+      remove_with_pieces(old.id)
+    for old, r in diff.modified:
+      if old.id in route_map:
+        remove_with_pieces(old.id)
+        r.id = loader.import_route(route_map, r, markers=markers)
+      else:
+        r.id = None
+    for old, r in diff.relabeled:
+      if old.id in route_map:
+        normalized = loader.normalize_route(r)
+        for route_id in [old.id] + route_map.split_pieces(old.id):
+          route_map.replace_info(route_id, normalized)
+      else:
+        r.id = None
+    for r in diff.added:
+      r.id = loader.import_route(route_map, r, markers=markers)
+
+
+def main(argv):
+  if len(argv) != 3:
+    raise app.UsageError('Pass the old and new kml files, as file or file@revision.')
+  old_routes, new_routes = [parse_revision(*arg.split('@', 1)) for arg in argv[1:]]
+  diff = diff_routes([signature(r) for r in old_routes], new_routes)
+  for r in diff.added:
+    print(f'added: {r.name}')
+  for old in diff.removed:
+    print(f'removed: {old.name}')
+  for old, r in diff.modified:
+    print(f'modified: {r.name}')
+  for old, r in diff.relabeled:
+    print(f'relabeled: {old.name} -> {r.name}')
+  print(', '.join(f'{count} {kind}' for kind, count in diff.summary().items()))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,60 @@
+import copy
+import os
+
+from absl.testing import absltest
+
+import geopackage
+import route
+import route_diff
+
+
+def _route(name, lats, route_id=None, lng=-150.0):
+  return route.Route(name=name, points=[route.LatLng(lat, lng) for lat in lats], labels=[], id=route_id)
+
+
+def _old_routes():
+  return [_route('same', [60.0, 60.1], 1), _route('moved', [61.0, 61.1], 2), _route('renamed', [62.0, 62.1], 3),
+          _route('gone', [63.0, 63.1], 4), _route('no id', [64.0, 64.1])]
+
+
+class RouteDiffTest(absltest.TestCase):
+
+  def test_diff_routes(self):
+    old_signatures = [route_diff.signature(r) for r in _old_routes()]
+    new_routes = [_route('same', [60.0, 60.1], 1), _route('moved', [61.0, 61.2], 2),
+                  _route('new name', [62.0, 62.1], 3), _route('no id', [64.0, 64.1]),
+                  _route('added', [65.0, 65.1])]
+    diff = route_diff.diff_routes(old_signatures, new_routes)
+    self.assertEqual(diff.summary(), {'added': 1, 'removed': 1, 'modified': 1, 'relabeled': 1, 'unchanged': 2})
+    self.assertEqual([r.name for r in diff.added], ['added'])
+    self.assertEqual([s.id for s in diff.removed], [4])
+    self.assertEqual([(s.id, r.id) for s, r in diff.modified], [(2, 2)])
+    self.assertEqual([(s.name, r.name) for s, r in diff.relabeled], [('renamed', 'new name')])
+
+  def test_geopackage_round_trip_is_unchanged(self):
+    filename = os.path.join(absltest.get_default_test_tmpdir(), 'routes.gpkg')
+    old_routes = _old_routes()
+    geopackage.write_routes(filename, old_routes)
+    diff = route_diff.diff_routes([route_diff.signature(r) for r in old_routes], geopackage.parse_gpkg(filename))
+    self.assertEqual(diff.summary(), {'added': 0, 'removed': 0, 'modified': 0, 'relabeled': 0, 'unchanged': 5})
+
+  def test_apply_diff_replaces_the_split_pieces(self):
+    route_map = route.RouteMap(headless=True)
+    for r in _old_routes():
+      route_map.add_route(copy.deepcopy(r))
+    old_signatures = [route_diff.signature(r, route_id) for route_id, r in route_map.items()]
+    route_id = next(route_id for route_id, r in route_map.items() if r.name == 'moved')
+    route_map.split_route(route_id, route.LatLng(61.05, -150.0))
+    self.assertLen(route_map.split_pieces(route_id), 1)
+
+    new_routes = [_route('moved', [61.0, 61.2], route_id)]
+    diff = route_diff.diff_routes([s for s in old_signatures if s.id == route_id], new_routes)
+    route_diff.apply_diff(route_map, diff, markers=False)
+    moved = [r for _, r in route_map.items() if r.name.startswith('moved')]
+    self.assertLen(moved, 1)
+    self.assertAlmostEqual(moved[0].points[-1].lat, 61.2)
+    self.assertLen(route_map.items(), 5)
+
+
+if __name__ == '__main__':
+  absltest.main()
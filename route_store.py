@@ -0,0 +1,267 @@
+"""Versioned snapshots of the routes, shared by several server processes.
+
+The editor process owns the RouteMap and is the only writer: it publishes a
+new snapshot after every change. A snapshot is a directory of flat numpy
+arrays and a json metadata table:
+
+  points.npy: (num_vertices, 3) lat, lng and elevation, NaN if unknown.
+  offsets.npy: (num_routes + 1,) first vertex of every route.
+  route_ids.npy: (num_routes,) RouteMap id of every route.
+  widths.npy: (num_routes,) line width of every route.
+  metadata.json: name, description, labels, activity_type and color columns.
+
+Readers memory-map the arrays, so any number of worker processes share one
+copy of the coordinates through the page cache. Snapshots are written to a
+temporary directory and renamed, then CURRENT is replaced to point to the new
+one, so a reader never sees a partial snapshot.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+import metrics
+import route
+import route_table
+
+CURRENT = 'CURRENT'
+# Old snapshots are kept for the readers still using them.
+NUM_KEPT_VERSIONS = 3
+
+
+def _version_dir(version):
+  return f'v{version:08d}'
+
+
+def current_version(store_dir):
+  """Version CURRENT points to, 0 if nothing was published."""
+  try:
+    with open(os.path.join(store_dir, CURRENT)) as f:
+      return int(f.read().strip() or 0)
+  except FileNotFoundError:
+    return 0
+
+
+class Writer:
+  """Publishes snapshots of a RouteMap, see RouteMap.publish()."""
+
+  def __init__(self, store_dir):
+    self._store_dir = store_dir
+    os.makedirs(store_dir, exist_ok=True)
+    self.version = current_version(store_dir)
+    # (map, revision) of the last snapshot, publishing it again is a no-op.
+    self._published = None
+    self._lock = threading.Lock()
+
+  def is_current(self, route_map):
+    return self._published == (id(route_map), route_map.revision)
+
+  def collect(self, items, revision, coordinates=None):
+    """Arrays and metadata of the snapshot of the (route_id, route) items at
+    revision, in memory. coordinates are the (n, 3) vertices of the items if
+    known, see route_table.RouteTable."""
+    lengths = np.array([len(r.points) for _, r in items], dtype=np.int64)
+    if coordinates is None:
+      points = np.array([[p.lat, p.lng, np.nan if p.elevation is None else p.elevation]
+                         for _, r in items for p in r.points], dtype=np.float64).reshape(-1, 3)
+    else:
+      points = np.concatenate([np.zeros((0, 3))] + [c for c in coordinates if c is not None])
+    arrays = {
+        'points': points,
+        'offsets': np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+        'route_ids': np.array([route_id for route_id, _ in items], dtype=np.int64),
+        'widths': np.array([r.line_style.width for _, r in items], dtype=np.float64),
+    }
+    metadata = {
+        'revision': revision,
+        'name': [r.name for _, r in items],
+        'description': [r.description or '' for _, r in items],
+        'labels': [list(r.labels) for _, r in items],
+        'activity_type': [r.activity_type for _, r in items],
+        'color': [r.line_style.color for _, r in items],
+    }
+    return arrays, metadata
+
+  def publish(self, route_map, items, revision, coordinates=None):
+    """Writes the (route_id, route) items of route_map at revision as the next
+    version. Returns the version."""
+    if self._published == (id(route_map), revision):
+      return self.version
+    return self.write(route_map, *self.collect(items, revision, coordinates))
+
+  @metrics.timed('publish_snapshot')
+  def write(self, route_map, arrays, metadata):
+    """Writes collect() arrays and metadata of route_map as the next version.
+    Returns the version."""
+    with self._lock:
+      revision = metadata['revision']
+      if self._published == (id(route_map), revision):
+        return self.version
+      version = self.version + 1
+      tmp_dir = tempfile.mkdtemp(prefix='.tmp', dir=self._store_dir)
+      for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, f'{name}.npy'), array)
+      with open(os.path.join(tmp_dir, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f)
+      os.rename(tmp_dir, os.path.join(self._store_dir, _version_dir(version)))
+      current_tmp = os.path.join(self._store_dir, f'.{CURRENT}.tmp')
+      with open(current_tmp, 'w') as f:
+        f.write(f'{version}\n')
+      os.replace(current_tmp, os.path.join(self._store_dir, CURRENT))
+      self.version = version
+      self._published = (id(route_map), revision)
+
+      # Readers that still map the removed files keep them until they unmap.
+      for old_version in range(version - NUM_KEPT_VERSIONS, 0, -1):
+        old_dir = os.path.join(self._store_dir, _version_dir(old_version))
+        if not os.path.isdir(old_dir):
+          break
+        shutil.rmtree(old_dir, ignore_errors=True)
+    print(f'Published route snapshot {version} with {len(arrays["route_ids"])} routes.')
+    return version
+
+
+class Publisher:
+  """Publishes a RouteMap from a background thread, so requests don't wait
+  for the snapshot to be written. Changes made while a snapshot is written
+  are published together in the next one."""
+
+  def __init__(self, writer):
+    self._writer = writer
+    self._route_map = None
+    self._requested = threading.Event()
+    threading.Thread(target=self._run, daemon=True).start()
+
+  def request(self, route_map):
+    self._route_map = route_map
+    self._requested.set()
+
+  def _run(self):
+    while True:
+      self._requested.wait()
+      self._requested.clear()
+      route_map = self._route_map
+      try:
+        route_map.publish(self._writer)
+      except OSError as e:
+        print(f'Failed to publish a route snapshot: {e}')
+
+
+class Snapshot:
+  """A published version of the routes, with the arrays memory-mapped."""
+
+  def __init__(self, path, version):
+    self.version = version
+    self.points = np.load(os.path.join(path, 'points.npy'), mmap_mode='r')
+    self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+    self.route_ids = np.load(os.path.join(path, 'route_ids.npy'), mmap_mode='r')
+    self.widths = np.load(os.path.join(path, 'widths.npy'), mmap_mode='r')
+    with open(os.path.join(path, 'metadata.json')) as f:
+      self.metadata = json.load(f)
+    self.revision = self.metadata['revision']
+    self._index = {route_id: i for i, route_id in enumerate(self.route_ids.tolist())}
+    # Derived columns, computed on first use.
+    self._lengths = None
+    self._elevation_gains = None
+
+  def __len__(self):
+    return len(self.route_ids)
+
+  def __contains__(self, route_id):
+    return route_id in self._index
+
+  def coordinates(self, route_id):
+    """(n, 3) lat, lng, elevation view of a route, without copying."""
+    i = self._index[route_id]
+    return self.points[self.offsets[i]:self.offsets[i + 1]]
+
+  def get(self, route_id):
+    """The route as a route.Route."""
+    i = self._index[route_id]
+    return route.Route(
+        name=self.metadata['name'][i], description=self.metadata['description'][i],
+        labels=list(self.metadata['labels'][i]), activity_type=self.metadata['activity_type'][i],
+        line_style=route.LineStyle(color=self.metadata['color'][i], width=float(self.widths[i])),
+        points=[route.LatLng(lat, lng, None if np.isnan(elevation) else elevation)
+                for lat, lng, elevation in self.coordinates(route_id).tolist()],
+        id=route_id)
+
+  def query(self, labels):
+    """Ids of the routes having all the comma separated labels."""
+    labels = route._parse_labels(labels)
+    return [route_id for route_id, route_labels in zip(self.route_ids.tolist(), self.metadata['labels'])
+            if all(label in route_labels for label in labels)]
+
+  def _owners(self):
+    """Index of the route of every vertex."""
+    return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+  def lengths(self):
+    """Length in meters of every route, like Route.length()."""
+    if self._lengths is None:
+      owner = self._owners()
+      within = owner[1:] == owner[:-1]
+      self._lengths = np.bincount(owner[1:][within], weights=route_table.segment_lengths(self.points[:, :2])[within],
+                                  minlength=len(self))
+    return self._lengths
+
+  def elevation_gains(self):
+    """(num_routes, 2) ascent and descent of every route, like
+    Route.elevation_gain()."""
+    if self._elevation_gains is None:
+      valid = ~np.isnan(self.points[:, 2])
+      owner = self._owners()[valid]
+      diffs = np.diff(self.points[valid, 2])
+      within = owner[1:] == owner[:-1]
+      diffs, owner = diffs[within], owner[1:][within]
+      self._elevation_gains = np.stack([
+          np.bincount(owner, weights=np.maximum(diffs, 0.0), minlength=len(self)),
+          np.bincount(owner, weights=np.maximum(-diffs, 0.0), minlength=len(self))], axis=1)
+    return self._elevation_gains
+
+  @metrics.timed('snapshot_compute_stats')
+  def compute_stats(self, labels):
+    """Same as RouteMap.compute_stats(), computed on the arrays."""
+    lengths, gains = self.lengths(), self.elevation_gains()
+    stats_dict = {}  # (length_m, num_segments, ascent_m, descent_m)
+    for route_id in self.query(labels):
+      i = self._index[route_id]
+      activity = self.metadata['activity_type'][i] or 'unknown'
+      for key in [activity, 'total']:
+        current_stats = stats_dict.get(key, (0.0, 0, 0.0, 0.0))
+        stats_dict[key] = (current_stats[0] + float(lengths[i]), current_stats[1] + 1,
+                           current_stats[2] + float(gains[i, 0]), current_stats[3] + float(gains[i, 1]))
+    return stats_dict
+
+
+class Reader:
+  """Latest snapshot of a store, reopened when the writer publishes a new one."""
+
+  def __init__(self, store_dir):
+    self._store_dir = store_dir
+    self._snapshot = None
+
+  def snapshot(self):
+    """The latest Snapshot, None if nothing was published yet. The last good
+    one if CURRENT names a snapshot that can't be opened."""
+    failed_version = None
+    while True:
+      version = current_version(self._store_dir)
+      if not version or (self._snapshot is not None and self._snapshot.version == version):
+        return self._snapshot
+      if version == failed_version:
+        # Removed by hand, or the writer crashed: retrying won't help until
+        # the next version is published.
+        print(f'Route snapshot {version} is missing, serving the last good one.')
+        return self._snapshot
+      try:
+        self._snapshot = Snapshot(os.path.join(self._store_dir, _version_dir(version)), version)
+        return self._snapshot
+      except FileNotFoundError:
+        # Removed by the writer after several newer versions, retry with the
+        # latest.
+        failed_version = version
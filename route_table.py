@@ -0,0 +1,112 @@
+"""Columns of the attributes derived from the geometry of every route.
+
+RouteMap keeps one row per route id, computed when the route is added or its
+vertices change, so that fitting the map, stats, duplicate checks and
+exports never go through the vertices of every route again. Removed routes
+have NaN rows and no vertices.
+"""
+
+import hashlib
+
+import gpxpy.geo
+import numpy as np
+
+
+def geometry_hash(r):
+  """Hash of the vertices of a route, rounded to 1e-7 degrees."""
+  coords = np.array([[p.lat, p.lng, np.nan if p.elevation is None else p.elevation] for p in r.points],
+                    dtype=np.float64).reshape(-1, 3)
+  coords[:, :2] = np.round(coords[:, :2] * 1e7)
+  coords[:, 2] = np.round(coords[:, 2] * 10)
+  return hashlib.sha1(coords.tobytes()).hexdigest()
+
+
+def segment_lengths(latlngs):
+  """gpxpy.geo.distance between consecutive rows of (n, 2) latlngs, so the
+  lengths match Route.length()."""
+  # Route.length() measures from every vertex to the previous one.
+  lat1, lng1 = latlngs[1:, 0], latlngs[1:, 1]
+  lat2, lng2 = latlngs[:-1, 0], latlngs[:-1, 1]
+  flat = np.hypot(lat1 - lat2, (lng1 - lng2) * np.cos(np.radians(lat1))) * gpxpy.geo.ONE_DEGREE
+  dlat, dlng = np.radians(lat1 - lat2), np.radians(lng1 - lng2)
+  a = np.sin(dlat / 2) ** 2 + np.sin(dlng / 2) ** 2 * np.cos(np.radians(lat1)) * np.cos(np.radians(lat2))
+  haversine = 2 * gpxpy.geo.EARTH_RADIUS * np.arcsin(np.sqrt(a))
+  # gpxpy only uses haversine for distant points.
+  distant = (np.abs(lat1 - lat2) > 0.2) | (np.abs(lng1 - lng2) > 0.2)
+  return np.where(distant, haversine, flat)
+
+
+class RouteTable:
+
+  def __init__(self, capacity=64):
+    # (south, west, north, east).
+    self.bounds = np.full((capacity, 4), np.nan)
+    # (lat, lng) of the first and last vertices, and the length weighted
+    # center of the segments.
+    self.start = np.full((capacity, 2), np.nan)
+    self.end = np.full((capacity, 2), np.nan)
+    self.centroid = np.full((capacity, 2), np.nan)
+    self.length_m = np.full(capacity, np.nan)
+    # (ascent_m, descent_m), like Route.elevation_gain().
+    self.elevation_gain = np.full((capacity, 2), np.nan)
+    self.num_vertices = np.zeros(capacity, dtype=np.int64)
+    self.geometry_hash = [None] * capacity
+    # (n, 3) lat, lng and elevation of the vertices, NaN if unknown, as
+    # published by route_store.
+    self.coordinates = [None] * capacity
+
+  def __len__(self):
+    return len(self.length_m)
+
+  def _grow(self, size):
+    for name in ('bounds', 'start', 'end', 'centroid', 'length_m', 'elevation_gain', 'num_vertices'):
+      column = getattr(self, name)
+      grown = np.full((size,) + column.shape[1:], np.nan if column.dtype.kind == 'f' else 0, dtype=column.dtype)
+      grown[:len(column)] = column
+      setattr(self, name, grown)
+    self.geometry_hash.extend([None] * (size - len(self.geometry_hash)))
+    self.coordinates.extend([None] * (size - len(self.coordinates)))
+
+  def update(self, route_id, r):
+    """Computes the row of a route, after it was added or its vertices changed."""
+    if route_id >= len(self):
+      self._grow(max(2 * len(self), route_id + 1))
+    if not r.points:
+      self.remove(route_id)
+      return
+    coordinates = np.array([[p.lat, p.lng, np.nan if p.elevation is None else p.elevation] for p in r.points],
+                           dtype=np.float64).reshape(-1, 3)
+    latlngs = coordinates[:, :2]
+    lengths = segment_lengths(latlngs)
+    self.bounds[route_id] = np.concatenate([latlngs.min(axis=0), latlngs.max(axis=0)])
+    self.start[route_id], self.end[route_id] = latlngs[0], latlngs[-1]
+    if lengths.sum() > 0.0:
+      self.centroid[route_id] = (lengths[:, None] * 0.5 * (latlngs[1:] + latlngs[:-1])).sum(axis=0) / lengths.sum()
+    else:
+      self.centroid[route_id] = latlngs.mean(axis=0)
+    self.length_m[route_id] = lengths.sum()
+    self.elevation_gain[route_id] = r.elevation_gain()
+    self.num_vertices[route_id] = len(latlngs)
+    self.geometry_hash[route_id] = geometry_hash(r)
+    self.coordinates[route_id] = coordinates
+
+  def remove(self, route_id):
+    if route_id >= len(self):
+      return
+    for column in (self.bounds, self.start, self.end, self.centroid, self.length_m, self.elevation_gain):
+      column[route_id] = np.nan
+    self.num_vertices[route_id] = 0
+    self.geometry_hash[route_id] = None
+    self.coordinates[route_id] = None
+
+  def duplicate_candidates(self, r, num_routes):
+    """Ids below num_routes of the routes that may be duplicates of r: the
+    same number of vertices and endpoints within about a meter."""
+    if not r.points:
+      return []
+    start = np.array([r.points[0].lat, r.points[0].lng])
+    end = np.array([r.points[-1].lat, r.points[-1].lng])
+    candidates = ((self.num_vertices[:num_routes] == len(r.points)) &
+                  (np.abs(self.start[:num_routes] - start).max(axis=1) < 1e-5) &
+                  (np.abs(self.end[:num_routes] - end).max(axis=1) < 1e-5))
+    return candidates.nonzero()[0].tolist()
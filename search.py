@@ -0,0 +1,138 @@
+"""In-memory full-text index of the route names, descriptions and labels.
+
+A query matches the routes containing all its terms. A term matches a word
+exactly, as the prefix of a word, or as a typo: words within one edit of the
+term, found with an index of the words with one character deleted, so no
+word is compared to the term unless they share a deletion.
+"""
+
+import bisect
+import collections
+import itertools
+import re
+
+# Weight of a word in every field of a route.
+FIELD_WEIGHTS = {'name': 3.0, 'labels': 2.0, 'description': 1.0}
+# Weight of the exact, prefix and fuzzy matches of a term.
+PREFIX_WEIGHT = 0.6
+FUZZY_WEIGHT = 0.4
+# Shorter terms only match exactly or as prefixes, too many words are one
+# edit away from them.
+MIN_FUZZY_LENGTH = 4
+
+_WORD = re.compile(r'\w+')
+
+
+def tokenize(text):
+  return _WORD.findall((text or '').lower())
+
+
+def _route_words(r):
+  """{word: weight} of a route, a word keeps the weight of its best field."""
+  words = {}
+  fields = (('name', tokenize(r.name)), ('description', tokenize(r.description)),
+            ('labels', [label.lower() for label in r.labels] + tokenize(' '.join(r.labels))))
+  for field, tokens in fields:
+    for token in tokens:
+      words[token] = max(words.get(token, 0.0), FIELD_WEIGHTS[field])
+  return words
+
+
+def _deletions(word):
+  return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+
+def _edit_distance_at_most_one(a, b):
+  """Whether a and b are equal or one insertion, deletion, substitution or
+  transposition apart."""
+  if abs(len(a) - len(b)) > 1:
+    return False
+  i = 0
+  while i < min(len(a), len(b)) and a[i] == b[i]:
+    i += 1
+  if len(a) == len(b):
+    return a[i + 1:] == b[i + 1:] or (a[i:i + 2] == b[i:i + 2][::-1] and a[i + 2:] == b[i + 2:])
+  if len(a) > len(b):
+    a, b = b, a
+  return a[i:] == b[i + 1:]
+
+
+class SearchIndex:
+
+  def __init__(self):
+    # {word: {route_id: weight}}.
+    self._postings = collections.defaultdict(dict)
+    self._route_words = {}
+    # Deletion of a word to the words it comes from, for the fuzzy matches.
+    self._deletion_words = collections.defaultdict(set)
+    # Sorted words for the prefix matches, rebuilt when words were added.
+    self._sorted_words = []
+    self._sorted = True
+
+  def __len__(self):
+    return len(self._route_words)
+
+  def update(self, route_id, r):
+    """Indexes the route, replacing what was indexed for route_id."""
+    self.remove(route_id)
+    words = _route_words(r)
+    self._route_words[route_id] = words
+    for word, weight in words.items():
+      if word not in self._postings:
+        self._sorted = False
+        for deletion in _deletions(word):
+          self._deletion_words[deletion].add(word)
+      self._postings[word][route_id] = weight
+
+  def remove(self, route_id):
+    for word in self._route_words.pop(route_id, {}):
+      postings = self._postings[word]
+      del postings[route_id]
+      if not postings:
+        del self._postings[word]
+        self._sorted = False
+        for deletion in _deletions(word):
+          self._deletion_words[deletion].discard(word)
+          if not self._deletion_words[deletion]:
+            del self._deletion_words[deletion]
+
+  def _term_matches(self, term):
+    """{word: weight} of the words matching a query term."""
+    if not self._sorted:
+      self._sorted_words = sorted(self._postings)
+      self._sorted = True
+    matches = {}
+    start = bisect.bisect_left(self._sorted_words, term)
+    for word in itertools.islice(self._sorted_words, start, None):
+      if not word.startswith(term):
+        break
+      matches[word] = 1.0 if word == term else PREFIX_WEIGHT
+    if len(term) >= MIN_FUZZY_LENGTH:
+      candidates = set(self._deletion_words.get(term, ()))
+      for deletion in _deletions(term) | {term}:
+        if deletion in self._postings:
+          candidates.add(deletion)
+        candidates.update(self._deletion_words.get(deletion, ()))
+      for word in candidates:
+        if word not in matches and _edit_distance_at_most_one(term, word):
+          matches[word] = FUZZY_WEIGHT
+    return matches
+
+  def search(self, query, limit=None):
+    """(route_id, score) of the routes matching every term of the query, best
+    first."""
+    scores = None
+    for term in tokenize(query):
+      term_scores = collections.defaultdict(float)
+      for word, match_weight in self._term_matches(term).items():
+        for route_id, weight in self._postings[word].items():
+          term_scores[route_id] = max(term_scores[route_id], match_weight * weight)
+      if scores is None:
+        scores = term_scores
+      else:
+        scores = {route_id: score + term_scores[route_id] for route_id, score in scores.items()
+                  if route_id in term_scores}
+      if not scores:
+        return []
+    results = sorted((scores or {}).items(), key=lambda item: (-item[1], item[0]))
+    return results[:limit] if limit else results
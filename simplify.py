@@ -0,0 +1,159 @@
+"""Polyline simplification in local metric coordinates.
+
+Both simplifiers return a boolean mask of the vertices to keep. The first and
+last vertices, and the vertices in keep, are never removed, so the endpoints
+shared by adjacent segments of a split route never move.
+"""
+
+import heapq
+
+import gpxpy.geo
+import numpy as np
+
+METHODS = ('douglas_peucker', 'visvalingam_whyatt')
+
+
+def local_xy(latlngs, lat0=None):
+  """Projects (n, 2) lat/lng degrees to meters, equirectangular around lat0,
+  their mean latitude by default. lat0 may be given for every vertex."""
+  latlngs = np.asarray(latlngs, dtype=np.float64).reshape(-1, 2)
+  if len(latlngs) == 0:
+    return latlngs
+  if lat0 is None:
+    lat0 = latlngs[:, 0].mean()
+  radians = np.radians(latlngs)
+  return np.stack([radians[:, 1] * np.cos(np.radians(lat0)), radians[:, 0]], axis=1) * gpxpy.geo.EARTH_RADIUS
+
+
+def latlng_from_xy(xy, lat0):
+  """Inverse of local_xy projected around lat0."""
+  radians = np.asarray(xy, dtype=np.float64).reshape(-1, 2) / gpxpy.geo.EARTH_RADIUS
+  return np.degrees(np.stack([radians[:, 1], radians[:, 0] / np.cos(np.radians(lat0))], axis=1))
+
+
+def split_segments(a, b, max_length):
+  """Splits the segments from a to b longer than max_length into equal
+  pieces. Returns the (a, b) of the pieces and the segment of every piece."""
+  num_pieces = np.maximum(np.ceil(np.hypot(*(b - a).T) / max_length), 1).astype(np.int64)
+  segment = np.repeat(np.arange(len(a)), num_pieces)
+  piece = np.arange(len(segment)) - np.repeat(np.cumsum(num_pieces) - num_pieces, num_pieces)
+  ab = b[segment] - a[segment]
+  t0 = piece / num_pieces[segment]
+  t1 = (piece + 1) / num_pieces[segment]
+  return a[segment] + t0[:, None] * ab, a[segment] + t1[:, None] * ab, segment
+
+
+def _segment_distances(xy, a, b):
+  """Distances of the points xy to the segments from a to b, row by row."""
+  ab = b - a
+  ap = xy - a
+  length2 = np.einsum('ij,ij->i', ab, ab)
+  t = np.einsum('ij,ij->i', ap, ab) / np.maximum(length2, 1e-12)
+  t = np.minimum(np.maximum(t, 0.0), 1.0)
+  ap -= t[:, None] * ab
+  return np.sqrt(np.einsum('ij,ij->i', ap, ap))
+
+
+def _fixed_mask(n, keep):
+  fixed = np.zeros(n, dtype=bool)
+  if n:
+    fixed[[0, n - 1]] = True
+  if keep is not None:
+    fixed[np.asarray(keep, dtype=np.int64)] = True
+  return fixed
+
+
+def douglas_peucker(xy, max_distance, keep=None):
+  """Keeps the vertices farther than max_distance from the simplified line.
+
+  Instead of recursing, every iteration splits all the ranges between kept
+  vertices at once, at their farthest vertex.
+  """
+  mask = _fixed_mask(len(xy), keep)
+  # Vertices whose range between kept vertices isn't settled yet.
+  candidates = (~mask).nonzero()[0]
+  while len(candidates):
+    kept = mask.nonzero()[0]
+    start = kept.searchsorted(candidates) - 1
+    distances = _segment_distances(xy[candidates], xy[kept[start]], xy[kept[start + 1]])
+    # Candidates are sorted, so the ones of a range are contiguous.
+    first = np.concatenate([[0], (start[1:] != start[:-1]).nonzero()[0] + 1])
+    range_max = np.repeat(np.maximum.reduceat(distances, first), np.diff(np.append(first, len(start))))
+    settled = range_max <= max_distance
+    split = ~settled & (distances == range_max)
+    mask[candidates[split]] = True
+    candidates = candidates[~(settled | split)]
+  return mask
+
+
+def _triangle_areas(xy, prev, cur, nxt):
+  a, b, c = xy[prev], xy[cur], xy[nxt]
+  return 0.5 * np.abs((b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) - (c[:, 0] - a[:, 0]) * (b[:, 1] - a[:, 1]))
+
+
+def visvalingam_whyatt(xy, min_area, keep=None):
+  """Removes the vertices whose effective area is below min_area, in m^2."""
+  n = len(xy)
+  mask = np.ones(n, dtype=bool)
+  if n < 3:
+    return mask
+  fixed = _fixed_mask(n, keep).tolist()
+  areas = [np.inf] * n
+  areas[1:-1] = _triangle_areas(xy, np.arange(0, n - 2), np.arange(1, n - 1), np.arange(2, n)).tolist()
+  heap = [(area, i) for i, area in enumerate(areas) if not fixed[i]]
+  heapq.heapify(heap)
+  # The removals are sequential, so they run on python lists.
+  points = xy.tolist()
+  prev = list(range(-1, n - 1))
+  nxt = list(range(1, n + 1))
+  removed = [False] * n
+  while heap:
+    area, i = heapq.heappop(heap)
+    if removed[i] or area != areas[i]:
+      # Stale entry, the vertex was removed or its area updated.
+      continue
+    if area >= min_area:
+      break
+    removed[i] = True
+    p, q = prev[i], nxt[i]
+    nxt[p], prev[q] = q, p
+    for j in (p, q):
+      if not fixed[j]:
+        (ax, ay), (bx, by), (cx, cy) = points[prev[j]], points[j], points[nxt[j]]
+        # A vertex never has a smaller effective area than the ones removed before it.
+        areas[j] = max(0.5 * abs((bx - ax) * (cy - ay) - (cx - ax) * (by - ay)), area)
+        heapq.heappush(heap, (areas[j], j))
+  mask[removed] = False
+  return mask
+
+
+def _simplify_xy(xy, max_distance, method, keep):
+  if method == 'douglas_peucker':
+    return douglas_peucker(xy, max_distance, keep)
+  if method == 'visvalingam_whyatt':
+    return visvalingam_whyatt(xy, max_distance ** 2, keep)
+  raise ValueError(f'Unknown simplification method: {method}')
+
+
+def simplify_mask(latlngs, max_distance, method='douglas_peucker', keep=None):
+  """Mask of the vertices of latlngs to keep.
+
+  visvalingam_whyatt removes the vertices with an effective area below
+  max_distance^2.
+  """
+  return _simplify_xy(local_xy(latlngs), max_distance, method, keep)
+
+
+def simplify_masks(latlngs_list, max_distance, method='douglas_peucker'):
+  """simplify_mask of many polylines, simplified together as one polyline
+  whose fixed vertices are their endpoints. Much faster for short polylines."""
+  lengths = np.array([len(latlngs) for latlngs in latlngs_list], dtype=np.int64)
+  if lengths.sum() == 0:
+    return [np.ones(n, dtype=bool) for n in lengths]
+  latlngs = np.concatenate([np.asarray(l, dtype=np.float64).reshape(-1, 2) for l in latlngs_list])
+  polyline_index = np.repeat(np.arange(len(lengths)), lengths)
+  mean_lats = np.bincount(polyline_index, weights=latlngs[:, 0], minlength=len(lengths)) / np.maximum(lengths, 1)
+  xy = local_xy(latlngs, mean_lats[polyline_index])
+  ends = np.cumsum(lengths)
+  keep = np.concatenate([ends - lengths, ends - 1])[np.concatenate([lengths, lengths]) > 0]
+  return np.split(_simplify_xy(xy, max_distance, method, keep), ends[:-1])
@@ -0,0 +1,68 @@
+from absl.testing import absltest
+import numpy as np
+
+import simplify
+
+
+def _reference_douglas_peucker(xy, max_distance, start, end, mask):
+  if end - start < 2:
+    return
+  distances = simplify._segment_distances(xy[start + 1:end], np.repeat(xy[start:start + 1], end - start - 1, 0),
+                                          np.repeat(xy[end:end + 1], end - start - 1, 0))
+  farthest = int(distances.argmax())
+  if distances[farthest] > max_distance:
+    mask[start + 1 + farthest] = True
+    _reference_douglas_peucker(xy, max_distance, start, start + 1 + farthest, mask)
+    _reference_douglas_peucker(xy, max_distance, start + 1 + farthest, end, mask)
+
+
+def _random_walk(rng, n):
+  return np.cumsum(rng.normal(size=(n, 2)) * 10.0, axis=0)
+
+
+class SimplifyTest(absltest.TestCase):
+
+  def test_local_xy_round_trips(self):
+    latlngs = np.array([[60.0, -150.0], [60.01, -149.98], [59.99, -150.02]])
+    np.testing.assert_allclose(simplify.latlng_from_xy(simplify.local_xy(latlngs, 60.0), 60.0), latlngs)
+
+  def test_douglas_peucker_matches_the_recursive_algorithm(self):
+    rng = np.random.default_rng(0)
+    for n in (2, 3, 50, 1000):
+      xy = _random_walk(rng, n)
+      expected = np.zeros(n, dtype=bool)
+      expected[[0, n - 1]] = True
+      _reference_douglas_peucker(xy, 15.0, 0, n - 1, expected)
+      np.testing.assert_array_equal(simplify.douglas_peucker(xy, 15.0), expected)
+
+  def test_keeps_the_fixed_vertices(self):
+    xy = _random_walk(np.random.default_rng(1), 200)
+    for method in simplify.METHODS:
+      mask = simplify._simplify_xy(xy, 1e6, method, [50, 120])
+      self.assertEqual(mask.nonzero()[0].tolist(), [0, 50, 120, 199])
+
+  def test_visvalingam_whyatt_removes_small_areas(self):
+    xy = np.array([[0.0, 0.0], [1.0, 0.1], [2.0, 0.0], [3.0, 5.0], [4.0, 0.0]])
+    np.testing.assert_array_equal(simplify.visvalingam_whyatt(xy, 1.0), [True, False, True, True, True])
+
+  def test_simplify_masks_matches_simplify_mask(self):
+    rng = np.random.default_rng(2)
+    latlngs_list = [np.array([60.0, -150.0]) + np.cumsum(rng.normal(size=(n, 2)) * 1e-4, axis=0)
+                    for n in (0, 1, 2, 30, 300)]
+    masks = simplify.simplify_masks(latlngs_list, 5.0)
+    for latlngs, mask in zip(latlngs_list, masks):
+      np.testing.assert_array_equal(mask, simplify.simplify_mask(latlngs, 5.0))
+
+  def test_split_segments(self):
+    a = np.array([[0.0, 0.0], [10.0, 0.0]])
+    b = np.array([[10.0, 0.0], [10.0, 3.0]])
+    piece_a, piece_b, segment = simplify.split_segments(a, b, 4.0)
+    self.assertEqual(segment.tolist(), [0, 0, 0, 1])
+    self.assertTrue((np.hypot(*(piece_b - piece_a).T) <= 4.0).all())
+    np.testing.assert_allclose(piece_a[1:3], piece_b[0:2])
+    np.testing.assert_allclose(piece_a[[0, 3]], a)
+    np.testing.assert_allclose(piece_b[[2, 3]], b)
+
+
+if __name__ == '__main__':
+  absltest.main()
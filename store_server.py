@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Read-only endpoints served from the route snapshots the editor publishes.
+
+Run next to an editor started with -route_store_dir:
+
+  python map_server.py -input_kml alaska.kml -route_store_dir route_store
+  PORT=5001 python map_server.py -route_store_dir route_store -route_store_reader
+
+The workers never parse the KML, they memory-map the latest snapshot and pick
+up new ones as they are published. With gunicorn installed they are
+-route_store_workers pre-forked processes, each keeping its Reader and the
+columns it derived from the snapshot across requests. Without it a single
+threaded process serves every request.
+"""
+
+import json
+import os
+
+from absl import flags
+from flask import Flask, request, make_response
+
+import route
+import route_store
+
+FLAGS = flags.FLAGS
+
+store_app = Flask(__name__)
+
+# Opened in every worker process, reused by all its requests.
+reader = None
+
+
+def latest_snapshot():
+  global reader
+  if reader is None:
+    reader = route_store.Reader(FLAGS.route_store_dir)
+  return reader.snapshot()
+
+
+def json_response(value, status=200):
+  output = make_response(json.dumps(value), status)
+  output.headers["Content-type"] = "application/json"
+  output.headers["Cache-Control"] = "no-store"
+  return output
+
+
+@store_app.before_request
+def require_snapshot():
+  if latest_snapshot() is None:
+    return json_response({'status': 'No snapshot published yet.'}, 503)
+
+
+@store_app.route('/snapshot', methods=['GET'])
+def snapshot_info():
+  snapshot = latest_snapshot()
+  return json_response({'status': 'OK', 'version': snapshot.version, 'revision': snapshot.revision,
+                        'num_routes': len(snapshot), 'num_vertices': len(snapshot.points)})
+
+
+@store_app.route('/query', methods=['GET'])
+def query():
+  return json_response({'status': 'OK', 'route_ids': latest_snapshot().query(request.args.get('labels', ''))})
+
+
+@store_app.route('/route/<int:route_id>', methods=['GET'])
+def get_route(route_id):
+  snapshot = latest_snapshot()
+  if route_id not in snapshot:
+    return json_response({'status': f'Unknown route: {route_id}'}, 404)
+  r = snapshot.get(route_id)
+  return json_response({'status': 'OK', 'id': route_id, 'name': r.name, 'description': r.description,
+                        'labels': r.labels, 'activity_type': r.activity_type, 'color': r.line_style.color,
+                        'width': r.line_style.width, 'points': snapshot.coordinates(route_id)[:, :2].tolist()})
+
+
+@store_app.route('/stats', methods=['GET'])
+def stats():
+  stats_dict = latest_snapshot().compute_stats(request.args.get('labels', ''))
+  return json_response({'status': 'OK', 'stats': stats_dict})
+
+
+@store_app.route('/all_stats', methods=['GET'])
+def all_stats():
+  output = make_response(route.section_stats_csv(latest_snapshot().compute_stats))
+  output.headers["Content-Disposition"] = "attachment; filename=section_stats.csv"
+  output.headers["Content-type"] = "text/csv"
+  return output
+
+
+def serve():
+  if not FLAGS.route_store_dir:
+    raise ValueError('-route_store_reader needs -route_store_dir.')
+  try:
+    import gunicorn.app.base
+  except ImportError:
+    print('gunicorn is not installed, serving the snapshots from a single process.')
+    store_app.run(host="0.0.0.0", port=os.environ.get("PORT", 5000), threaded=True)
+    return
+
+  class PreforkServer(gunicorn.app.base.BaseApplication):
+
+    def load_config(self):
+      self.cfg.set('bind', f'0.0.0.0:{os.environ.get("PORT", 5000)}')
+      self.cfg.set('workers', FLAGS.route_store_workers)
+
+    def load(self):
+      return store_app
+
+  PreforkServer().run()
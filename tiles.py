@@ -0,0 +1,228 @@
+import concurrent.futures
+import math
+import os
+import sqlite3
+import threading
+import time
+import urllib.request
+
+# Basemap layers: id -> (url, attribution, name). The exported maps only
+# show STATIC_LAYERS, the editor shows all of them.
+TILE_LAYERS = {
+  'world_imagery': ('https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
+                    'ArcGIS', 'World_Imagery'),
+  'esri_topo': ('https://server.arcgisonline.com/ArcGIS/rest/services/World_Topo_Map/MapServer/tile/{z}/{y}/{x}',
+                'ESRI', 'ESRI Topo'),
+  'opentopo': ('https://{s}.tile.opentopomap.org/{z}/{x}/{y}.png', 'OpenTopo', 'OpenTopo'),
+  'usgs_topo': ('https://basemap.nationalmap.gov/arcgis/rest/services/USGSTopo/MapServer/tile/{z}/{y}/{x}',
+                'USGS', 'USGS Topo'),
+  'caltopo': ('http://caltopo.s3.amazonaws.com/topo/{z}/{x}/{y}.png?v=1', 'Caltopo', 'CaltopoFS'),
+}
+STATIC_LAYERS = ['world_imagery']
+
+# Leaflet's default maximum zoom, higher levels aren't requested.
+MAX_ZOOM = 18
+
+
+def tile_url(layer, z, x, y):
+  url = TILE_LAYERS[layer][0]
+  return url.format(s='abc'[(x + y) % 3], z=z, x=x, y=y)
+
+
+def tile_range(lat, lng, z):
+  """Tile x, y containing a point at zoom z (web mercator, y going south)."""
+  n = 2 ** z
+  lat = min(max(lat, -85.0511), 85.0511)
+  x = int((lng + 180.0) / 360.0 * n)
+  y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+  return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tiles_in_bounds(bounds, zooms):
+  """Yields the (z, x, y) of the tiles covering ((south, west), (north, east))."""
+  (south, west), (north, east) = bounds
+  for z in zooms:
+    x0, y0 = tile_range(north, west, z)
+    x1, y1 = tile_range(south, east, z)
+    for x in range(x0, x1 + 1):
+      for y in range(y0, y1 + 1):
+        yield z, x, y
+
+
+# MBTiles format metadata of the tile content types.
+MBTILES_FORMATS = {'image/png': 'png', 'image/jpeg': 'jpg', 'image/webp': 'webp'}
+
+
+def content_type(data):
+  if data[:8] == b'\x89PNG\r\n\x1a\n':
+    return 'image/png'
+  if data[:3] == b'\xff\xd8\xff':
+    return 'image/jpeg'
+  if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+    return 'image/webp'
+  return 'application/octet-stream'
+
+
+class MBTiles:
+  """Tiles of one layer in an MBTiles file, evicting the least recently used
+  tiles when the file grows above max_bytes.
+
+  Besides the standard columns, the tiles table keeps the last access time of
+  every tile, only updated when it is more than access_resolution_s old so
+  that panning over cached tiles doesn't write. Rows are in TMS order (y going
+  north), as the spec requires.
+  """
+
+  def __init__(self, path, name, max_bytes, access_resolution_s=600.0):
+    self._max_bytes = max_bytes
+    self._access_resolution_s = access_resolution_s
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(path, check_same_thread=False)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.execute('PRAGMA synchronous=NORMAL')
+    self._db.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)')
+    self._db.execute('CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, '
+                     'tile_row INTEGER, tile_data BLOB, last_access REAL)')
+    self._db.execute('CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles '
+                     '(zoom_level, tile_column, tile_row)')
+    self._db.execute('CREATE INDEX IF NOT EXISTS tile_access ON tiles (last_access)')
+    if self._db.execute('SELECT COUNT(*) FROM metadata').fetchone()[0] == 0:
+      self._db.execute('INSERT INTO metadata VALUES (?, ?)', ('name', name))
+    self._db.commit()
+    # The format metadata is written from the first tile stored, layers serve
+    # png or jpeg tiles.
+    self._format_written = False
+    self.size_bytes = self._db.execute('SELECT COALESCE(SUM(LENGTH(tile_data)), 0) FROM tiles').fetchone()[0]
+
+  def get(self, z, x, y):
+    tms_y = 2 ** z - 1 - y
+    with self._lock:
+      row = self._db.execute('SELECT rowid, tile_data, last_access FROM tiles '
+                             'WHERE zoom_level=? AND tile_column=? AND tile_row=?', (z, x, tms_y)).fetchone()
+      if row is None:
+        return None
+      rowid, data, last_access = row
+      now = time.time()
+      if now - last_access >= self._access_resolution_s:
+        self._db.execute('UPDATE tiles SET last_access=? WHERE rowid=?', (now, rowid))
+        self._db.commit()
+    return data
+
+  def contains(self, z, x, y):
+    with self._lock:
+      return self._db.execute('SELECT 1 FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                              (z, x, 2 ** z - 1 - y)).fetchone() is not None
+
+  def put(self, z, x, y, data):
+    tms_y = 2 ** z - 1 - y
+    with self._lock:
+      old = self._db.execute('SELECT LENGTH(tile_data) FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                             (z, x, tms_y)).fetchone()
+      self._db.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?)',
+                       (z, x, tms_y, sqlite3.Binary(data), time.time()))
+      if not self._format_written and content_type(data) in MBTILES_FORMATS:
+        self._db.execute("DELETE FROM metadata WHERE name='format'")
+        self._db.execute('INSERT INTO metadata VALUES (?, ?)', ('format', MBTILES_FORMATS[content_type(data)]))
+        self._format_written = True
+      self.size_bytes += len(data) - (old[0] if old else 0)
+      if self.size_bytes > self._max_bytes:
+        self._evict()
+      self._db.commit()
+
+  def _evict(self):
+    # Evicts down to 90% of the limit so that evictions happen in batches.
+    target_bytes = 0.9 * self._max_bytes
+    rowids = []
+    cursor = self._db.execute('SELECT rowid, LENGTH(tile_data) FROM tiles ORDER BY last_access')
+    for rowid, size in cursor:
+      if self.size_bytes <= target_bytes:
+        break
+      rowids.append((rowid,))
+      self.size_bytes -= size
+    cursor.close()
+    self._db.executemany('DELETE FROM tiles WHERE rowid=?', rowids)
+
+  def close(self):
+    with self._lock:
+      self._db.close()
+
+
+class TileCache:
+  """Caching proxy of the basemap tile servers, one MBTiles file per layer.
+
+  When offline, tiles are only served from the cache.
+  """
+
+  def __init__(self, cache_dir, max_bytes_per_layer, offline=False, timeout_s=10.0, urls=None,
+               access_resolution_s=600.0):
+    self._cache_dir = cache_dir
+    self._max_bytes = max_bytes_per_layer
+    self._access_resolution_s = access_resolution_s
+    self._offline = offline
+    self._timeout_s = timeout_s
+    # Upstream url templates, overridable to use another tile server.
+    self._urls = urls or {}
+    self._layers = {}
+    self._lock = threading.Lock()
+    os.makedirs(cache_dir, exist_ok=True)
+
+  def _layer(self, layer):
+    with self._lock:
+      if layer not in self._layers:
+        self._layers[layer] = MBTiles(os.path.join(self._cache_dir, f'{layer}.mbtiles'),
+                                      TILE_LAYERS[layer][2], self._max_bytes, self._access_resolution_s)
+      return self._layers[layer]
+
+  def _fetch(self, layer, z, x, y):
+    if layer in self._urls:
+      url = self._urls[layer].format(s='abc'[(x + y) % 3], z=z, x=x, y=y)
+    else:
+      url = tile_url(layer, z, x, y)
+    request = urllib.request.Request(url, headers={'User-Agent': 'routemapper'})
+    with urllib.request.urlopen(request, timeout=self._timeout_s) as response:
+      return response.read()
+
+  def get(self, layer, z, x, y):
+    """Returns the tile data, or None when it isn't available."""
+    if layer not in TILE_LAYERS or not 0 <= z <= MAX_ZOOM or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+      return None
+    mbtiles = self._layer(layer)
+    data = mbtiles.get(z, x, y)
+    if data is not None or self._offline:
+      return data
+    try:
+      data = self._fetch(layer, z, x, y)
+    except OSError as e:
+      print(f'Failed to fetch tile {layer}/{z}/{x}/{y}: {e}')
+      return None
+    mbtiles.put(z, x, y, data)
+    return data
+
+  def seed(self, bounds_list, zooms, layers, max_tiles=100000, num_threads=8):
+    """Downloads the missing tiles covering the bounds for every zoom level.
+
+    Returns the number of tiles downloaded.
+    """
+    tiles = set()
+    for bounds in bounds_list:
+      tiles.update(tiles_in_bounds(bounds, zooms))
+    if len(tiles) * len(layers) > max_tiles:
+      print(f'Not seeding {len(tiles) * len(layers)} tiles, more than {max_tiles}.')
+      return 0
+
+    def seed_tile(layer_tile):
+      layer, (z, x, y) = layer_tile
+      if self._layer(layer).contains(z, x, y):
+        return False
+      return self.get(layer, z, x, y) is not None
+
+    with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+      num_fetched = sum(executor.map(seed_tile, [(layer, tile) for layer in layers for tile in sorted(tiles)]))
+    print(f'Seeded {num_fetched} tiles of {len(tiles) * len(layers)}.')
+    return num_fetched
+
+  def close(self):
+    with self._lock:
+      for mbtiles in self._layers.values():
+        mbtiles.close()
+      self._layers = {}
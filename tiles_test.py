@@ -0,0 +1,90 @@
+import http.server
+import os
+import tempfile
+import threading
+
+from absl.testing import absltest
+
+import tiles
+
+PNG = b'\x89PNG\r\n\x1a\n'
+
+
+class _TileHandler(http.server.BaseHTTPRequestHandler):
+  """Serves /z/x/y as a fake png tile of 1000 bytes, counting requests."""
+
+  def do_GET(self):
+    self.server.requests.append(self.path)
+    body = (PNG + self.path.encode()).ljust(1000, b'\0')
+    self.send_response(200)
+    self.send_header('Content-Type', 'image/png')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+class TileCacheTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.server = http.server.ThreadingHTTPServer(('localhost', 0), _TileHandler)
+    self.server.requests = []
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.addCleanup(self.server.server_close)
+    self.addCleanup(self.server.shutdown)
+    self.cache_dir = tempfile.mkdtemp(dir=absltest.get_default_test_tmpdir())
+
+  def _cache(self, max_bytes=10**6, offline=False):
+    cache = tiles.TileCache(self.cache_dir, max_bytes, offline=offline, access_resolution_s=0.0,
+                            urls={'opentopo': f'http://localhost:{self.server.server_port}/{{z}}/{{x}}/{{y}}'})
+    self.addCleanup(cache.close)
+    return cache
+
+  def test_miss_fetches_and_caches(self):
+    cache = self._cache()
+    data = cache.get('opentopo', 3, 1, 2)
+    self.assertTrue(data.startswith(PNG + b'/3/1/2'))
+    self.assertEqual(self.server.requests, ['/3/1/2'])
+    self.assertTrue(os.path.exists(os.path.join(self.cache_dir, 'opentopo.mbtiles')))
+
+  def test_hit_is_served_from_the_cache(self):
+    cache = self._cache()
+    data = cache.get('opentopo', 3, 1, 2)
+    self.assertEqual(cache.get('opentopo', 3, 1, 2), data)
+    self.assertLen(self.server.requests, 1)
+
+  def test_eviction_removes_the_least_recently_used_tile(self):
+    cache = self._cache(max_bytes=3500)
+    for x in range(3):
+      cache.get('opentopo', 4, x, 0)
+    # Tile 0 is used again, tile 1 is now the least recently used.
+    cache.get('opentopo', 4, 0, 0)
+    cache.get('opentopo', 4, 3, 0)
+    mbtiles = cache._layer('opentopo')
+    self.assertTrue(mbtiles.contains(4, 0, 0))
+    self.assertFalse(mbtiles.contains(4, 1, 0))
+    self.assertTrue(mbtiles.contains(4, 3, 0))
+    self.assertLessEqual(mbtiles.size_bytes, 3500)
+
+  def test_offline_miss_returns_none(self):
+    cache = self._cache(offline=True)
+    self.assertIsNone(cache.get('opentopo', 3, 1, 2))
+    self.assertEmpty(self.server.requests)
+
+  def test_seed_fills_the_bounds(self):
+    cache = self._cache()
+    bounds = ((60.0, -150.0), (61.0, -149.0))
+    expected = set(tiles.tiles_in_bounds(bounds, range(5, 8)))
+    self.assertEqual(cache.seed([bounds], range(5, 8), ['opentopo']), len(expected))
+    self.assertLen(self.server.requests, len(expected))
+    mbtiles = cache._layer('opentopo')
+    self.assertTrue(all(mbtiles.contains(z, x, y) for z, x, y in expected))
+    # Seeding again fetches nothing.
+    self.assertEqual(cache.seed([bounds], range(5, 8), ['opentopo']), 0)
+
+
+if __name__ == '__main__':
+  absltest.main()
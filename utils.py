@@ -1,4 +1,9 @@
 from branca.element import MacroElement, Template, Element, Figure
+import collections
+import folium
+import json
+import metrics
+import polyline
 
 class JavaScript(MacroElement):
   """
@@ -29,7 +34,124 @@ class JavaScript(MacroElement):
         args = {}
     self.args = args
 
-def render_nodes(node, parent):
+def encoded_js(locations, precision):
+  """JS string literal of the encoded polyline of locations."""
+  # branca parses the rendered script as a template again, so braces in the
+  # encoded string are written as JS escapes.
+  return json.dumps(polyline.encode(locations, precision)).replace('{', '\\u007b').replace('}', '\\u007d')
+
+class EncodedPolyLine(folium.PolyLine):
+  """
+  PolyLine whose locations are sent as a Google encoded polyline string.
+
+  Much smaller than the JSON locations of folium.PolyLine, it needs a
+  PolylineDecoder in the map to be decoded by the browser.
+  """
+  _template = Template(u"""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.polyline(
+                decodePolyline({{ this.encoded_js }}, {{ this.precision }}),
+                {{ this.options|tojson }}
+            ).addTo({{this._parent.get_name()}});
+        {% endmacro %}
+        """)
+
+  def __init__(self, locations, precision=5, **kwargs):
+    super(EncodedPolyLine, self).__init__(locations, **kwargs)
+    self.precision = precision
+    self.encoded_js = encoded_js(locations, precision)
+
+class PolylineDecoder(MacroElement):
+  """Adds the decodePolyline() JS function used by EncodedPolyLine to the page."""
+
+  def __init__(self):
+    super(PolylineDecoder, self).__init__()
+    self._name = "PolylineDecoder"
+
+  def render(self, **kwargs):
+    super(PolylineDecoder, self).render(**kwargs)
+    figure = self.get_root()
+    figure.header.add_child(Element(f'<script>{polyline.DECODER_JS}</script>'), name='polyline_decoder')
+
+class RouteRegistry(MacroElement):
+  """Adds route_layers to the page, the layers of every route by route id."""
+
+  def __init__(self):
+    super(RouteRegistry, self).__init__()
+    self._name = "RouteRegistry"
+
+  def render(self, **kwargs):
+    super(RouteRegistry, self).render(**kwargs)
+    figure = self.get_root()
+    figure.header.add_child(Element('<script>var route_layers = {};</script>'), name='route_registry')
+
+class ViewportLoader(MacroElement):
+  """
+  Loads the detailed routes of the visible part of the map from /viewport.
+
+  Every route is drawn as a coarse, non interactive overview line, overviews
+  maps route ids to their addOverview() call. The client sends the ids of the
+  routes in route_layers with every request, so the server can evict the ones
+  that moved off screen.
+  """
+  _template = Template(u"""
+        {% macro script(this, kwargs) %}
+            var overview_lines = {};
+            var overview_group = L.layerGroup().addTo({{ this._parent.get_name() }});
+            function addOverview(route_id, encoded, precision, color) {
+              overview_lines[route_id] = L.polyline(decodePolyline(encoded, precision),
+                  {color: color, weight: 2, opacity: 0.6, interactive: false}).addTo(overview_group);
+            }
+            function removeOverview(route_id) {
+              if (route_id in overview_lines) {
+                overview_group.removeLayer(overview_lines[route_id]);
+                delete overview_lines[route_id];
+              }
+            }
+            {% for overview_js in this.overviews.values() %}{{ overview_js }}
+            {% endfor %}
+            var viewport_request = null;
+            var viewport_outdated = false;
+            function updateViewport() {
+              if (viewport_request) {
+                viewport_outdated = true;
+                return;
+              }
+              var map = {{ this._parent.get_name() }};
+              var bounds = map.getBounds().pad(0.25);
+              viewport_request = $.ajax({
+                url: '/viewport',
+                type: 'POST',
+                data: {south: bounds.getSouth(), west: bounds.getWest(), north: bounds.getNorth(),
+                       east: bounds.getEast(), zoom: map.getZoom(), loaded: Object.keys(route_layers).join(',')},
+                success: function(response) {
+                  response_dict = JSON.parse(response);
+                  if ("js_code" in response_dict) {
+                    eval(response_dict["js_code"]);
+                  }
+                },
+                complete: function() {
+                  viewport_request = null;
+                  if (viewport_outdated) {
+                    viewport_outdated = false;
+                    updateViewport();
+                  }
+                }
+              });
+            }
+            {{ this._parent.get_name() }}.on('moveend', updateViewport);
+            $(updateViewport);
+        {% endmacro %}
+        """)
+
+  def __init__(self):
+    super(ViewportLoader, self).__init__()
+    self._name = "ViewportLoader"
+    self.overviews = collections.OrderedDict()
+
+@metrics.timed('render_nodes')
+def render_nodes(nodes, parent):
+  """Renders the script of a node, or a list of nodes, added to parent."""
   mf = Figure()
   mf._name=parent._name
   mf._id = parent._id
@@ -37,7 +159,8 @@ def render_nodes(node, parent):
           '{{this.script.render(**kwargs)}}\n'
       )
 
-  node.add_to(mf)
+  for node in nodes if isinstance(nodes, (list, tuple)) else [nodes]:
+    node.add_to(mf)
   html = mf.render()
   html = "".join([s for s in html.splitlines(True) if s.strip("\r\n")])
   return html